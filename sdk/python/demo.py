@@ -2,6 +2,8 @@ import math
 import time
 
 import frskyosd
+from frskyosd import scene
+from frskyosd.capture import CaptureWriter
 
 class SYM:
     HOME_ARROW_FIRST = 0x60
@@ -326,6 +328,16 @@ class OSDDemo:
         self.draw_home_indicator(angle, False)
         self.commit()
 
+    def draw_home_scene(self):
+        angle, prev_angle = self.rotate_home(0.1)
+        if not hasattr(self, 'scene'):
+            self.scene = scene.Scene(self.osd)
+        transform = (('rotate', -angle), ('translate', 180, 144))
+        self.scene.set('home', scene.Triangle((0, 6), (6, -6), (-6, -6),
+            stroke=frskyosd.COLOR.BLACK, fill=frskyosd.COLOR.WHITE, transform=transform))
+        self.scene.set('degrees', scene.String(180 - 18, 144 + 20, '%03d' % int(math.degrees(angle))))
+        self.scene.commit()
+
     def draw_triangle(self):
         angle, prev_angle = self.rotate_home(0.1)
         self.begin()
@@ -428,7 +440,7 @@ class OSDDemo:
         opts = 0
         for ii in range(0, self.osd.info.gridRows):
             s = 'This is line {}'.format(ii+1).upper()
-            self.osd.draw_grid_str((self.osd.info.gridColumns - len(s)) / 2, ii, s, opts)
+            self.osd.draw_grid_str((self.osd.info.gridColumns - len(s)) // 2, ii, s, opts)
         self.commit()
 
     def draw_grid_lines_full(self):
@@ -441,37 +453,68 @@ class OSDDemo:
                     s = '+' + s + '+'
                 else:
                     s = s + '-'
-            self.osd.draw_grid_str((self.osd.info.gridColumns - len(s)) / 2, ii, s, opts)
+            self.osd.draw_grid_str((self.osd.info.gridColumns - len(s)) // 2, ii, s, opts)
         self.commit()
 
+def print_wire_stats(t):
+    stats = t.as_dict()
+    by_size = sorted(stats['command_bytes'].items(), key=lambda item: -item[1])
+    print('{} bytes in {} frames, {:.2f}ms encoding: {}'.format(t.wire_bytes, t.frames, t.encode_time * 1000,
+        ', '.join('{} {}'.format(name, size) for name, size in by_size)))
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser()
 
-    draw_choices = ('logo', 'ahi', 'ahi_light', 'compass', 'foo', 'home', 'triangle', 'rect', 'grid', 'grid_lines', 'grid_lines_full')
+    draw_choices = ('logo', 'ahi', 'ahi_light', 'compass', 'foo', 'home', 'home_scene', 'triangle', 'rect', 'grid', 'grid_lines', 'grid_lines_full')
 
     parser.add_argument('--trace', default=False, action='store_true', dest='trace', help='Print all data sent/received')
     parser.add_argument('--profile-at', dest='profile_at', type=str, help='Screen point to draw profiling information at')
     parser.add_argument('--once', default=False, action='store_true', dest='once', help='Draw the element once at exit')
+    parser.add_argument('--track-state', default=False, action='store_true', dest='track_state', help='Skip drawing state commands that wouldn\'t change anything')
+    parser.add_argument('--ctm-tolerance', dest='ctm_tolerance', type=float, default=frskyosd.CTM_TOLERANCE, help='Maximum error in pixels for using compact CTM commands, negative to disable them')
+    parser.add_argument('--compose-ctm', default=False, action='store_true', dest='compose_ctm', help='Compose CTM operations in the host and send them in as few bytes as possible before drawing')
+    parser.add_argument('--wire-stats', default=False, action='store_true', dest='wire_stats', help='Print the bytes sent by each frame, by command')
+    parser.add_argument('--capture', dest='capture', help='Record all data sent/received to the given file, see frskyosd.capture')
+    parser.add_argument('--fps', type=float, dest='fps', help='Target frame rate, dropping frames that the link can\'t keep up with')
     parser.add_argument('port', type=str, help='OSD serial port')
     parser.add_argument('draw', type=str, help='Demo element to draw', choices=draw_choices)
     args = parser.parse_args()
 
-    osd = frskyosd.OSD(args.port, trace=args.trace, profile_at=args.profile_at)
+    capture = None
+    if args.capture:
+        capture = CaptureWriter(open(args.capture, 'wb'))
+
+    try:
+        return run(args, capture)
+    finally:
+        if capture is not None:
+            capture.close()
+
+def run(args, capture):
+    osd = frskyosd.OSD(args.port, trace=args.trace, profile_at=args.profile_at, track_state=args.track_state, ctm_tolerance=args.ctm_tolerance, compose_ctm=args.compose_ctm, wire_stats=args.wire_stats, capture=capture)
     if not osd.connect():
         return 1
 
+    if args.wire_stats:
+        osd.wire_stats.add_callback(print_wire_stats)
+
     demo = OSDDemo(osd)
 
     draw = getattr(demo, 'draw_' + args.draw)
 
     osd.drawing_reset()
     osd.clear_screen()
+    if args.once:
+        draw()
+        return
+    if args.fps:
+        scheduler = frskyosd.FrameScheduler(osd, fps=args.fps)
+        scheduler.run(draw)
+        return
     while True:
         draw()
-        if args.once:
-            break
         time.sleep(0.1)
 
 
@@ -1 +1,18 @@
 from .frskyosd import *
+from .crc import crc8_dvb_s2
+from .scene import Scene
+from .grid import GridBuffer
+from .displaylist import DisplayList
+from .scheduler import FrameScheduler
+from .mock import MockConn, MockOSD, MockOSDServer
+
+try:
+    from .raster import Canvas
+except ImportError:
+    # Requires NumPy
+    pass
+
+import sys as _sys
+if _sys.version_info[0] >= 3:
+    from .aio import AsyncOSD
+    from .group import OSDGroup
@@ -0,0 +1,456 @@
+'''asyncio based OSD client, allowing a single event loop to drive
+several OSDs at the same time. Requires Python 3.'''
+
+import asyncio
+import struct
+
+import serial
+
+from .frskyosd import (
+    BAUDRATE,
+    CMD,
+    DATA_RATES,
+    FLASH_WRITE_END,
+    FONT_CHAR_SIZE,
+    MAX_SEND_BUFFER_SIZE,
+    OSD,
+    RemoteResponseError,
+    ResponseError,
+    SerialConn,
+    TCPConn,
+    _ALLOW_WORKAROUND,
+    _DATA_RATE_MIN_GAIN,
+    _Pipeline,
+    font_fingerprint,
+    parse_mcm,
+)
+
+async def _read_with_timeout(aw, timeout):
+    # Like the blocking connections, a read that times out raises
+    # IOError. asyncio.TimeoutError isn't an IOError before Python 3.11.
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        raise IOError('timed out')
+
+class AsyncTCPConn(object):
+
+    RECV_SIZE = TCPConn.RECV_SIZE
+
+    def __init__(self, reader, writer, timeout=None):
+        self._reader = reader
+        self._writer = writer
+        self.timeout = timeout
+
+    @classmethod
+    async def open(cls, loc, timeout=None):
+        host, port = loc.split(':')
+        reader, writer = await asyncio.open_connection(host, int(port))
+        return cls(reader, writer, timeout)
+
+    def write(self, b):
+        # b might be a view of the OSD frame buffer, which is reused
+        self._writer.write(bytes(b))
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def read_available(self):
+        data = await _read_with_timeout(self._reader.read(self.RECV_SIZE), self.timeout)
+        if not data:
+            raise IOError('connection closed')
+        return data
+
+    def close(self):
+        self._writer.close()
+
+class AsyncSerialConn(object):
+    '''Serial port in non-blocking mode, driven by the event loop
+    readiness callbacks. Only available on platforms where
+    add_reader()/add_writer() support serial ports (i.e. not Windows).'''
+
+    def __init__(self, port, baudrate, timeout=None):
+        self.timeout = timeout
+        self._loop = asyncio.get_event_loop()
+        self._conn = serial.Serial(port, baudrate, timeout=0, write_timeout=0)
+        self._fd = self._conn.fileno()
+        self._recv_buf = bytearray()
+        self._readable = asyncio.Event()
+        self._send_buf = bytearray()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    def _on_readable(self):
+        data = self._conn.read(self._conn.in_waiting or 1)
+        if data:
+            self._recv_buf.extend(data)
+            self._readable.set()
+
+    def _on_writable(self):
+        n = self._conn.write(bytes(self._send_buf))
+        del self._send_buf[:n or 0]
+        if not self._send_buf:
+            self._loop.remove_writer(self._fd)
+            self._drained.set()
+
+    def write(self, b):
+        if not self._send_buf:
+            self._drained.clear()
+            self._loop.add_writer(self._fd, self._on_writable)
+        self._send_buf.extend(b)
+
+    async def drain(self):
+        await self._drained.wait()
+
+    async def read_available(self):
+        while not self._recv_buf:
+            self._readable.clear()
+            await _read_with_timeout(self._readable.wait(), self.timeout)
+        data = bytes(self._recv_buf)
+        del self._recv_buf[:]
+        return data
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+        if self._send_buf:
+            self._loop.remove_writer(self._fd)
+        self._conn.close()
+
+class AsyncOSD(OSD):
+    '''OSD client for asyncio. Drawing functions are the same than
+    in OSD and just append commands to the send buffer, while the
+    functions performing round trips to the device are coroutines.
+    Frames sent when the buffer fills up are queued in the transport
+    and sent in the background. Await drain() or transaction_commit()
+    to wait for them to be sent.
+
+    MSP passthrough is not supported.'''
+
+    async def open(self):
+        '''Open the connection to the OSD'''
+        if self.conn is not None:
+            self.conn.close()
+
+        self.recv_buffer.clear()
+        self._decoder.reset()
+        self._forget_drawing_state()
+        if self.msp_passthrough:
+            raise NotImplementedError('MSP passthrough is not supported by AsyncOSD')
+        if SerialConn.accepts(self.port):
+            self.conn = AsyncSerialConn(self.port, self.baudrate, self.timeout)
+        elif TCPConn.accepts(self.port):
+            self.conn = await AsyncTCPConn.open(self.port, self.timeout)
+        else:
+            print("Unknown port type {}".format(self.port))
+            return False
+        return True
+
+    async def close(self):
+        if self.conn is not None:
+            self.flush()
+            await self.drain()
+            self.conn.close()
+            self.conn = None
+        if self.capture is not None:
+            self.capture.flush()
+
+    async def connect(self, force=False):
+        '''Open the connection and retrieve OSD info'''
+        if self.is_connected() and not force:
+            return True
+        if not await self.open():
+            return False
+        resp = await self.get_info()
+        if not resp or resp.cmd != CMD.INFO:
+            print("Invalid CMD.INFO response {}".format(resp))
+            return False
+
+        self.info = resp
+        if resp.is_bootloader:
+            print('FrSky OSD bootloader')
+        else:
+            print("FrSky OSD {}.{}.{}, {}x{} grid, {}x{} pixels".format(resp.major, resp.minor, resp.patch, resp.gridColumns, resp.gridRows, resp.pixelWidth, resp.pixelHeight))
+        return True
+
+    async def drain(self):
+        '''Wait until all the flushed frames have been sent'''
+        await self.conn.drain()
+
+    async def get_active_camera(self):
+        resp = await self.send_frame_sync_resp(CMD.GET_ACTIVE_CAMERA)
+        return resp.byte_at(0)
+
+    async def transaction_commit(self):
+        super(AsyncOSD, self).transaction_commit()
+        await self.drain()
+
+    # Raw frame handling
+
+    async def send_frame_sync_resp(self, cmd, payload=None):
+        self.send_frame(cmd, payload)
+        self.flush_send_buffer()
+        await self.drain()
+        return await self._recv_response()
+
+    async def _recv_response(self):
+        while not self.recv_buffer:
+            if not self._feed_received(await self.conn.read_available()):
+                return None
+        return self._pop_response()
+
+    async def _send_pipelined(self, cmd, payloads, window, check, on_ack=None, retries=3):
+        pipeline = _Pipeline(cmd, payloads, window, check, on_ack, retries)
+        while not pipeline.done():
+            for payload in pipeline.next_requests():
+                self.send_frame(cmd, payload)
+                self.flush_send_buffer()
+            await self.drain()
+            for ii in range(pipeline.handle(await self._recv_pipelined_response())):
+                await self._recv_pipelined_response()
+        return pipeline.responses
+
+    async def _discard_responses(self):
+        self.recv_buffer.clear()
+        if self.timeout is None:
+            return
+        try:
+            while True:
+                self._feed_received(await self.conn.read_available())
+                self.recv_buffer.clear()
+        except IOError:
+            pass
+
+    async def _recv_pipelined_response(self):
+        try:
+            return await self._recv_response()
+        except IOError:
+            self._abort_partial_frame()
+            return None
+
+    async def set_data_rate(self, dr):
+        payload = self._pack_u32(dr or BAUDRATE)
+        resp = await self.send_frame_sync_resp(CMD.SET_DATA_RATE, payload)
+        if resp is None or resp.cmd != CMD.SET_DATA_RATE:
+            raise RuntimeError('invalid SET_DATA_RATE response {}'.format(resp))
+        new_dr = struct.unpack('<I', resp.payload)[0]
+        if new_dr != self.baudrate:
+            if self.trace:
+                print("changing baudrate from {} to {}".format(self.baudrate, new_dr))
+            self.baudrate = new_dr
+            await self.open()
+        return self.baudrate
+
+    async def auto_tune_data_rate(self, rates=None, burst_frames=8, timeout=0.5):
+        if not SerialConn.accepts(self.port):
+            raise RuntimeError('data rate tuning requires a direct serial connection')
+        prev_timeout = self.timeout
+        self.timeout = timeout
+        try:
+            await self.open()
+            best = self.baudrate
+            best_throughput = await self._probe_data_rate(burst_frames)
+            if best_throughput is None:
+                raise RuntimeError('OSD not responding at {} bps'.format(self.baudrate))
+            for rate in sorted(r for r in (rates or DATA_RATES) if r > self.baudrate):
+                prev = self.baudrate
+                try:
+                    await self.set_data_rate(rate)
+                    throughput = await self._probe_data_rate(burst_frames)
+                except (IOError, RuntimeError):
+                    throughput = None
+                if self.debug:
+                    print('data rate {}: {}'.format(rate, 'failed' if throughput is None else '{:.0f} bytes/s'.format(throughput)))
+                if throughput is None:
+                    await self._fall_back_data_rate(best, (rate, prev))
+                    break
+                if throughput > best_throughput * _DATA_RATE_MIN_GAIN:
+                    best = self.baudrate
+                    best_throughput = throughput
+            if self.baudrate != best:
+                await self.set_data_rate(best)
+        finally:
+            self.timeout = prev_timeout
+            await self.open()
+        return self.baudrate
+
+    async def _probe_data_rate(self, burst_frames):
+        if not await self._verify_data_rate():
+            return None
+        if self.send_buffer:
+            self.flush()
+        burst = bytearray([CMD.CONTEXT_PUSH, CMD.CONTEXT_POP] * (MAX_SEND_BUFFER_SIZE // 2))
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        written = self.bytes_written
+        for ii in range(burst_frames):
+            self.send_commands(burst)
+            self.flush_send_buffer()
+        await self.drain()
+        if not await self._verify_data_rate():
+            return None
+        return (self.bytes_written - written) / (loop.time() - start)
+
+    async def _verify_data_rate(self):
+        errors = self._decoder.errors
+        try:
+            resp = await self.get_info()
+        except IOError:
+            return False
+        return resp is not None and resp.cmd == CMD.INFO and self._decoder.errors == errors
+
+    async def _fall_back_data_rate(self, rate, candidates):
+        for attempt in range(2):
+            for candidate in candidates:
+                self.baudrate = candidate
+                await self.open()
+                try:
+                    await self.set_data_rate(rate)
+                except (IOError, RuntimeError):
+                    pass
+                self.baudrate = rate
+                await self.open()
+                if await self._verify_data_rate():
+                    return
+        raise RuntimeError('lost connection to the OSD while changing its data rate, reboot it to restore {} bps'.format(BAUDRATE))
+
+    # MSP
+
+    def _msp_req(self, cmd, payload=None):
+        raise NotImplementedError('MSP passthrough is not supported by AsyncOSD')
+
+    def _set_msp_passthrough(self):
+        raise NotImplementedError('MSP passthrough is not supported by AsyncOSD')
+
+    def _stop_msp_passthrough(self):
+        raise NotImplementedError('MSP passthrough is not supported by AsyncOSD')
+
+    # Widgets
+
+    async def _widget_set_config(self, wid, config):
+        payload = struct.pack('<B', wid) + config
+        resp = await self.send_frame_sync_resp(CMD.WIDGET_SET_CONFIG, payload)
+        if isinstance(resp, ResponseError):
+            raise RemoteResponseError(resp, 'error configuring widget {}: {}'.format(wid, resp.error_code))
+
+    # Fonts
+
+    async def upload_font(self, font, progress=None, window=1):
+        data = parse_mcm(font)
+        chars = range(len(data) // FONT_CHAR_SIZE)
+        payloads, check, on_ack = self._write_font_transfer(data, chars, progress)
+        await self._send_pipelined(CMD.WRITE_FONT, payloads, window, check, on_ack)
+
+    async def read_font(self, chars, window=1):
+        payloads, check, on_ack, data = self._read_font_transfer(chars)
+        await self._send_pipelined(CMD.READ_FONT, payloads, window, check, on_ack)
+        return data
+
+    async def sync_font(self, font, cache=None, progress=None, window=1):
+        data = parse_mcm(font)
+        hashes = font_fingerprint(data)
+        chars = range(len(hashes))
+        current = self._cached_font_fingerprint(chars, cache)
+        if current is None:
+            current = font_fingerprint(await self.read_font(chars, window))
+        changed = [c for c in chars if hashes[c] != current[c]]
+        payloads, check, on_ack = self._write_font_transfer(data, changed, progress)
+        await self._send_pipelined(CMD.WRITE_FONT, payloads, window, check, on_ack)
+        return self._sync_font_done(hashes, changed, cache)
+
+    # Firmware flashing
+
+    async def flash_firmware(self, f, no_reboot=False, progress=None, window=1):
+        if not no_reboot:
+            self.reboot(True)
+            await asyncio.sleep(1)
+        return await self.flash_firmware_bl(f, progress, window)
+
+    async def erase_firmware(self, no_reboot=False):
+        if not no_reboot:
+            self.reboot(True)
+            await asyncio.sleep(1)
+        payload = struct.pack('<L', 0)
+        resp = await self.send_frame_sync_resp(CMD.WRITE_FLASH, payload)
+        self._ensure_write_flash_response(resp, 0)
+        await self._flash_finish()
+
+    async def _flash_finish(self, allow_workaround=False):
+        payload = struct.pack('<L', FLASH_WRITE_END)
+        resp = await self.send_frame_sync_resp(CMD.WRITE_FLASH, payload)
+        self._ensure_write_flash_response(resp, 0, allow_workaround=allow_workaround)
+        self.reboot()
+        await self.drain()
+
+    async def flash_firmware_bl(self, f, progress=None, window=1):
+        payloads, check, on_ack, total = self._flash_transfer(f, progress)
+        start = asyncio.get_event_loop().time()
+        await self._send_pipelined(CMD.WRITE_FLASH, payloads, window, check, on_ack)
+        rate = self._flash_rate(total, asyncio.get_event_loop().time() - start)
+        await self._flash_finish(allow_workaround=_ALLOW_WORKAROUND)
+        return rate
+
+    # VM
+
+    async def _vm_storage_size(self):
+        resp = await self.send_frame_sync_resp(CMD.VM_STORAGE_SIZE)
+        if isinstance(resp, ResponseError):
+            raise RemoteResponseError(resp, 'error retrieving storage size: {}'.format(resp.error_code))
+        return struct.unpack('<L', resp.payload)[0]
+
+    async def upload_program(self, f, window=1):
+        raw = f.read()
+        payload = self._program_header(raw, await self._vm_storage_size())
+        resp = await self.send_frame_sync_resp(CMD.VM_STORAGE_WRITE, payload)
+        offset = self._upload_resp_offset(resp)
+        payloads, check = self._program_upload_transfer(raw, offset)
+        await self._send_pipelined(CMD.VM_STORAGE_WRITE, payloads, window, check)
+
+    async def download_program(self, f, window=1, retries=3):
+        header_size = self._vm_storage_header_size()
+        payload = struct.pack('<LL', 0, header_size)
+        resp = await self.send_frame_sync_resp(CMD.VM_STORAGE_READ, payload)
+        size, crc = struct.unpack('<LL', resp.payload)
+        if size > await self._vm_storage_size():
+            raise RuntimeError('no valid data found in the vm storage')
+        for attempt in range(retries + 1):
+            payloads, check, on_ack, data = self._program_download_transfer(size)
+            await self._send_pipelined(CMD.VM_STORAGE_READ, payloads, window, check, on_ack)
+            if self._crc32_ieee(bytes(data)) == crc:
+                f.write(data)
+                return
+            # See OSD.download_program()
+            window = 1
+            await self._discard_responses()
+        raise RuntimeError('downloaded program doesn\'t match its CRC after {} retries'.format(retries))
+
+    async def start_program(self):
+        self._forget_drawing_state()
+        resp = await self.send_frame_sync_resp(CMD.VM_START)
+        if isinstance(resp, ResponseError):
+            raise RemoteResponseError(resp, 'error starting program: {}'.format(resp.error_code))
+        return struct.unpack('<L', resp.payload)[0]
+
+    async def run_program(self, f):
+        try:
+            await self.upload_program(f)
+        except RemoteResponseError as e:
+            if e.resp.error_code != -9:
+                raise
+        await self.start_program()
+
+    async def _vm_lookup_symbol(self, name):
+        payload = self._pack_str(name)
+        resp = await self.send_frame_sync_resp(CMD.VM_LOOKUP_SYMBOL, payload)
+        if isinstance(resp, ResponseError):
+            raise RemoteResponseError(resp, 'error looking up symbol "{}": {}'.format(name, resp.error_code))
+        return struct.unpack('<h', resp.payload)[0]
+
+    async def run_function(self, name, args=None, reply=True):
+        sym = await self._vm_lookup_symbol(name)
+        payload = self._pack_function_call(sym, args, reply)
+        self._forget_drawing_state()
+        if reply:
+            resp = await self.send_frame_sync_resp(CMD.VM_EXEC, payload)
+            return struct.unpack('<L', resp.payload)[0]
+        self.send_frame(CMD.VM_EXEC, payload)
@@ -0,0 +1,227 @@
+'''Benchmarks for the host side of the SDK. Run them with:
+
+    python -m frskyosd.bench [--output results.json] [--port host:port]
+
+or with --benchmark from the frskyosd.py command line. The results
+are a dict serialized as JSON, so runs can be compared across
+releases. Drawing commands are encoded into a connection that just
+counts the bytes, so the link speed doesn't affect them, while round
+trips go to the given port or to a local MockOSDServer.
+
+The demo.py and widgets.py scenes are measured when those modules
+can be imported (i.e. when running from the SDK directory). The
+encoding and scene benchmarks are also available as pytest-benchmark
+tests in tests/test_bench.py.'''
+
+import importlib
+import json
+import platform
+import sys
+import time
+import timeit
+
+from .crc import benchmark as crc_benchmark
+from .frskyosd import BAUDRATE, CMD, OSD
+from .mock import MockConn, MockOSDServer
+from .scheduler import BITS_PER_BYTE
+
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    _timer = time.time
+
+_POLYLINE = [(100 + ii * 4, 80 + (ii % 2) * 10) for ii in range(32)]
+
+# Name and function encoding a single primitive
+PRIMITIVES = (
+    ('_pack_point', lambda osd: osd._pack_point(120, 80)),
+    ('move_to_point', lambda osd: osd.move_to_point(120, 80)),
+    ('stroke_line_to_point', lambda osd: osd.stroke_line_to_point(200, 150)),
+    ('fill_rect', lambda osd: osd.fill_rect((10, 20, 30, 40))),
+    ('draw_str', lambda osd: osd.draw_str(10, 20, 'ALT 120M')),
+    ('draw_grid_chr', lambda osd: osd.draw_grid_chr(1, 2, 'A')),
+    ('draw_grid_str', lambda osd: osd.draw_grid_str(1, 2, 'ALT 120M')),
+    ('widget_graph_draw', lambda osd: osd.widget_graph_draw(0, 12345)),
+    ('stroke_polyline', lambda osd: osd.stroke_polyline(_POLYLINE)),
+)
+
+# Module, class and scene names for the demos
+SCENES = (
+    ('demo', 'OSDDemo', ('logo', 'ahi', 'ahi_light', 'compass', 'foo', 'home', 'home_scene',
+                         'triangle', 'rect', 'grid', 'grid_lines', 'grid_lines_full')),
+    ('widgets', 'OSDWidgetsDemo', ('ahi', 'ahi_line', 'sidebar', 'graph')),
+)
+
+class _CountingConn(object):
+    # Discards the data, counting bytes and writes
+
+    def __init__(self):
+        self.bytes_out = 0
+        self.writes = 0
+
+    def write(self, b):
+        self.bytes_out += len(b)
+        self.writes += 1
+
+    def close(self):
+        pass
+
+def _mock_osd():
+    # OSD connected to a MockOSD, with its info already retrieved
+    osd = OSD('mock')
+    osd.conn = MockConn()
+    osd.info = osd.get_info()
+    return osd
+
+def _best(fn, number, repeat):
+    # Best time for number calls to fn, in seconds
+    return min(timeit.repeat(fn, number=number, repeat=repeat))
+
+def encode(number=2000, repeat=3):
+    '''Measure how fast each primitive in PRIMITIVES is encoded.
+    Returns a dict with ops_per_sec and the bytes_per_op sent for
+    each one, including the frame overhead.'''
+    osd = _mock_osd()
+    conn = _CountingConn()
+    osd.conn = conn
+    results = {}
+    for name, fn in PRIMITIVES:
+        elapsed = _best(lambda: fn(osd), number, repeat)
+        osd.flush_send_buffer()
+        if name.startswith('_pack'):
+            size = len(fn(osd))
+        else:
+            start = conn.bytes_out
+            for ii in range(number):
+                fn(osd)
+            osd.flush_send_buffer()
+            size = float(conn.bytes_out - start) / number
+        results[name] = {
+            'ops_per_sec': number / elapsed,
+            'bytes_per_op': size,
+        }
+    return results
+
+def _scene_draw(module, cls, name, osd):
+    demo = getattr(module, cls)(osd)
+    draw = getattr(demo, 'draw_' + name)
+    if module.__name__ != 'widgets':
+        return draw
+    # The widgets demo wraps each draw in a transaction in its main()
+    def transaction():
+        osd.transaction_begin()
+        draw()
+        osd.transaction_commit()
+    return transaction
+
+def scenes(frames=200, repeat=3):
+    '''Measure the demo scenes. Returns a dict keyed by module.scene
+    with the fps the host can encode, the bytes_per_frame sent and the
+    writes_per_frame (i.e. frames flushed to the link), plus the
+    link_fps a link at the default data rate could carry. Scenes
+    that raise an exception report it as error.'''
+    results = {}
+    for module_name, cls, names in SCENES:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        for name in names:
+            key = '{}.{}'.format(module_name, name)
+            osd = _mock_osd()
+            try:
+                draw = _scene_draw(module, cls, name, osd)
+                # First frame against the mock, since widgets configure
+                # themselves with round trips
+                draw()
+                osd.flush_send_buffer()
+                conn = _CountingConn()
+                osd.conn = conn
+                elapsed = _best(draw, frames, repeat)
+            except Exception as e:
+                results[key] = {'error': '{}: {}'.format(type(e).__name__, e)}
+                continue
+            total = frames * repeat
+            bytes_per_frame = float(conn.bytes_out) / total
+            results[key] = {
+                'fps': frames / elapsed,
+                'bytes_per_frame': bytes_per_frame,
+                'writes_per_frame': float(conn.writes) / total,
+                'link_fps': BAUDRATE / (bytes_per_frame * BITS_PER_BYTE) if bytes_per_frame else None,
+            }
+    return results
+
+def round_trip(port=None, count=200, timeout=1.0):
+    '''Measure the latency of get_info() against port or, if it's
+    None, against a MockOSDServer on the loopback interface that
+    doesn't emulate the link. A response not received within timeout
+    seconds aborts the benchmark. Returns the min, mean, median, p95
+    and max latency in seconds.'''
+    server = None
+    if port is None:
+        server = MockOSDServer(emulate_link=False)
+        server.start()
+        port = server.address
+    osd = OSD(port, timeout=timeout)
+    try:
+        if not osd.open():
+            raise RuntimeError('could not open {}'.format(port))
+        osd.get_info()
+        samples = []
+        for ii in range(count):
+            start = _timer()
+            resp = osd.get_info()
+            samples.append(_timer() - start)
+            if resp is None or resp.cmd != CMD.INFO:
+                raise RuntimeError('invalid CMD.INFO response {}'.format(resp))
+    finally:
+        osd.close()
+        if server is not None:
+            server.stop()
+    samples.sort()
+    return {
+        'port': 'mock' if server is not None else port,
+        'count': count,
+        'min': samples[0],
+        'mean': sum(samples) / len(samples),
+        'median': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+def run(port=None, quick=False):
+    '''Run all the benchmarks, returning a dict with the results.
+    With quick=True, fewer iterations are done.'''
+    scale = 10 if quick else 1
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'encode': encode(number=2000 // scale),
+        'scenes': scenes(frames=200 // scale),
+        'crc': crc_benchmark(number=100 // scale),
+        'round_trip': round_trip(port, count=200 // scale),
+    }
+
+def write_json(results, f):
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the OSD SDK, printing the results as JSON')
+    parser.add_argument('--port', type=str, help='OSD port for the round trip benchmark, a local mock OSD by default')
+    parser.add_argument('--quick', default=False, action='store_true', help='Run fewer iterations')
+    parser.add_argument('--output', type=str, help='Write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = run(args.port, args.quick)
+    if args.output:
+        with open(args.output, 'w') as f:
+            write_json(results, f)
+    else:
+        write_json(results, sys.stdout)
+
+if __name__ == '__main__':
+    main()
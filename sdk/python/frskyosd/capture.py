@@ -0,0 +1,235 @@
+'''Binary capture of the data exchanged with the OSD, to be decoded
+or replayed later. Captures are recorded by passing a CaptureWriter
+to the OSD:
+
+    with open('session.cap', 'wb') as f:
+        osd = OSD(port, capture=CaptureWriter(f))
+        ...
+        osd.close()
+
+and can be printed as commands or replayed with:
+
+    python -m frskyosd.capture decode session.cap
+    python -m frskyosd.capture replay session.cap host:port [--speed N]
+
+A capture starts with MAGIC and the wall clock time it was started
+at, as a little endian double. It's followed by a record for each
+write and each read, with a header containing the direction (SENT or
+RECEIVED), the time since the start as a double and the size of the
+data as an uint32.'''
+
+import collections
+import struct
+import threading
+import time
+
+from .frskyosd import (
+    BAUDRATE,
+    MAX_RESPONSE_SIZE,
+    OSD,
+    FrameDecoder,
+    _cmd_names,
+    _format_payload,
+    _timer,
+    iter_commands,
+)
+
+MAGIC = b'FOSDCAP\x01'
+
+# Record directions
+SENT = 0
+RECEIVED = 1
+
+_START = struct.Struct('<d')
+_RECORD = struct.Struct('<BdI')
+
+CaptureRecord = collections.namedtuple('CaptureRecord', ('time', 'direction', 'data'))
+CaptureEvent = collections.namedtuple('CaptureEvent', ('time', 'direction', 'cmd', 'payload'))
+
+class CaptureWriter(object):
+    '''Records the data written to and read from the OSD into f, a
+    file opened in binary mode. Records are accumulated in memory and
+    written in blocks of buffer_size bytes, so capturing adds little
+    overhead to each write. Call flush() or close() to write the
+    pending records.'''
+
+    def __init__(self, f, buffer_size=64 * 1024):
+        self._f = f
+        self._buffer_size = buffer_size
+        self._buf = bytearray(MAGIC + _START.pack(time.time()))
+        self._start = _timer()
+        self.records = 0
+
+    def _record(self, direction, data):
+        buf = self._buf
+        buf += _RECORD.pack(direction, _timer() - self._start, len(data))
+        buf += data
+        self.records += 1
+        if len(buf) >= self._buffer_size:
+            self.flush()
+
+    def sent(self, data):
+        self._record(SENT, data)
+
+    def received(self, data):
+        self._record(RECEIVED, data)
+
+    def flush(self):
+        if self._buf:
+            self._f.write(self._buf)
+            del self._buf[:]
+        self._f.flush()
+
+    def close(self):
+        self.flush()
+        self._f.close()
+
+def read_capture(f):
+    '''Yield a CaptureRecord for each record in the capture file f. A
+    truncated record at the end, e.g. from a process that didn't close
+    the capture, is ignored.'''
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a capture file')
+    f.read(_START.size)
+    while True:
+        header = f.read(_RECORD.size)
+        if len(header) < _RECORD.size:
+            return
+        direction, t, size = _RECORD.unpack(header)
+        data = f.read(size)
+        if len(data) < size:
+            return
+        yield CaptureRecord(t, direction, data)
+
+def capture_start_time(f):
+    '''Returns the wall clock time the capture in f was started at'''
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a capture file')
+    return _START.unpack(f.read(_START.size))[0]
+
+def decode_capture(records):
+    '''Reconstruct the command stream from the records returned by
+    read_capture(). Yields a CaptureEvent for each command sent and for
+    each response received, with the time of the record that completed
+    its frame. Data that doesn't belong to a valid frame is skipped.'''
+    decoders = {SENT: FrameDecoder(), RECEIVED: FrameDecoder(MAX_RESPONSE_SIZE)}
+    for rec in records:
+        for payload in decoders[rec.direction].feed_payloads(rec.data):
+            if rec.direction == SENT:
+                for cmd, p in iter_commands(bytearray(payload)):
+                    yield CaptureEvent(rec.time, SENT, cmd, bytes(p))
+            elif payload:
+                yield CaptureEvent(rec.time, RECEIVED, payload[0], bytes(payload[1:]))
+
+def format_event(ev, names=None):
+    names = names or _cmd_names()
+    arrow = '>>' if ev.direction == SENT else '<<'
+    line = '{:12.6f} {} {}'.format(ev.time, arrow, names.get(ev.cmd, ev.cmd))
+    if ev.payload:
+        line += ' ' + _format_payload(bytearray(ev.payload))
+    return line
+
+def replay(records, port, speed=1.0, baudrate=BAUDRATE, wait=1.0):
+    '''Send the data in the SENT records to the OSD at port. With
+    speed=1.0 the records are sent with their original timing, higher
+    values replay faster and None sends them as fast as possible.
+    Received data is read in the background and counted. After the last
+    record, waits up to wait seconds for the missing responses.
+
+    The data rate is not changed during the replay, so captures that
+    change it must be replayed to a port already at the final rate.
+
+    Returns a dict with the number of frames and bytes sent, the
+    responses received and the responses present in the capture.'''
+    records = list(records)
+    expected = sum(1 for ev in decode_capture(records) if ev.direction == RECEIVED)
+    osd = OSD(port, baudrate=baudrate, timeout=0.1)
+    if not osd.open():
+        raise RuntimeError('could not open {}'.format(port))
+    conn = osd.conn
+    received = [0, 0]
+    done = threading.Event()
+
+    def read():
+        decoder = FrameDecoder(MAX_RESPONSE_SIZE)
+        while not done.is_set():
+            try:
+                data = conn._read_available()
+            except IOError:
+                # Timed out
+                continue
+            if not data:
+                break
+            received[0] += len(data)
+            received[1] += len(decoder.feed_payloads(data))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    sent = 0
+    writes = 0
+    start = _timer()
+    try:
+        for rec in records:
+            if rec.direction != SENT:
+                continue
+            if speed:
+                delay = rec.time / speed - (_timer() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            conn.write(rec.data)
+            sent += len(rec.data)
+            writes += 1
+        deadline = _timer() + wait
+        while received[1] < expected and _timer() < deadline and reader.is_alive():
+            time.sleep(0.01)
+        elapsed = _timer() - start
+    finally:
+        done.set()
+        reader.join()
+        conn.close()
+    return {
+        'writes': writes,
+        'bytes_sent': sent,
+        'bytes_received': received[0],
+        'responses': received[1],
+        'expected_responses': expected,
+        'elapsed': elapsed,
+    }
+
+def main():
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(description='Decode or replay OSD captures')
+    subparsers = parser.add_subparsers(dest='action')
+    decode_parser = subparsers.add_parser('decode', help='Print the commands and responses in a capture')
+    decode_parser.add_argument('capture', type=str, help='Capture file')
+    replay_parser = subparsers.add_parser('replay', help='Send the captured commands to an OSD')
+    replay_parser.add_argument('capture', type=str, help='Capture file')
+    replay_parser.add_argument('port', type=str, help='OSD port. Supports both path to serial port path or host:port')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='Replay speed relative to the capture, 0 to send as fast as possible')
+    replay_parser.add_argument('--baudrate', type=int, default=BAUDRATE, help='Data rate of the serial port')
+    args = parser.parse_args()
+
+    if args.action == 'decode':
+        names = _cmd_names()
+        with open(args.capture, 'rb') as f:
+            print('capture started at {}'.format(time.ctime(capture_start_time(f))))
+            f.seek(0)
+            for ev in decode_capture(read_capture(f)):
+                print(format_event(ev, names))
+    elif args.action == 'replay':
+        with open(args.capture, 'rb') as f:
+            records = list(read_capture(f))
+        results = replay(records, args.port, speed=args.speed or None, baudrate=args.baudrate)
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        parser.print_help()
+        return 1
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main() or 0)
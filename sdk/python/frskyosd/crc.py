@@ -0,0 +1,58 @@
+'''CRC8 DVB-S2 (polynomial 0xD5, initial value 0) as used by the OSD framing'''
+
+CRC8_DVB_S2_POLY = 0xD5
+
+def _crc8_dvb_s2_bitwise(crc, b):
+    crc ^= b
+    for ii in range(8):
+        if crc & 0x80:
+            crc = ((crc << 1) ^ CRC8_DVB_S2_POLY) & 0xff
+        else:
+            crc = (crc << 1) & 0xff
+    return crc
+
+_CRC8_DVB_S2_TABLE = bytearray([_crc8_dvb_s2_bitwise(0, ii) for ii in range(256)])
+
+def crc8_dvb_s2_byte(crc, b):
+    '''Update crc with a single byte'''
+    return _CRC8_DVB_S2_TABLE[crc ^ b]
+
+def crc8_dvb_s2(data, init=0):
+    '''Return the CRC of a whole bytes, bytearray or memoryview, starting at init'''
+    table = _CRC8_DVB_S2_TABLE
+    crc = init
+    for b in bytearray(data):
+        crc = table[crc ^ b]
+    return crc
+
+def benchmark(size=4096, number=100):
+    '''Compare the table driven CRC against the bitwise implementation.
+    Returns a dict with the throughput of both, in bytes/s.'''
+    import os
+    import timeit
+
+    data = bytearray(os.urandom(size))
+
+    def bitwise():
+        crc = 0
+        for b in data:
+            crc = _crc8_dvb_s2_bitwise(crc, b)
+        return crc
+
+    def table():
+        return crc8_dvb_s2(data)
+
+    if bitwise() != table():
+        raise RuntimeError('CRC implementations disagree')
+
+    results = {}
+    for name, fn in (('bitwise', bitwise), ('table', table)):
+        elapsed = min(timeit.repeat(fn, number=number, repeat=3))
+        results[name] = size * number / elapsed
+    return results
+
+if __name__ == '__main__':
+    results = benchmark()
+    for name in ('bitwise', 'table'):
+        print('{}: {:.0f} bytes/s'.format(name, results[name]))
+    print('speedup: {:.1f}x'.format(results['table'] / results['bitwise']))
@@ -0,0 +1,189 @@
+'''Affine matrices matching the OSD CTM. Matrices are tuples with the
+(m11, m12, m21, m22, m31, m32) coefficients, the same ones taken by
+CTM_SET. Points are row vectors, so [x y 1] x M transforms a point and
+a x b applies a first and then b.'''
+
+import math
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+# Tolerance when comparing coefficients, well below float32 precision
+_EPSILON = 1e-6
+
+def multiply(a, b):
+    a11, a12, a21, a22, a31, a32 = a
+    b11, b12, b21, b22, b31, b32 = b
+    return (a11 * b11 + a12 * b21, a11 * b12 + a12 * b22,
+            a21 * b11 + a22 * b21, a21 * b12 + a22 * b22,
+            a31 * b11 + a32 * b21 + b31, a31 * b12 + a32 * b22 + b32)
+
+def invert(m):
+    m11, m12, m21, m22, m31, m32 = m
+    det = m11 * m22 - m12 * m21
+    if det == 0:
+        raise ValueError('matrix {} is not invertible'.format(m))
+    i11 = m22 / det
+    i12 = -m12 / det
+    i21 = -m21 / det
+    i22 = m11 / det
+    return (i11, i12, i21, i22, -(m31 * i11 + m32 * i21), -(m31 * i12 + m32 * i22))
+
+def apply(m, x, y):
+    m11, m12, m21, m22, m31, m32 = m
+    return (x * m11 + y * m21 + m31, x * m12 + y * m22 + m32)
+
+def translation(tx, ty):
+    return (1.0, 0.0, 0.0, 1.0, float(tx), float(ty))
+
+def scaling(sx, sy):
+    return (float(sx), 0.0, 0.0, float(sy), 0.0, 0.0)
+
+def rotation(r):
+    c = math.cos(r)
+    s = math.sin(r)
+    return (c, -s, s, c, 0.0, 0.0)
+
+def shearing(sx, sy):
+    return (1.0, float(sy), float(sx), 1.0, 0.0, 0.0)
+
+def about(m, cx, cy):
+    '''Returns m applied about (cx, cy) rather than the origin'''
+    return multiply(multiply(translation(-cx, -cy), m), translation(cx, cy))
+
+def equal(a, b):
+    return all(abs(x - y) <= _EPSILON for x, y in zip(a, b))
+
+def is_translation(m):
+    return equal(m[:4], IDENTITY[:4])
+
+def as_rotation_translation(m):
+    '''Returns (r, tx, ty) if m is a rotation by r followed by a
+    translation, None otherwise'''
+    r = math.atan2(-m[1], m[0])
+    if not equal(m[:4], rotation(r)[:4]):
+        return None
+    return r, m[4], m[5]
+
+# Matrix for each operation, named like the OSD ctm_* functions
+_OP_MATRICES = {
+    'translate': translation,
+    'scale': scaling,
+    'rotate': rotation,
+    'rotate_about': lambda r, cx, cy: about(rotation(r), cx, cy),
+    'shear': shearing,
+    'shear_about': lambda sx, sy, cx, cy: about(shearing(sx, sy), cx, cy),
+    'multiply': lambda *m: tuple(float(v) for v in m),
+}
+
+def op_matrix(op):
+    '''Returns the matrix for op and whether it's composed before the
+    CTM rather than after it. op is a tuple with the name of an OSD
+    ctm_* function without the prefix, e.g. 'rotate_rev', followed by
+    its arguments.'''
+    name = op[0]
+    rev = name.endswith('_rev')
+    if rev:
+        name = name[:-len('_rev')]
+    return _OP_MATRICES[name](*op[1:]), rev
+
+class CTMTracker(object):
+    '''Host side model of the OSD CTM, used to compose consecutive CTM
+    operations and send them when a drawing command needs them. It
+    keeps track of the CTM the OSD is using (device, None if unknown)
+    and the one the drawing functions have requested (logical). When
+    the logical CTM is unknown too (e.g. after running a VM function)
+    it's tracked as the operations pending on top of the device CTM.
+
+    Operations are tuples as taken by op_matrix(), plus ('reset',) and
+    ('set', m11, m12, m21, m22, m31, m32). The ones requested since the
+    OSD was last updated are kept in ops, so update() can send them
+    unchanged when that's cheaper than a single composed command.'''
+
+    def __init__(self):
+        self.forget()
+
+    def forget(self):
+        self.device = None
+        self.logical = None
+        self.pending = IDENTITY
+        self.ops = []
+        self._stack = []
+
+    def drawing_reset(self):
+        self.device = IDENTITY
+        self.logical = IDENTITY
+        self.pending = IDENTITY
+        self.ops = []
+        self._stack = []
+
+    def push(self):
+        self._stack.append((self.device, self.logical, self.pending, list(self.ops)))
+
+    def pop(self):
+        if self._stack:
+            self.device, self.logical, self.pending, self.ops = self._stack.pop()
+        else:
+            # Context pushed before tracking started
+            self.device = None
+            self.logical = None
+            self.pending = IDENTITY
+            self.ops = []
+
+    def reset(self):
+        self.logical = IDENTITY
+        self.ops.append(('reset',))
+
+    def set(self, m):
+        self.logical = tuple(m)
+        self.ops.append(('set',) + self.logical)
+
+    def compose(self, op):
+        '''Compose the operation op with the CTM. Returns False if it
+        can't be tracked, in which case the caller should update the
+        OSD and send it directly.'''
+        m, rev = op_matrix(op)
+        if self.logical is not None:
+            self.logical = multiply(m, self.logical) if rev else multiply(self.logical, m)
+        elif rev:
+            return False
+        else:
+            self.pending = multiply(self.pending, m)
+        self.ops.append(op)
+        return True
+
+    def update(self, size):
+        '''Returns the list of operations needed to bring the OSD CTM up
+        to date, empty if it already is. size(op) must return the bytes
+        needed to send op. The cheapest of the operations requested
+        since the last update, a rotation plus a translation, a single
+        CTM_MULTIPLY and a single CTM_SET is returned.'''
+        ops = self.ops
+        self.ops = []
+        candidates = [ops] if ops else []
+        if self.logical is None:
+            delta = self.pending
+            if equal(delta, IDENTITY):
+                return []
+            self.pending = IDENTITY
+        else:
+            device = self.device
+            logical = self.logical
+            if device is not None and equal(device, logical):
+                return []
+            self.device = logical
+            if equal(logical, IDENTITY):
+                return [('reset',)]
+            candidates.append([('set',) + logical])
+            delta = multiply(invert(device), logical) if device is not None else None
+        if delta is not None:
+            candidates.append([('multiply',) + delta])
+            rt = as_rotation_translation(delta)
+            if rt is not None:
+                r, tx, ty = rt
+                ops = []
+                if not is_translation(delta):
+                    ops.append(('rotate', r))
+                if abs(tx) > _EPSILON or abs(ty) > _EPSILON:
+                    ops.append(('translate', tx, ty))
+                candidates.append(ops)
+        return min(candidates, key=lambda ops: sum(size(op) for op in ops))
@@ -0,0 +1,325 @@
+import contextlib
+import struct
+
+from .frskyosd import CMD, COLOR, MAX_SEND_BUFFER_SIZE, OSD, _str_to_bytes
+
+class Slot(object):
+    '''A parameter of a DisplayList, patched in place on each replay'''
+
+    size = 0
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+
+    def patch(self, buf, offset, value):
+        raise NotImplementedError
+
+class PointSlot(Slot):
+    '''A point or size, given as (x, y). Unpacks to itself, so it
+    can be passed as move_to_point(*slot) or as p1 for triangles'''
+
+    size = 3
+
+    def __iter__(self):
+        return iter((self, self))
+
+    def __getitem__(self, idx):
+        if idx not in (0, 1):
+            raise IndexError(idx)
+        return self
+
+    def patch(self, buf, offset, value):
+        v = (int(value[1]) & 0xfff) << 12 | (int(value[0]) & 0xfff)
+        buf[offset] = v & 0xff
+        buf[offset + 1] = (v >> 8) & 0xff
+        buf[offset + 2] = v >> 16
+
+class ColorSlot(Slot):
+
+    size = 1
+
+    def patch(self, buf, offset, value):
+        if value < COLOR._MIN or value > COLOR._MAX:
+            raise RuntimeError("Invalid color %d" % value)
+        buf[offset] = value
+
+class I24Slot(Slot):
+    '''A signed 24 bit integer, as used by the sidebar and graph widgets'''
+
+    size = 3
+
+    def patch(self, buf, offset, value):
+        v = int(value) & 0xffffff
+        buf[offset] = v & 0xff
+        buf[offset + 1] = (v >> 8) & 0xff
+        buf[offset + 2] = v >> 16
+
+class StringSlot(Slot):
+    '''A null terminated string of up to capacity bytes. The string is
+    always sent padded to its capacity, so its position in the
+    template doesn't change.'''
+
+    def __init__(self, name, capacity, default=None):
+        super(StringSlot, self).__init__(name, default)
+        self.capacity = capacity
+        self.size = capacity + 1
+
+    def patch(self, buf, offset, value):
+        b = _str_to_bytes(value)
+        if len(b) > self.capacity:
+            raise ValueError('string {!r} is longer than {} bytes'.format(value, self.capacity))
+        buf[offset:offset + self.size] = b + bytearray(self.size - len(b))
+
+class _Payload(object):
+    # Payload containing slots, built by concatenating bytes and
+    # slots in the same way the OSD builds its payloads.
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def __add__(self, other):
+        return _Payload(self.pieces + _pieces(other))
+
+    def __radd__(self, other):
+        return _Payload(_pieces(other) + self.pieces)
+
+def _pieces(p):
+    if isinstance(p, _Payload):
+        return p.pieces
+    return [bytes(p)] if p else []
+
+class _Recorder(OSD):
+    # Records the commands generated by the OSD drawing functions
+    # instead of sending them.
+
+    def __init__(self, info):
+        OSD.__init__(self, None)
+        self.info = info
+        self.commands = []
+        self.state_fields = set()
+        self.resets_state = False
+        self._depth = 0
+
+    def send_frame(self, cmd, payload=None):
+        self.commands.append((cmd, _pieces(payload) if payload else []))
+
+    def flush_send_buffer(self):
+        pass
+
+    def _send_state_frame(self, cmd, payload, *fields):
+        self.state_fields.update(fields)
+        return self.send_frame(cmd, payload)
+
+    def _send_ctm_frame(self, cmd, payload):
+        return self._send_state_frame(cmd, payload, 'ctm')
+
+    def context_push(self):
+        self._depth += 1
+        self.send_frame(CMD.CONTEXT_PUSH)
+
+    def context_pop(self):
+        self._depth -= 1
+        if self._depth < 0:
+            # Pops a context pushed outside the display list
+            self.resets_state = True
+        self.send_frame(CMD.CONTEXT_POP)
+
+    def drawing_reset(self):
+        self.resets_state = True
+        return self.send_frame(CMD.DRAWING_RESET)
+
+    def _forget_drawing_state(self):
+        self.resets_state = True
+
+    # The OSD packs these directly into its frame buffer, record them
+    # with the _pack_* functions so they can contain slots
+
+    def _send_point(self, cmd, x, y, color=None):
+        payload = self._pack_point(x, y)
+        if color is not None:
+            payload = payload + self._pack_color(color)
+        return self.send_frame(cmd, payload)
+
+    def _send_rect(self, cmd, r):
+        return self.send_frame(cmd, self._pack_rect(r))
+
+    def _send_triangle(self, cmd, p1, p2, p3):
+        payload = self._pack_point(p1[0], p1[1]) + self._pack_point(p2[0], p2[1]) + self._pack_point(p3[0], p3[1])
+        return self.send_frame(cmd, payload)
+
+    def _send_chr(self, cmd, x, y, ch, opts, color=None):
+        if isinstance(ch, str):
+            ch = ord(ch[0])
+        payload = self._pack_point(x, y) + struct.pack('<HB', int(ch), opts or 0)
+        if color is not None:
+            payload = payload + self._pack_color(color)
+        return self.send_frame(cmd, payload)
+
+    def _send_str(self, cmd, x, y, s, opts, color=None):
+        return self._send_str_slow(cmd, x, y, s, opts, color)
+
+    def _send_block(self, cmd, data, stride):
+        data = bytearray(data)
+        for ii in range(0, len(data), stride):
+            self.send_frame(data[ii], bytes(data[ii + 1:ii + stride]))
+
+    def draw_grid_str(self, gx, gy, s, opts=None):
+        if isinstance(s, StringSlot):
+            # DRAW_GRID_STR_2 encodes the length in its header, use the
+            # null terminated encoding so the slot can be patched
+            payload = struct.pack('<BBB', gx, gy, opts or 0) + self._pack_str(s)
+            return self.send_frame(CMD.DRAW_GRID_STR, payload)
+        return OSD.draw_grid_str(self, gx, gy, s, opts)
+
+    def draw_grid_strs(self, items):
+        for item in items:
+            self.draw_grid_str(*item)
+
+    def _pack_color(self, color):
+        if isinstance(color, ColorSlot):
+            return _Payload([color])
+        return OSD._pack_color(self, color)
+
+    def _pack_point(self, x, y):
+        if isinstance(x, PointSlot) or isinstance(y, PointSlot):
+            if x is not y:
+                raise ValueError('both coordinates must come from the same point slot')
+            return _Payload([x])
+        return OSD._pack_point(self, x, y)
+
+    def _pack_i24(self, val):
+        if isinstance(val, I24Slot):
+            return _Payload([val])
+        return OSD._pack_i24(self, val)
+
+    def _pack_str(self, s, null_terminated=True):
+        if isinstance(s, StringSlot):
+            if not null_terminated:
+                raise ValueError('string slots must be null terminated')
+            return self._pack_uvarint(s.size) + _Payload([s])
+        return OSD._pack_str(self, s, null_terminated)
+
+class DisplayList(object):
+    '''A sequence of drawing commands recorded once and replayed
+    many times. Values that change between replays are declared as
+    slots and passed to the drawing functions while recording:
+
+        dl = DisplayList(osd)
+        corner = dl.point('corner')
+        with dl.record() as r:
+            r.set_stroke_color(dl.color('color', COLOR.WHITE))
+            r.move_to_point(*corner)
+            r.stroke_line_to_point(100, 100)
+        ...
+        dl.replay(corner=(10, 20))
+
+    Recording produces a byte template with the encoded commands.
+    Replaying patches the slots in place and appends the template to
+    the send buffer, without packing each command again.'''
+
+    def __init__(self, osd):
+        self.osd = osd
+        self._slots = {}
+        self._template = None
+        self._patches = {}
+        self._chunks = []
+        self._state_fields = ()
+        self._resets_state = False
+
+    def _add_slot(self, slot):
+        if slot.name in self._slots:
+            raise ValueError('duplicate slot {!r}'.format(slot.name))
+        self._slots[slot.name] = slot
+        return slot
+
+    def point(self, name, default=None):
+        return self._add_slot(PointSlot(name, default))
+
+    def color(self, name, default=None):
+        return self._add_slot(ColorSlot(name, default))
+
+    def i24(self, name, default=None):
+        return self._add_slot(I24Slot(name, default))
+
+    def string(self, name, capacity, default=None):
+        return self._add_slot(StringSlot(name, capacity, default))
+
+    @contextlib.contextmanager
+    def record(self):
+        '''Returns a context manager yielding an OSD that records the
+        commands instead of sending them. The display list is compiled
+        when the block exits, replacing any previous recording.'''
+        rec = _Recorder(self.osd.info)
+        yield rec
+        self._compile(rec)
+
+    def _compile(self, rec):
+        template = bytearray()
+        patches = {}
+        bounds = []
+        start = 0
+        for cmd, pieces in rec.commands:
+            size = 1 + sum(p.size if isinstance(p, Slot) else len(p) for p in pieces)
+            # Split the template into chunks that fit in a frame,
+            # without splitting any command
+            if len(template) - start + size > MAX_SEND_BUFFER_SIZE:
+                bounds.append((start, len(template)))
+                start = len(template)
+            template.append(cmd)
+            for p in pieces:
+                if isinstance(p, Slot):
+                    patches.setdefault(p.name, []).append((p, len(template)))
+                    template.extend(bytearray(p.size))
+                else:
+                    template.extend(p)
+        if len(template) > start:
+            bounds.append((start, len(template)))
+        self._template = template
+        self._patches = patches
+        view = memoryview(template)
+        self._chunks = [view[a:b] for a, b in bounds]
+        self._state_fields = tuple(rec.state_fields)
+        self._resets_state = rec.resets_state
+        defaults = dict((name, slot.default) for name, slot in self._slots.items() if slot.default is not None)
+        self.update(**defaults)
+
+    def __len__(self):
+        return len(self._template) if self._template is not None else 0
+
+    def update(self, **values):
+        '''Patch the given slots without sending anything'''
+        template = self._template
+        for name, value in values.items():
+            if name not in self._slots:
+                raise ValueError('unknown slot {!r}'.format(name))
+            for slot, offset in self._patches.get(name, ()):
+                slot.patch(template, offset, value)
+
+    def send(self):
+        '''Append the commands to the OSD send buffer'''
+        if self._template is None:
+            raise RuntimeError('display list has not been recorded')
+        osd = self.osd
+        if osd.debug:
+            print('DISPLAY LIST =>> {} bytes'.format(len(self._template)))
+        tracker = osd.ctm_tracker
+        if tracker is not None:
+            # The commands in the list use the CTM requested so far
+            osd._flush_ctm()
+            if self._resets_state or 'ctm' in self._state_fields:
+                tracker.forget()
+        state = osd.drawing_state
+        if state is not None:
+            if self._resets_state:
+                state.forget()
+            else:
+                for field in self._state_fields:
+                    state.set((field,), None)
+        for chunk in self._chunks:
+            osd.send_commands(chunk)
+
+    def replay(self, **values):
+        '''Patch the given slots and send the commands'''
+        self.update(**values)
+        self.send()
@@ -1,5 +1,7 @@
 import binascii
 import collections
+import hashlib
+import math
 import os
 import socket
 import struct
@@ -8,8 +10,27 @@ import time
 
 import serial
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from .crc import crc8_dvb_s2
+    from . import ctm
+except (ImportError, ValueError):
+    # Invoked directly as a script
+    from crc import crc8_dvb_s2
+    import ctm
+
 BAUDRATE = 115200
 
+# Candidate data rates for auto_tune_data_rate()
+DATA_RATES = (115200, 230400, 460800, 921600, 1000000, 1500000, 2000000)
+# A higher data rate is only used when it improves the throughput by
+# at least this factor, preferring the more robust lower rate otherwise
+_DATA_RATE_MIN_GAIN = 1.05
+
 CHAR_WIDTH = 12
 CHAR_HEIGHT = 18
 
@@ -74,7 +95,17 @@ class CMD:
     CTM_SHEAR = 86
     CTM_SHEAR_ABOUT = 87
     CTM_MULTIPLY = 88
-    CTM_TRANSLATE_REV = 89
+    CTM_TRANSLATE_REV = 89              # API2
+    CTM_SCALE_REV = 90                  # API2
+    CTM_ROTATE_REV = 91                 # API2
+    CTM_ROTATE_ABOUT_REV = 92           # API2
+    CTM_SHEAR_REV = 93                  # API2
+    CTM_SHEAR_ABOUT_REV = 94            # API2
+    CTM_MULTIPLY_REV = 95               # API2
+    CTM_I16TRANSLATE = 96               # API2
+    CTM_U16ROTATE = 97                  # API2
+    CTM_I16TRANSLATE_REV = 98           # API2
+    CTM_U16_ROTATE_REV = 99             # API2
 
     CONTEXT_PUSH = 100
     CONTEXT_POP = 101
@@ -143,8 +174,103 @@ class WIDGETS:
 FLASH_WRITE_MAX_BLOCK_SIZE = 64
 FLASH_WRITE_END = (2 << 31) - 1
 
+FONT_CHAR_SIZE = 64
+
 MAX_SEND_BUFFER_SIZE = 254
 
+# Largest payload in a frame sent by the OSD, a READ_FONT response
+# with the command, the character address and its data
+MAX_RESPONSE_SIZE = 1 + 2 + FONT_CHAR_SIZE
+
+# Maximum error in pixels allowed when sending CTM translations and
+# rotations with the compact int16/uint16 encodings. Rotation errors
+# are measured at the farthest corner of the screen, assuming no
+# scaling. Use ctm_tolerance=None to always send float32 values.
+CTM_TOLERANCE = 0.05
+_U16_ROTATION_STEPS = 1 << 16
+
+# CTM operations, named like the OSD ctm_* functions, with their
+# command, the compact command used within ctm_tolerance and the
+# payload format
+_CTM_OPS = {
+    'reset': (CMD.CTM_RESET, None, ''),
+    'set': (CMD.CTM_SET, None, '<ffffff'),
+    'translate': (CMD.CTM_TRANSLATE, CMD.CTM_I16TRANSLATE, '<ff'),
+    'translate_rev': (CMD.CTM_TRANSLATE_REV, CMD.CTM_I16TRANSLATE_REV, '<ff'),
+    'scale': (CMD.CTM_SCALE, None, '<ff'),
+    'scale_rev': (CMD.CTM_SCALE_REV, None, '<ff'),
+    'rotate': (CMD.CTM_ROTATE, CMD.CTM_U16ROTATE, '<f'),
+    'rotate_rev': (CMD.CTM_ROTATE_REV, CMD.CTM_U16_ROTATE_REV, '<f'),
+    'rotate_about': (CMD.CTM_ROTATE_ABOUT, None, '<fff'),
+    'rotate_about_rev': (CMD.CTM_ROTATE_ABOUT_REV, None, '<fff'),
+    'shear': (CMD.CTM_SHEAR, None, '<ff'),
+    'shear_rev': (CMD.CTM_SHEAR_REV, None, '<ff'),
+    'shear_about': (CMD.CTM_SHEAR_ABOUT, None, '<ffff'),
+    'shear_about_rev': (CMD.CTM_SHEAR_ABOUT_REV, None, '<ffff'),
+    'multiply': (CMD.CTM_MULTIPLY, None, '<ffffff'),
+    'multiply_rev': (CMD.CTM_MULTIPLY_REV, None, '<ffffff'),
+}
+
+# Commands affected by the CTM. When composing CTM operations in the
+# host, the CTM is sent before any of these.
+_CTM_DEPENDENT_CMDS = frozenset([
+    CMD.SET_PIXEL,
+    CMD.SET_PIXEL_TO_STROKE_COLOR,
+    CMD.SET_PIXEL_TO_FILL_COLOR,
+    CMD.WIDGET_DRAW,
+] + list(range(CMD.DRAW_BITMAP, CMD.FILL_STROKE_ELLIPSE_IN_RECT + 1)))
+
+# Frames are assembled in place in a preallocated buffer, with room
+# for the '$A' header and a length of up to 2 bytes before the commands
+# and the CRC after them
+_FRAME_HEADER_SIZE = 4
+_FRAME_BUFFER_SIZE = _FRAME_HEADER_SIZE + MAX_SEND_BUFFER_SIZE + 1
+
+# Points are packed as 24 bits, written as an uint16 and an uint8
+_U24 = struct.Struct('<HB')
+_CHR_OPTS = struct.Struct('<HB')
+_CHR_OPTS_COLOR = struct.Struct('<HBB')
+
+def _check_color(color):
+    if color < COLOR._MIN or color > COLOR._MAX:
+        raise RuntimeError("Invalid color %d" % color)
+
+def _pack_point_into(buf, offset, x, y):
+    _U24.pack_into(buf, offset, (int(y) & 0xf) << 12 | (int(x) & 0xfff), (int(y) >> 4) & 0xff)
+
+_U16 = struct.Struct('<H')
+
+def _pack_points_block(cmd, items, npoints, trailer=b''):
+    # Returns the encoded commands for each item in items, which contain
+    # npoints (x, y) pairs flattened, e.g. (x, y, w, h) for rects. Each
+    # command is cmd, the packed points and the trailer bytes.
+    trailer = bytearray(trailer)
+    n = len(items)
+    if numpy is not None and isinstance(items, numpy.ndarray):
+        coords = items.reshape(n, npoints, 2).astype(numpy.int64)
+        v = ((coords[:, :, 1] & 0xfff) << 12) | (coords[:, :, 0] & 0xfff)
+        out = numpy.empty((n, 1 + 3 * npoints + len(trailer)), numpy.uint8)
+        out[:, 0] = cmd
+        for k in range(npoints):
+            out[:, 1 + 3 * k] = v[:, k] & 0xff
+            out[:, 2 + 3 * k] = (v[:, k] >> 8) & 0xff
+            out[:, 3 + 3 * k] = v[:, k] >> 16
+        for k, b in enumerate(trailer):
+            out[:, 1 + 3 * npoints + k] = b
+        return out.tobytes()
+    values = []
+    append = values.append
+    for item in items:
+        append(cmd)
+        for k in range(0, npoints * 2, 2):
+            x = int(item[k])
+            y = int(item[k + 1])
+            append((y & 0xf) << 12 | (x & 0xfff))
+            append((y >> 4) & 0xff)
+        values.extend(trailer)
+    fmt = 'B' + 'HB' * npoints + 'B' * len(trailer)
+    return struct.pack('<' + fmt * n, *values)
+
 def _int_as_bytes(i):
     return struct.pack('B', i)
 
@@ -166,9 +292,13 @@ def _bytes_have_prefix(b, prefix):
     return True
 
 def _str_to_bytes(s):
+    if isinstance(s, bytearray):
+        return bytes(s)
     if bytes is str:
         # Python 2
         return s
+    if isinstance(s, bytes):
+        return s
     # Python 3
     return bytes(s, 'ascii')
 
@@ -184,6 +314,29 @@ def _format_payload(p):
         return ''.join(['{:02x}'.format(v) for v in values])
     return str(p)
 
+def parse_mcm(f):
+    '''Parse a MAX7456 font in MCM format, returning a bytearray with
+    FONT_CHAR_SIZE bytes per character'''
+    header = f.readline().strip()
+    if header != b'MAX7456':
+        raise RuntimeError("Invalid MAX7456 header")
+    bits = f.read().translate(None, b' \t\r\n')
+    if bits.translate(None, b'01'):
+        raise RuntimeError("Invalid MAX7456 data")
+    # Ignore any trailing incomplete character
+    nbits = len(bits) - len(bits) % (FONT_CHAR_SIZE * 8)
+    if nbits == 0:
+        return bytearray()
+    # Convert all the bits at once, going through hex so this works
+    # with both Python 2 and 3
+    value = int(bits[:nbits], 2)
+    return bytearray(binascii.unhexlify('{:0{}x}'.format(value, nbits // 4)))
+
+def font_fingerprint(data):
+    '''Return a list with the hash of each character in data'''
+    return [hashlib.sha1(bytes(data[ii:ii + FONT_CHAR_SIZE])).hexdigest()
+            for ii in range(0, len(data), FONT_CHAR_SIZE)]
+
 class Unit(object):
     def __init__(self, scale, symbol, divisor, divided_symbol):
         self.scale = scale
@@ -257,12 +410,299 @@ class ResponseWriteFlash(Response):
     def _payload_str(self):
         return '{:#08x}'.format(self.addr)
 
+class ResponseFont(Response):
+    def __init__(self, cmd, payload):
+        super(ResponseFont, self).__init__(cmd, payload)
+        self.addr = struct.unpack('<H', payload[:2])[0]
+        self.data = payload[2:]
+
+    def _payload_str(self):
+        return 'chr {}, {}'.format(self.addr, _format_payload(self.data))
+
 _response_cls = {
     CMD.ERROR: ResponseError,
     CMD.INFO: ResponseInfo,
+    CMD.READ_FONT: ResponseFont,
+    CMD.WRITE_FONT: ResponseFont,
     CMD.WRITE_FLASH: ResponseWriteFlash,
 }
 
+def _decode_uvarint(data, pos):
+    # Returns the value and the position after it
+    val = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        val |= (b & 0x7f) << shift
+        if b < 0x80:
+            return val, pos
+        shift += 7
+
+def _blob_size(header):
+    # Commands with header bytes followed by an uvarint sized blob
+    def size(data, pos):
+        n, end = _decode_uvarint(data, pos + header)
+        return end - pos + n
+    return size
+
+def _grid_str_2_size(data, pos):
+    n = (data[pos] | data[pos + 1] << 8) >> 12
+    if n:
+        return 2 + n
+    return _blob_size(2)(data, pos)
+
+def _vm_exec_size(data, pos):
+    sym, p = _decode_uvarint(data, pos)
+    nargs, p = _decode_uvarint(data, p)
+    return p - pos + 4 * nargs
+
+# Payload size of the commands that can share a frame with others,
+# either as a number of bytes or a function returning it
+_CMD_PAYLOAD_SIZES = {
+    CMD.TRANSACTION_BEGIN: 0,
+    CMD.TRANSACTION_COMMIT: 0,
+    CMD.TRANSACTION_BEGIN_PROFILED: 3,
+    CMD.SET_STROKE_COLOR: 1,
+    CMD.SET_FILL_COLOR: 1,
+    CMD.SET_STROKE_AND_FILL_COLOR: 1,
+    CMD.SET_COLOR_INVERSION: 1,
+    CMD.SET_PIXEL: 4,
+    CMD.SET_PIXEL_TO_STROKE_COLOR: 3,
+    CMD.SET_PIXEL_TO_FILL_COLOR: 3,
+    CMD.SET_STROKE_WIDTH: 1,
+    CMD.SET_LINE_OUTLINE_TYPE: 1,
+    CMD.SET_LINE_OUTLINE_COLOR: 1,
+    CMD.CLIP_TO_RECT: 6,
+    CMD.CLEAR_SCREEN: 0,
+    CMD.CLEAR_RECT: 6,
+    CMD.DRAWING_RESET: 0,
+    CMD.DRAW_BITMAP: _blob_size(7),
+    CMD.DRAW_BITMAP_MASK: _blob_size(8),
+    CMD.DRAW_CHAR: 6,
+    CMD.DRAW_CHAR_MASK: 7,
+    CMD.DRAW_STRING: _blob_size(4),
+    CMD.DRAW_STRING_MASK: _blob_size(5),
+    CMD.MOVE_TO_POINT: 3,
+    CMD.STROKE_LINE_TO_POINT: 3,
+    CMD.STROKE_TRIANGLE: 9,
+    CMD.FILL_TRIANGLE: 9,
+    CMD.FILL_STROKE_TRIANGLE: 9,
+    CMD.STROKE_RECT: 6,
+    CMD.FILL_RECT: 6,
+    CMD.FILL_STROKE_RECT: 6,
+    CMD.STROKE_ELLIPSE_IN_RECT: 6,
+    CMD.FILL_ELLIPSE_IN_RECT: 6,
+    CMD.FILL_STROKE_ELLIPSE_IN_RECT: 6,
+    CMD.CTM_RESET: 0,
+    CMD.CTM_SET: 24,
+    CMD.CTM_TRANSLATE: 8,
+    CMD.CTM_SCALE: 8,
+    CMD.CTM_ROTATE: 4,
+    CMD.CTM_ROTATE_ABOUT: 12,
+    CMD.CTM_SHEAR: 8,
+    CMD.CTM_SHEAR_ABOUT: 16,
+    CMD.CTM_MULTIPLY: 24,
+    CMD.CTM_TRANSLATE_REV: 8,
+    CMD.CTM_SCALE_REV: 8,
+    CMD.CTM_ROTATE_REV: 4,
+    CMD.CTM_ROTATE_ABOUT_REV: 12,
+    CMD.CTM_SHEAR_REV: 8,
+    CMD.CTM_SHEAR_ABOUT_REV: 16,
+    CMD.CTM_MULTIPLY_REV: 24,
+    CMD.CTM_I16TRANSLATE: 4,
+    CMD.CTM_U16ROTATE: 2,
+    CMD.CTM_I16TRANSLATE_REV: 4,
+    CMD.CTM_U16_ROTATE_REV: 2,
+    CMD.CONTEXT_PUSH: 0,
+    CMD.CONTEXT_POP: 0,
+    CMD.DRAW_GRID_CHR: 5,
+    CMD.DRAW_GRID_STR: _blob_size(3),
+    CMD.DRAW_GRID_CHR_2: 3,
+    CMD.DRAW_GRID_STR_2: _grid_str_2_size,
+    CMD.WIDGET_DRAW: 4,
+    CMD.WIDGET_ERASE: 1,
+    CMD.REBOOT: 1,
+    CMD.SET_DATA_RATE: 4,
+    CMD.VM_EXEC: _vm_exec_size,
+}
+
+def iter_commands(data):
+    '''Split the payload of a frame into its commands, yielding
+    (cmd, payload) tuples. Commands with an unknown size take the
+    rest of the frame.'''
+    data = bytearray(data)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        cmd = data[pos]
+        pos += 1
+        size = _CMD_PAYLOAD_SIZES.get(cmd)
+        if size is None:
+            size = end - pos
+        elif not isinstance(size, int):
+            try:
+                size = size(data, pos)
+            except IndexError:
+                size = end - pos
+        yield cmd, data[pos:pos + size]
+        pos += size
+
+class FrameDecoder(object):
+    """Incremental decoder for $A framed data. It doesn't perform any
+    I/O, data must be provided via feed() as it's received. When noise
+    or a corrupted frame is found, it resynchronizes by scanning for
+    the next header.
+
+    Frames longer than max_payload_size are rejected as soon as their
+    length is read, so a corrupted length doesn't hold the frames
+    after it. Use MAX_RESPONSE_SIZE when decoding data sent by the
+    OSD."""
+
+    HEADER = b'$A'
+    MAX_PAYLOAD_SIZE = MAX_SEND_BUFFER_SIZE
+
+    def __init__(self, max_payload_size=MAX_PAYLOAD_SIZE):
+        self.max_payload_size = max_payload_size
+        self._buf = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.length_errors = 0
+        self.skipped_bytes = 0
+
+    @property
+    def errors(self):
+        return self.crc_errors + self.length_errors
+
+    def feed(self, data):
+        """Feed data, returning a list with the Response objects for
+        all the frames completed by it"""
+        return [Response.decode(p[0], p[1:]) for p in self.feed_payloads(data) if len(p) > 0]
+
+    def feed_payloads(self, data):
+        """Like feed(), but returns the raw payloads of each frame"""
+        buf = self._buf
+        buf.extend(data)
+        payloads = []
+        pos = 0
+        while True:
+            idx = buf.find(self.HEADER, pos)
+            if idx < 0:
+                # Keep a trailing '$', it might be the start of a header
+                end = len(buf)
+                if end > pos and buf[end - 1] == self.HEADER[0]:
+                    end -= 1
+                self.skipped_bytes += end - pos
+                pos = end
+                break
+            self.skipped_bytes += idx - pos
+            pos = idx
+            # uvarint length
+            p = idx + len(self.HEADER)
+            size = 0
+            shift = 0
+            complete = False
+            while p < len(buf) and shift <= 28:
+                b = buf[p]
+                p += 1
+                size |= (b & 0x7f) << shift
+                if b < 0x80:
+                    complete = True
+                    break
+                shift += 7
+            if not complete and shift <= 28:
+                # Need more data
+                break
+            if not complete or size > self.max_payload_size:
+                self.length_errors += 1
+                self.skipped_bytes += 1
+                pos = idx + 1
+                continue
+            end = p + size
+            if end >= len(buf):
+                # Need more data
+                break
+            crc = crc8_dvb_s2(memoryview(buf)[idx + len(self.HEADER):end])
+            if crc != buf[end]:
+                # The length might be wrong too, so the next frame can
+                # start anywhere after this header. Look for it in the
+                # bytes already buffered rather than skipping the frame.
+                self.crc_errors += 1
+                self.skipped_bytes += 1
+                pos = idx + 1
+                continue
+            payloads.append(bytearray(buf[p:end]))
+            self.frames += 1
+            pos = end + 1
+        del buf[:pos]
+        return payloads
+
+    def pending(self):
+        """Number of bytes held while waiting for a frame to complete"""
+        return len(self._buf)
+
+    def abort(self):
+        """Give up on the frame waiting for more data, e.g. when the
+        rest of it doesn't arrive in time because its length was
+        corrupted. Returns the Response objects for the frames found in
+        the bytes after its header."""
+        if not self._buf:
+            return []
+        if self._buf.startswith(self.HEADER):
+            self.length_errors += 1
+        self.skipped_bytes += 1
+        del self._buf[:1]
+        return self.feed(b'')
+
+    def reset(self):
+        del self._buf[:]
+
+class _Pipeline(object):
+    """Bookkeeping for requests sent with a window of outstanding
+    responses, without performing any I/O. On a mismatched response,
+    the requests sent after the failed one are discarded and sent
+    again (go-back-N)."""
+
+    def __init__(self, cmd, payloads, window, check, on_ack=None, retries=3):
+        self.cmd = cmd
+        self.payloads = payloads
+        self.window = max(1, window)
+        self.check = check
+        self.on_ack = on_ack
+        self.retries = retries
+        self.responses = [None] * len(payloads)
+        self.acked = 0
+        self.sent = 0
+        self.failures = 0
+
+    def done(self):
+        return self.acked >= len(self.payloads)
+
+    def next_requests(self):
+        """Returns the payloads that can be sent now"""
+        end = min(len(self.payloads), self.acked + self.window)
+        requests = self.payloads[self.sent:end]
+        self.sent = max(self.sent, end)
+        return requests
+
+    def handle(self, resp):
+        """Process the response to the oldest outstanding request.
+        Returns the number of responses that must be received and
+        discarded before sending again."""
+        if self.check(self.acked, resp):
+            self.responses[self.acked] = resp
+            if self.on_ack:
+                self.on_ack(self.acked, resp)
+            self.acked += 1
+            self.failures = 0
+            return 0
+        self.failures += 1
+        if self.failures > self.retries:
+            raise RuntimeError('invalid response to command {} after {} retries: {}'.format(self.cmd, self.retries, resp))
+        discard = self.sent - self.acked - 1
+        self.sent = self.acked
+        return discard
+
 class RemoteResponseError(Exception):
     """Raised when the OSD returns an error over the protocol"""
     def __init__(self, resp, message=None):
@@ -271,15 +711,264 @@ class RemoteResponseError(Exception):
         self.resp = resp
         self.message = message
 
-class SerialConn:
-    def __init__(self, port, baudrate):
-        self._conn = serial.Serial(port, baudrate)
+class DrawingState(object):
+    """Host side mirror of the OSD drawing context stack. Each context
+    maps the state fields to the payload of the command that last set
+    them. Fields not present are unknown."""
+
+    def __init__(self):
+        self.forget()
+
+    def forget(self):
+        """Mark everything as unknown, e.g. after reconnecting"""
+        self._stack = [{}]
+
+    def drawing_reset(self):
+        self._stack = [{
+            'color_inversion': b'\x00',
+            'ctm': b'',
+        }]
+
+    def push(self):
+        self._stack.append(dict(self._stack[-1]))
+
+    def pop(self):
+        if len(self._stack) > 1:
+            self._stack.pop()
+        else:
+            # Context pushed before tracking started
+            self._stack = [{}]
+
+    def matches(self, fields, value):
+        ctx = self._stack[-1]
+        return all(ctx.get(f) == value for f in fields)
+
+    def set(self, fields, value):
+        ctx = self._stack[-1]
+        for f in fields:
+            if value is None:
+                ctx.pop(f, None)
+            else:
+                ctx[f] = value
+
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    _timer = time.time
+
+def _cmd_names():
+    return dict((v, k) for k, v in vars(CMD).items() if not k.startswith('_') and isinstance(v, int))
+
+class TransactionStats(object):
+    """Counters for the frames sent during a transaction:
+
+        commands: number of commands by opcode
+        command_bytes: bytes used by the commands with each opcode,
+            counting the opcode itself
+        payload_bytes: bytes of commands, without the framing
+        wire_bytes: bytes written, including the frame headers and CRCs
+        frames: frames sent. More than one means the transaction was
+            flushed before its commit, since it didn't fit in a frame.
+        encode_time: seconds between the begin and the commit not spent
+            writing, i.e. building the transaction in the host
+        write_time: seconds spent writing frames"""
+
+    def __init__(self, skip=0):
+        self.commands = collections.Counter()
+        self.command_bytes = collections.Counter()
+        self.payload_bytes = 0
+        self.wire_bytes = 0
+        self.frames = 0
+        self.encode_time = 0.0
+        self.write_time = 0.0
+        # Bytes of commands queued before the transaction began
+        self._skip = skip
+
+    @property
+    def flushes(self):
+        """Frames flushed before the commit"""
+        return max(0, self.frames - 1)
+
+    def add_frame(self, frame, write_time):
+        data = bytearray(frame)
+        size, pos = _decode_uvarint(data, 2)
+        skip, self._skip = self._skip, 0
+        if skip >= size:
+            # Flushed the commands queued before the transaction
+            return
+        payload = data[pos + skip:pos + size]
+        for cmd, p in iter_commands(payload):
+            self.commands[cmd] += 1
+            self.command_bytes[cmd] += 1 + len(p)
+        self.payload_bytes += len(payload)
+        self.wire_bytes += len(data) - skip
+        self.frames += 1
+        self.write_time += write_time
+
+    def as_dict(self):
+        names = _cmd_names()
+        return {
+            'commands': dict((names.get(c, c), n) for c, n in self.commands.items()),
+            'command_bytes': dict((names.get(c, c), n) for c, n in self.command_bytes.items()),
+            'payload_bytes': self.payload_bytes,
+            'wire_bytes': self.wire_bytes,
+            'frames': self.frames,
+            'flushes': self.flushes,
+            'encode_time': self.encode_time,
+            'write_time': self.write_time,
+        }
+
+class WireStats(object):
+    """Collects TransactionStats for each transaction sent by an OSD,
+    enabled with OSD(..., wire_stats=True). The last window
+    transactions are kept in history and summarized by summary().
+    Functions added with add_callback() are called with each
+    TransactionStats when its transaction is committed:
+
+        osd = OSD(port, wire_stats=True)
+        osd.wire_stats.add_callback(lambda t: print(t.as_dict()))
+
+    Frames sent outside of transactions are not counted."""
+
+    def __init__(self, window=100):
+        self.history = collections.deque(maxlen=window)
+        self.transactions = 0
+        self.current = None
+        self._callbacks = []
+        self._started = None
+
+    def add_callback(self, fn):
+        self._callbacks.append(fn)
+
+    def remove_callback(self, fn):
+        self._callbacks.remove(fn)
+
+    def begin(self, pending=0):
+        """Start a transaction. pending is the number of bytes already
+        in the send buffer, which don't belong to it."""
+        self.current = TransactionStats(pending)
+        self._started = _timer()
+
+    def frame(self, frame, write_time):
+        if self.current is not None:
+            self.current.add_frame(frame, write_time)
+
+    def commit(self):
+        t = self.current
+        if t is None:
+            return None
+        t.encode_time = max(0.0, _timer() - self._started - t.write_time)
+        self.current = None
+        self.history.append(t)
+        self.transactions += 1
+        for fn in self._callbacks:
+            fn(t)
+        return t
+
+    def summary(self):
+        """Returns a dict summarizing the transactions in history, with
+        the totals by command and the avg and max of each counter"""
+        commands = collections.Counter()
+        command_bytes = collections.Counter()
+        for t in self.history:
+            commands.update(t.commands)
+            command_bytes.update(t.command_bytes)
+        names = _cmd_names()
+        count = len(self.history)
+        summary = {
+            'transactions': count,
+            'commands': dict((names.get(c, c), n) for c, n in commands.items()),
+            'command_bytes': dict((names.get(c, c), n) for c, n in command_bytes.items()),
+        }
+        for field in ('payload_bytes', 'wire_bytes', 'frames', 'flushes', 'encode_time', 'write_time'):
+            values = [getattr(t, field) for t in self.history]
+            summary[field] = {
+                'avg': float(sum(values)) / count if count else None,
+                'max': max(values) if count else None,
+            }
+        return summary
+
+class BufferedConn(object):
+    """Base class for connections. Received data is accumulated in
+    a buffer so each call to the underlying transport retrieves as
+    many bytes as are available, rather than just one."""
+
+    def __init__(self):
+        self._recv_buf = bytearray()
+        self._recv_pos = 0
+
+    def _read_available(self):
+        """Must block until at least one byte can be returned"""
+        raise NotImplementedError
+
+    def _fill(self):
+        data = self._read_available()
+        if not data:
+            raise IOError('connection closed')
+        if self._recv_pos > 0:
+            # Reclaim the already consumed space before growing
+            del self._recv_buf[:self._recv_pos]
+            self._recv_pos = 0
+        self._recv_buf.extend(data)
+
+    def buffered(self):
+        return len(self._recv_buf) - self._recv_pos
+
+    def read(self, size=1):
+        """Read exactly size bytes"""
+        while self.buffered() < size:
+            self._fill()
+        start = self._recv_pos
+        self._recv_pos += size
+        data = bytes(self._recv_buf[start:self._recv_pos])
+        if self._recv_pos == len(self._recv_buf):
+            del self._recv_buf[:]
+            self._recv_pos = 0
+        return data
+
+    def read_available(self):
+        """Read all the buffered data or, if there's none, whatever
+        the transport returns in a single call"""
+        if self.buffered() == 0:
+            self._fill()
+        data = bytes(self._recv_buf[self._recv_pos:])
+        del self._recv_buf[:]
+        self._recv_pos = 0
+        return data
+
+    def skip_until(self, marker, limit):
+        """Discard data until the given byte is found, consuming it.
+        Returns the number of bytes skipped (not counting the marker)
+        or -1 if the marker was not found within limit bytes."""
+        skipped = 0
+        while True:
+            if self.buffered() == 0:
+                self._fill()
+            end = self._recv_pos + limit - skipped
+            idx = self._recv_buf.find(marker, self._recv_pos, end)
+            if idx >= 0:
+                skipped += idx - self._recv_pos
+                self._recv_pos = idx + 1
+                return skipped
+            available = min(len(self._recv_buf), end) - self._recv_pos
+            skipped += available
+            self._recv_pos += available
+            if skipped >= limit:
+                return -1
+
+class SerialConn(BufferedConn):
+    def __init__(self, port, baudrate, timeout=None):
+        super(SerialConn, self).__init__()
+        self._conn = serial.Serial(port, baudrate, timeout=timeout)
 
     def write(self, b):
         return self._conn.write(b)
 
-    def read(self):
-        return self._conn.read()
+    def _read_available(self):
+        data = self._conn.read(self._conn.in_waiting or 1)
+        if not data:
+            raise IOError('timed out waiting for data')
+        return data
 
     def close(self):
         return self._conn.close()
@@ -294,17 +983,22 @@ class SerialConn:
             return True
         return False
 
-class TCPConn:
-    def __init__(self, loc):
+class TCPConn(BufferedConn):
+
+    RECV_SIZE = 4096
+
+    def __init__(self, loc, timeout=None):
+        super(TCPConn, self).__init__()
         host, port = loc.split(':')
         self._conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._conn.settimeout(timeout)
         self._conn.connect((host, int(port)))
 
     def write(self, b):
-        self._conn.send(b)
+        self._conn.sendall(b)
 
-    def read(self):
-        return self._conn.recv(1)
+    def _read_available(self):
+        return self._conn.recv(self.RECV_SIZE)
 
     def close(self):
         return self._conn.close()
@@ -313,16 +1007,20 @@ class TCPConn:
     def accepts(cls, loc):
         return ':' in loc
 
-class OSD:
+class OSD(object):
 
     def __init__(self, port, **kwargs):
         self.conn = None
-        self.send_buffer = bytearray()
-        self.recv_buffer = []
+        self._frame = bytearray(_FRAME_BUFFER_SIZE)
+        self._frame_len = 0
+        self.recv_buffer = collections.deque()
+        self._decoder = FrameDecoder(MAX_RESPONSE_SIZE)
         self.port = port
         self.trace = kwargs.get('trace', False)
         self.debug = self.trace or kwargs.get('debug', False)
         self.baudrate = kwargs.get('baudrate', BAUDRATE)
+        # Read timeout in seconds, None to wait forever
+        self.timeout = kwargs.get('timeout')
         self.msp_passthrough = kwargs.get('msp_passthrough', False)
         profile_at = kwargs.get('profile_at')
         if profile_at is not None:
@@ -335,16 +1033,33 @@ class OSD:
                 raise ValueError('profile_at must be a tuple, list or a string in the form "X,Y"')
         self.profile_at = profile_at
         self.info = None
+        self.drawing_state = DrawingState() if kwargs.get('track_state', False) else None
+        self.saved_bytes = 0
+        self.transaction_saved_bytes = 0
+        # Total bytes in the frames sent to the OSD
+        self.bytes_written = 0
+        self.ctm_tolerance = kwargs.get('ctm_tolerance', CTM_TOLERANCE)
+        # When enabled, CTM operations are composed in the host and
+        # sent before the next drawing command, using the cheapest of
+        # the operations as requested and their composition
+        self.ctm_tracker = ctm.CTMTracker() if kwargs.get('compose_ctm', False) else None
+        # Per transaction counters of the frames sent
+        self.wire_stats = WireStats() if kwargs.get('wire_stats', False) else None
+        # CaptureWriter recording the data sent and received
+        self.capture = kwargs.get('capture')
 
     def open(self):
         '''Open the connection to the OSD'''
         if self.conn is not None:
             self.conn.close()
 
+        self.recv_buffer.clear()
+        self._decoder.reset()
+        self._forget_drawing_state()
         if SerialConn.accepts(self.port):
-            self.conn = SerialConn(self.port, self.baudrate)
+            self.conn = SerialConn(self.port, self.baudrate, self.timeout)
         elif TCPConn.accepts(self.port):
-            self.conn = TCPConn(self.port)
+            self.conn = TCPConn(self.port, self.timeout)
         else:
             print("Unknown port type {}".format(self.port))
             return False
@@ -360,6 +1075,8 @@ class OSD:
                 self._stop_msp_passthrough()
             self.conn.close()
             self.conn = None
+        if self.capture is not None:
+            self.capture.flush()
 
     def connect(self, force=False):
         '''Open the connection and retrieve OSD info'''
@@ -397,41 +1114,97 @@ class OSD:
         payload = struct.pack('<H', char_addr) + data
         return self.send_frame_sync_resp(CMD.WRITE_FONT, payload)
 
-    def upload_font(self, font, progress=None):
-        '''Upload a MAX7456 font from an MCM'''
-        header = font.readline().strip()
-        if header != b'MAX7456':
-            raise RuntimeError("Invalid MAX7456 header")
+    def upload_font(self, font, progress=None, window=1):
+        '''Upload a MAX7456 font from an MCM, keeping up to window
+        characters in flight'''
+        data = parse_mcm(font)
+        chars = range(len(data) // FONT_CHAR_SIZE)
+        payloads, check, on_ack = self._write_font_transfer(data, chars, progress)
+        self._send_pipelined(CMD.WRITE_FONT, payloads, window, check, on_ack)
+
+    def read_font(self, chars, window=1):
+        '''Read the given characters from the OSD, returning a bytearray
+        with FONT_CHAR_SIZE bytes per character'''
+        payloads, check, on_ack, data = self._read_font_transfer(chars)
+        self._send_pipelined(CMD.READ_FONT, payloads, window, check, on_ack)
+        return data
 
-        data = bytearray()
-        chr_addr = 0
-        buf = ''
-        for ch in font.read():
-            if isinstance(ch, int):
-                # Python 3
-                ch = chr(ch)
-            if ch == '\r' or ch == '\n':
-                continue
-            buf += ch
-            if len(buf) == 8:
-                b = int(buf, 2)
-                data.append(b)
-                buf = ''
-                if len(data) == 64:
-                    self.upload_font_char(chr_addr, data)
-                    if progress:
-                        progress(chr_addr)
-                    data = bytearray()
-                    chr_addr += 1
+    def sync_font(self, font, cache=None, progress=None, window=1):
+        '''Upload only the characters from a MAX7456 MCM font that are
+        different from the ones stored in the OSD. If cache is provided,
+        it must be a dict mapping character addresses to the hashes
+        stored in it by a previous sync_font() on the same device. When
+        it covers the whole font, reading the font back is skipped.
+        Returns the number of characters that didn't need uploading'''
+        data = parse_mcm(font)
+        hashes = font_fingerprint(data)
+        chars = range(len(hashes))
+        current = self._cached_font_fingerprint(chars, cache)
+        if current is None:
+            current = font_fingerprint(self.read_font(chars, window))
+        changed = [c for c in chars if hashes[c] != current[c]]
+        payloads, check, on_ack = self._write_font_transfer(data, changed, progress)
+        self._send_pipelined(CMD.WRITE_FONT, payloads, window, check, on_ack)
+        return self._sync_font_done(hashes, changed, cache)
+
+    def _cached_font_fingerprint(self, chars, cache):
+        if cache is not None and all(c in cache for c in chars):
+            return [cache[c] for c in chars]
+        return None
+
+    def _sync_font_done(self, hashes, changed, cache):
+        if cache is not None:
+            cache.update(enumerate(hashes))
+        skipped = len(hashes) - len(changed)
+        if self.debug:
+            print('{} characters uploaded, {} skipped'.format(len(changed), skipped))
+        return skipped
+
+    def _read_font_transfer(self, chars):
+        chars = list(chars)
+        data = bytearray(len(chars) * FONT_CHAR_SIZE)
+        view = memoryview(data)
+        payloads = [struct.pack('<H', c) for c in chars]
+
+        def check(idx, resp):
+            if isinstance(resp, ResponseError):
+                raise RemoteResponseError(resp, 'error reading font character {}: {}'.format(chars[idx], resp.error_code))
+            return isinstance(resp, ResponseFont) and resp.addr == chars[idx]
+
+        def on_ack(idx, resp):
+            chr_data = resp.data[:FONT_CHAR_SIZE]
+            start = idx * FONT_CHAR_SIZE
+            view[start:start + len(chr_data)] = chr_data
+
+        return payloads, check, on_ack, data
+
+    def _write_font_transfer(self, data, chars, progress):
+        chars = list(chars)
+        payloads = []
+        for chr_addr in chars:
+            start = chr_addr * FONT_CHAR_SIZE
+            char_data = data[start:start + FONT_CHAR_SIZE]
+            if self.trace:
+                print('Uploading character {} {}'.format(chr_addr, _format_payload(char_data)))
+            payloads.append(struct.pack('<H', chr_addr) + bytes(char_data))
+
+        def check(idx, resp):
+            return isinstance(resp, ResponseFont) and resp.addr == chars[idx]
+
+        def on_ack(idx, resp):
+            if progress:
+                progress(chars[idx])
+
+        return payloads, check, on_ack
 
     # Firmware flashing
 
-    def flash_firmware(self, f, no_reboot=False, progress=None):
+    def flash_firmware(self, f, no_reboot=False, progress=None, window=1):
         '''Flash a compatible firmware file'''
         if not no_reboot:
             self.reboot(True)
             time.sleep(1)
-        self.flash_firmware_bl(f, progress)
+        return self.flash_firmware_bl(f, progress, window)
 
     def erase_firmware(self, no_reboot=False):
         '''Erase firmware from the device (will need an update applied to work)'''
@@ -451,31 +1224,55 @@ class OSD:
         # Reboot
         self.reboot()
 
-    def flash_firmware_bl(self, f, progress=None):
-        '''Flash a compatible firmware file, already in BL'''
-        rem = f.read()
-        total = len(rem)
-        addr = 0
-        while len(rem) > 0:
-            sz = FLASH_WRITE_MAX_BLOCK_SIZE if len(rem) > FLASH_WRITE_MAX_BLOCK_SIZE else len(rem)
-            chunk = rem[:sz]
-            rem = rem[sz:]
-            payload = struct.pack('<L', addr) + chunk
-            addr += sz
-            resp = self.send_frame_sync_resp(CMD.WRITE_FLASH, payload)
-            self._ensure_write_flash_response(resp, addr, allow_workaround=_ALLOW_WORKAROUND and len(rem) == 0)
+    def flash_firmware_bl(self, f, progress=None, window=1):
+        '''Flash a compatible firmware file, already in BL, keeping up
+        to window blocks in flight. Returns the throughput in bytes/s'''
+        payloads, check, on_ack, total = self._flash_transfer(f, progress)
+        start = time.time()
+        self._send_pipelined(CMD.WRITE_FLASH, payloads, window, check, on_ack)
+        rate = self._flash_rate(total, time.time() - start)
+        self._flash_finish(allow_workaround=_ALLOW_WORKAROUND)
+        return rate
+
+    def _flash_transfer(self, f, progress):
+        data = memoryview(f.read())
+        total = len(data)
+        payloads = []
+        addrs = []
+        for addr in range(0, total, FLASH_WRITE_MAX_BLOCK_SIZE):
+            chunk = data[addr:addr + FLASH_WRITE_MAX_BLOCK_SIZE]
+            payloads.append(struct.pack('<L', addr) + chunk.tobytes())
+            addrs.append(addr + len(chunk))
+
+        def check(idx, resp):
+            allow_workaround = _ALLOW_WORKAROUND and idx == len(payloads) - 1
+            try:
+                self._ensure_write_flash_response(resp, addrs[idx], allow_workaround=allow_workaround)
+            except RuntimeError as e:
+                print('{}, retransmitting'.format(e))
+                return False
+            return True
+
+        def on_ack(idx, resp):
             if progress:
-                progress(1 - float(len(rem)) / total)
+                progress(float(addrs[idx]) / total)
             if self.debug:
-                print('{} of {} bytes'.format(total - len(rem), total))
+                print('{} of {} bytes'.format(addrs[idx], total))
 
-        self._flash_finish(allow_workaround=_ALLOW_WORKAROUND)
+        return payloads, check, on_ack, total
+
+    def _flash_rate(self, total, elapsed):
+        rate = total / elapsed if elapsed > 0 else 0
+        if self.debug:
+            print('flashed {} bytes in {:.2f}s ({:.0f} bytes/s)'.format(total, elapsed, rate))
+        return rate
 
     def reboot(self, to_bootloader=False):
         '''Perform an OSD reboot, optionally staying into BL mode'''
         payload = [1 if to_bootloader else 0]
         self.send_frame(CMD.REBOOT, payload)
         self.flush_send_buffer()
+        self._forget_drawing_state()
 
     # Camera and other settings
     def get_active_camera(self):
@@ -485,16 +1282,23 @@ class OSD:
     # Transactions
 
     def transaction_begin(self, profile_at=None):
+        if self.wire_stats is not None:
+            self.wire_stats.begin(self._frame_len)
         profile_at = profile_at = self.profile_at
         if profile_at:
             payload = self._pack_point(profile_at[0], profile_at[1])
             self.send_frame(CMD.TRANSACTION_BEGIN_PROFILED, payload)
         else:
             self.send_frame(CMD.TRANSACTION_BEGIN)
+        self.transaction_saved_bytes = 0
 
     def transaction_commit(self):
         self.send_frame(CMD.TRANSACTION_COMMIT)
         self.flush_send_buffer()
+        if self.wire_stats is not None:
+            self.wire_stats.commit()
+        if self.debug and self.drawing_state is not None:
+            print('transaction saved {} bytes of redundant state'.format(self.transaction_saved_bytes))
 
     # Drawing
 
@@ -538,52 +1342,76 @@ class OSD:
             payload = header + self._pack_str(s)
         return self.send_frame(cmd, payload)
 
+    def draw_grid_strs(self, items):
+        '''Draw several strings in the grid. items is a sequence of
+        (gx, gy, s) or (gx, gy, s, opts) tuples'''
+        v2 = self._speaks_v2()
+        buf = self._frame
+        for item in items:
+            gx, gy, s = item[:3]
+            opts = (item[3] if len(item) > 3 else None) or 0
+            b = _str_to_bytes(s)
+            n = len(b)
+            if not v2 or opts > 7 or n > 15:
+                self.draw_grid_str(gx, gy, s, opts)
+                continue
+            off = self._reserve(CMD.DRAW_GRID_STR_2, 2 + n)
+            _U16.pack_into(buf, off, (gx & 31) | (gy & 15) << 5 | (opts & 7) << 9 | n << 12)
+            buf[off + 2:off + 2 + n] = b
+            if self.debug:
+                self._print_cmd(off)
+
     def set_stroke_color(self, color):
         payload = self._pack_color(color)
-        return self.send_frame(CMD.SET_STROKE_COLOR, payload)
+        return self._send_state_frame(CMD.SET_STROKE_COLOR, payload, 'stroke_color')
 
     def set_fill_color(self, color):
         payload = self._pack_color(color)
-        return self.send_frame(CMD.SET_FILL_COLOR, payload)
+        return self._send_state_frame(CMD.SET_FILL_COLOR, payload, 'fill_color')
 
     def set_stroke_and_fill_color(self, color):
         payload = self._pack_color(color)
-        return self.send_frame(CMD.SET_STROKE_AND_FILL_COLOR, payload)
+        return self._send_state_frame(CMD.SET_STROKE_AND_FILL_COLOR, payload, 'stroke_color', 'fill_color')
 
     def set_color_inversion(self, invert):
         payload = self._pack_u8(1 if invert else 0)
-        return self.send_frame(CMD.SET_COLOR_INVERSION, payload)
+        return self._send_state_frame(CMD.SET_COLOR_INVERSION, payload, 'color_inversion')
 
     def set_pixel(self, x, y, color):
-        payload = self._pack_point(x, y) + self._pack_color(color)
-        return self.send_frame(CMD.SET_PIXEL, payload)
+        return self._send_point(CMD.SET_PIXEL, x, y, color)
 
     def set_pixel_to_stroke_color(self, x, y):
-        payload = self._pack_point(x, y)
-        return self.send_frame(CMD.SET_PIXEL_TO_STROKE_COLOR, payload)
+        return self._send_point(CMD.SET_PIXEL_TO_STROKE_COLOR, x, y)
 
     def set_pixel_to_fill_color(self, x, y):
-        payload = self._pack_point(x, y)
-        return self.send_frame(CMD.SET_PIXEL_TO_FILL_COLOR, payload)
+        return self._send_point(CMD.SET_PIXEL_TO_FILL_COLOR, x, y)
+
+    def set_pixels(self, points, color=None):
+        '''Set several pixels, given as a sequence or a NumPy array of
+        (x, y) points, to color or to the stroke color if it's None'''
+        if color is None:
+            return self._send_points_block(CMD.SET_PIXEL_TO_STROKE_COLOR, points, 1)
+        _check_color(color)
+        return self._send_points_block(CMD.SET_PIXEL, points, 1, bytearray([color]))
 
     def set_stroke_width(self, w):
         payload = self._pack_u8(w)
-        return self.send_frame(CMD.SET_STROKE_WIDTH, payload)
+        return self._send_state_frame(CMD.SET_STROKE_WIDTH, payload, 'stroke_width')
 
     def set_line_outline_type(self, ot):
         if ot < OUTLINE.NONE or ot > OUTLINE.LEFT:
             raise ValueError("Invalid outline type %d" % ot)
 
         payload = self._pack_u8(ot)
-        return self.send_frame(CMD.SET_LINE_OUTLINE_TYPE, payload)
+        return self._send_state_frame(CMD.SET_LINE_OUTLINE_TYPE, payload, 'outline_type')
 
     def set_line_outline_color(self, color):
         payload = self._pack_color(color)
-        return self.send_frame(CMD.SET_LINE_OUTLINE_COLOR, payload)
+        return self._send_state_frame(CMD.SET_LINE_OUTLINE_COLOR, payload, 'outline_color')
 
     def clip_to_rect(self, rect):
         payload = self._pack_rect(rect)
-        return self.send_frame(CMD.CLIP_TO_RECT, payload)
+        return self._send_state_frame(CMD.CLIP_TO_RECT, payload, 'clip_rect')
 
     def clear_screen(self):
         '''Clear the whole screen'''
@@ -591,10 +1419,13 @@ class OSD:
 
     def clear_rect(self, rect):
         '''Clear a rect given as (x, y, w, h)'''
-        payload = self._pack_rect(rect)
-        return self.send_frame(CMD.CLEAR_RECT, payload)
+        return self._send_rect(CMD.CLEAR_RECT, rect)
 
     def drawing_reset(self):
+        if self.drawing_state is not None:
+            self.drawing_state.drawing_reset()
+        if self.ctm_tracker is not None:
+            self.ctm_tracker.drawing_reset()
         return self.send_frame(CMD.DRAWING_RESET)
 
     def draw_bitmap(self, rect, bitmap, opts=None):
@@ -606,108 +1437,329 @@ class OSD:
         pass
 
     def draw_chr(self, x, y, ch, opts=None):
-        c = ch
-        if isinstance(c, str):
-            c = ord(c[0])
-        payload = self._pack_point(x, y) + struct.pack('<HB', int(c), (opts or 0))
-        return self.send_frame(CMD.DRAW_CHAR, payload)
+        return self._send_chr(CMD.DRAW_CHAR, x, y, ch, opts)
 
     def draw_chr_mask(self, x, y, ch, color, opts=None):
-        c = ch
-        if isinstance(c, str):
-            c = ord(c[0])
-        payload = self._pack_point(x, y) + struct.pack('<HBB', int(c), opts or 0, color)
-        return self.send_frame(CMD.DRAW_CHAR_MASK, payload)
+        return self._send_chr(CMD.DRAW_CHAR_MASK, x, y, ch, opts, color)
 
     def draw_str(self, x, y, s, opts=None):
-        self._pack_point(x, y)
-        header = self._pack_point(x, y) + struct.pack('<B', opts or 0)
-        payload = header + self._pack_str(s)
-        return self.send_frame(CMD.DRAW_STRING, payload)
+        return self._send_str(CMD.DRAW_STRING, x, y, s, opts)
 
     def draw_str_mask(self, x, y, s, color, opts=None):
-        self._pack_point(x, y)
-        header = self._pack_point(x, y) + struct.pack('<BB', opts or 0, color)
-        payload = header + self._pack_str(s)
-        return self.send_frame(CMD.DRAW_STRING_MASK, payload)
+        return self._send_str(CMD.DRAW_STRING_MASK, x, y, s, opts, color)
 
     def move_to_point(self, x, y):
-        payload = self._pack_point(x, y)
-        return self.send_frame(CMD.MOVE_TO_POINT, payload)
+        return self._send_point(CMD.MOVE_TO_POINT, x, y)
 
     def stroke_line_to_point(self, x, y):
-        payload = self._pack_point(x, y)
-        return self.send_frame(CMD.STROKE_LINE_TO_POINT, payload)
+        return self._send_point(CMD.STROKE_LINE_TO_POINT, x, y)
+
+    def stroke_polyline(self, points, closed=False):
+        '''Stroke the lines joining a sequence or a NumPy array of (x, y)
+        points, returning to the first one when closed is True'''
+        if len(points) == 0:
+            return
+        data = bytearray(_pack_points_block(CMD.STROKE_LINE_TO_POINT, points, 1))
+        data[0] = CMD.MOVE_TO_POINT
+        if closed:
+            data += data[:4]
+            data[-4] = CMD.STROKE_LINE_TO_POINT
+        return self._send_block(CMD.STROKE_LINE_TO_POINT, data, 4)
 
     def stroke_triangle(self, p1, p2, p3):
-        payload = self._pack_point(p1[0], p1[1]) + self._pack_point(p2[0], p2[1]) + self._pack_point(p3[0], p3[1])
-        return self.send_frame(CMD.STROKE_TRIANGLE, payload)
+        return self._send_triangle(CMD.STROKE_TRIANGLE, p1, p2, p3)
 
     def fill_triangle(self, p1, p2, p3):
-        payload = self._pack_point(p1[0], p1[1]) + self._pack_point(p2[0], p2[1]) + self._pack_point(p3[0], p3[1])
-        return self.send_frame(CMD.FILL_TRIANGLE, payload)
+        return self._send_triangle(CMD.FILL_TRIANGLE, p1, p2, p3)
 
     def fill_stroke_triangle(self, p1, p2, p3):
-        payload = self._pack_point(p1[0], p1[1]) + self._pack_point(p2[0], p2[1]) + self._pack_point(p3[0], p3[1])
-        return self.send_frame(CMD.FILL_STROKE_TRIANGLE, payload)
+        return self._send_triangle(CMD.FILL_STROKE_TRIANGLE, p1, p2, p3)
 
     def stroke_rect(self, r):
-        payload = self._pack_rect(r)
-        return self.send_frame(CMD.STROKE_RECT, payload)
+        return self._send_rect(CMD.STROKE_RECT, r)
 
     def fill_rect(self, r):
-        payload = self._pack_rect(r)
-        return self.send_frame(CMD.FILL_RECT, payload)
+        return self._send_rect(CMD.FILL_RECT, r)
 
     def fill_stroke_rect(self, r):
-        payload = self._pack_rect(r)
-        return self.send_frame(CMD.FILL_STROKE_RECT, payload)
+        return self._send_rect(CMD.FILL_STROKE_RECT, r)
+
+    def stroke_rects(self, rects):
+        '''Stroke a sequence or a NumPy array of (x, y, w, h) rects'''
+        return self._send_points_block(CMD.STROKE_RECT, rects, 2)
+
+    def fill_rects(self, rects):
+        '''Fill a sequence or a NumPy array of (x, y, w, h) rects'''
+        return self._send_points_block(CMD.FILL_RECT, rects, 2)
 
     def stroke_ellipse_in_rect(self, r):
-        payload = self._pack_rect(r)
-        return self.send_frame(CMD.STROKE_ELLIPSE_IN_RECT, payload)
+        return self._send_rect(CMD.STROKE_ELLIPSE_IN_RECT, r)
 
     def fill_ellipse_in_rect(self, r):
-        payload = self._pack_rect(r)
-        return self.send_frame(CMD.FILL_ELLIPSE_IN_RECT, payload)
+        return self._send_rect(CMD.FILL_ELLIPSE_IN_RECT, r)
 
     def fill_stroke_ellipse_in_rect(self, r):
-        payload = self._pack_rect(r)
-        return self.send_frame(CMD.FILL_STROKE_ELLIPSE_IN_RECT, payload)
+        return self._send_rect(CMD.FILL_STROKE_ELLIPSE_IN_RECT, r)
+
+    # Commands packed directly into the frame buffer
+
+    def _send_point(self, cmd, x, y, color=None):
+        if color is None:
+            off = self._reserve(cmd, 3)
+        else:
+            _check_color(color)
+            off = self._reserve(cmd, 4)
+            self._frame[off + 3] = color
+        _pack_point_into(self._frame, off, x, y)
+        if self.debug:
+            self._print_cmd(off)
+
+    def _send_rect(self, cmd, r):
+        x, y, w, h = r
+        off = self._reserve(cmd, 6)
+        buf = self._frame
+        _pack_point_into(buf, off, x, y)
+        _pack_point_into(buf, off + 3, w, h)
+        if self.debug:
+            self._print_cmd(off)
+
+    def _send_triangle(self, cmd, p1, p2, p3):
+        off = self._reserve(cmd, 9)
+        buf = self._frame
+        _pack_point_into(buf, off, p1[0], p1[1])
+        _pack_point_into(buf, off + 3, p2[0], p2[1])
+        _pack_point_into(buf, off + 6, p3[0], p3[1])
+        if self.debug:
+            self._print_cmd(off)
+
+    def _send_chr(self, cmd, x, y, ch, opts, color=None):
+        c = ch
+        if isinstance(c, str):
+            c = ord(c[0])
+        if color is None:
+            off = self._reserve(cmd, 6)
+            _CHR_OPTS.pack_into(self._frame, off + 3, int(c), opts or 0)
+        else:
+            off = self._reserve(cmd, 7)
+            _CHR_OPTS_COLOR.pack_into(self._frame, off + 3, int(c), opts or 0, color)
+        _pack_point_into(self._frame, off, x, y)
+        if self.debug:
+            self._print_cmd(off)
+
+    def _send_str(self, cmd, x, y, s, opts, color=None):
+        b = _str_to_bytes(s)
+        # Null terminated blob, with its length as an uvarint
+        n = len(b) + 1
+        header = 4 if color is None else 5
+        size_len = 1 if n < 0x80 else 2
+        size = header + size_len + n
+        if size + 1 > MAX_SEND_BUFFER_SIZE:
+            # Too long for the frame buffer
+            return self._send_str_slow(cmd, x, y, s, opts, color)
+        off = self._reserve(cmd, size)
+        buf = self._frame
+        _pack_point_into(buf, off, x, y)
+        buf[off + 3] = opts or 0
+        if color is not None:
+            buf[off + 4] = color
+        pos = off + header
+        if size_len == 1:
+            buf[pos] = n
+        else:
+            buf[pos] = (n & 0x7f) | 0x80
+            buf[pos + 1] = n >> 7
+        pos += size_len
+        buf[pos:pos + n - 1] = b
+        buf[pos + n - 1] = 0
+        if self.debug:
+            self._print_cmd(off)
+
+    def _send_points_block(self, cmd, items, npoints, trailer=b''):
+        if len(items) == 0:
+            return
+        data = _pack_points_block(cmd, items, npoints, trailer)
+        return self._send_block(cmd, data, 1 + 3 * npoints + len(trailer))
+
+    def _send_block(self, cmd, data, stride):
+        # Append data, containing commands of stride bytes, splitting it
+        # between frames as needed
+        if self.debug:
+            print("CMD {} =>> {} commands".format(cmd, len(data) // stride))
+        if self.ctm_tracker is not None and cmd in _CTM_DEPENDENT_CMDS:
+            self._flush_ctm()
+        view = memoryview(data)
+        pos = 0
+        end = len(data)
+        while pos < end:
+            room = (MAX_SEND_BUFFER_SIZE - self._frame_len) // stride * stride
+            if room == 0:
+                self.flush_send_buffer()
+                continue
+            n = min(room, end - pos)
+            off = _FRAME_HEADER_SIZE + self._frame_len
+            self._frame[off:off + n] = view[pos:pos + n]
+            self._frame_len += n
+            pos += n
+
+    def _send_str_slow(self, cmd, x, y, s, opts, color):
+        header = self._pack_point(x, y) + struct.pack('<B', opts or 0)
+        if color is not None:
+            header = header + self._pack_color(color)
+        return self.send_frame(cmd, header + self._pack_str(s))
 
     # CTM
 
     def ctm_reset(self):
-        self.send_frame(CMD.CTM_RESET)
+        return self._ctm_op('reset')
 
     def ctm_set(self, m11, m12, m21, m22, m31, m32):
-        payload = struct.pack('<ffffff', m11, m12, m21, m22, m31, m32)
-        return self.send_frame(CMD.CTM_SET, payload)
+        return self._ctm_op('set', m11, m12, m21, m22, m31, m32)
 
     def ctm_translate(self, tx, ty):
-        payload = struct.pack('<ff', tx, ty)
-        return self.send_frame(CMD.CTM_TRANSLATE, payload)
+        return self._ctm_op('translate', tx, ty)
 
     def ctm_translate_rev(self, tx, ty):
-        payload = struct.pack('<ff', tx, ty)
-        return self.send_frame(CMD.CTM_TRANSLATE_REV, payload)
+        return self._ctm_op('translate_rev', tx, ty)
 
     def ctm_scale(self, sx, sy):
-        payload = struct.pack('<ff', sx, sy)
-        return self.send_frame(CMD.CTM_SCALE, payload)
+        return self._ctm_op('scale', sx, sy)
+
+    def ctm_scale_rev(self, sx, sy):
+        return self._ctm_op('scale_rev', sx, sy)
 
     def ctm_rotate(self, r):
-        payload = struct.pack('<f', r)
-        return self.send_frame(CMD.CTM_ROTATE, payload)
+        return self._ctm_op('rotate', r)
+
+    def ctm_rotate_rev(self, r):
+        return self._ctm_op('rotate_rev', r)
+
+    def ctm_rotate_about(self, r, cx, cy):
+        return self._ctm_op('rotate_about', r, cx, cy)
+
+    def ctm_rotate_about_rev(self, r, cx, cy):
+        return self._ctm_op('rotate_about_rev', r, cx, cy)
+
+    def ctm_shear(self, sx, sy):
+        return self._ctm_op('shear', sx, sy)
+
+    def ctm_shear_rev(self, sx, sy):
+        return self._ctm_op('shear_rev', sx, sy)
+
+    def ctm_shear_about(self, sx, sy, cx, cy):
+        return self._ctm_op('shear_about', sx, sy, cx, cy)
+
+    def ctm_shear_about_rev(self, sx, sy, cx, cy):
+        return self._ctm_op('shear_about_rev', sx, sy, cx, cy)
+
+    def ctm_multiply(self, m11, m12, m21, m22, m31, m32):
+        return self._ctm_op('multiply', m11, m12, m21, m22, m31, m32)
+
+    def ctm_multiply_rev(self, m11, m12, m21, m22, m31, m32):
+        return self._ctm_op('multiply_rev', m11, m12, m21, m22, m31, m32)
+
+    def _ctm_op(self, *op):
+        # Compose op in the host if possible, otherwise send it
+        tracker = self.ctm_tracker
+        if tracker is not None:
+            if op[0] == 'reset':
+                return tracker.reset()
+            if op[0] == 'set':
+                return tracker.set(op[1:])
+            if tracker.compose(op):
+                return
+            self._flush_ctm()
+        self._send_ctm_op(op)
+
+    def _send_ctm_op(self, op):
+        cmd, payload = self._ctm_frame(op)
+        if cmd == CMD.CTM_RESET:
+            return self._send_state_frame(cmd, payload, 'ctm')
+        return self._send_ctm_frame(cmd, payload)
+
+    def _ctm_frame(self, op):
+        # Returns the command and payload for the CTM operation op
+        name = op[0]
+        cmd, compact_cmd, fmt = _CTM_OPS[name]
+        if compact_cmd is not None:
+            if name.startswith('translate'):
+                return self._ctm_translate_frame(cmd, compact_cmd, *op[1:])
+            return self._ctm_rotate_frame(cmd, compact_cmd, *op[1:])
+        return cmd, struct.pack(fmt, *op[1:])
+
+    def _ctm_op_size(self, op):
+        return 1 + len(self._ctm_frame(op)[1])
+
+    def _flush_ctm(self):
+        for op in self.ctm_tracker.update(self._ctm_op_size):
+            self._send_ctm_op(op)
+
+    def _ctm_compact(self):
+        return self.ctm_tolerance is not None and self.info is not None and self._speaks_v2()
+
+    def _ctm_translate_frame(self, cmd, cmd_i16, tx, ty):
+        if self._ctm_compact():
+            itx = int(round(tx))
+            ity = int(round(ty))
+            if -0x8000 <= itx <= 0x7fff and -0x8000 <= ity <= 0x7fff and \
+                    abs(tx - itx) <= self.ctm_tolerance and abs(ty - ity) <= self.ctm_tolerance:
+                return cmd_i16, struct.pack('<hh', itx, ity)
+        return cmd, struct.pack('<ff', tx, ty)
+
+    def _ctm_rotate_frame(self, cmd, cmd_u16, r):
+        if self._ctm_compact():
+            step = 2 * math.pi / _U16_ROTATION_STEPS
+            q = int(round(r / step))
+            radius = math.hypot(self.info.pixelWidth, self.info.pixelHeight)
+            if abs(r - q * step) * radius <= self.ctm_tolerance:
+                return cmd_u16, struct.pack('<H', q % _U16_ROTATION_STEPS)
+        return cmd, struct.pack('<f', r)
 
     # Context
 
     def context_push(self):
+        if self.ctm_tracker is not None:
+            # Otherwise the pending operations would be sent inside the
+            # context and again after popping it
+            self._flush_ctm()
+            self.ctm_tracker.push()
+        if self.drawing_state is not None:
+            self.drawing_state.push()
         self.send_frame(CMD.CONTEXT_PUSH)
 
     def context_pop(self):
+        if self.drawing_state is not None:
+            self.drawing_state.pop()
+        if self.ctm_tracker is not None:
+            self.ctm_tracker.pop()
         self.send_frame(CMD.CONTEXT_POP)
 
+    # Drawing state
+
+    def _send_state_frame(self, cmd, payload, *fields):
+        state = self.drawing_state
+        if state is not None:
+            if state.matches(fields, payload):
+                saved = 1 + len(payload)
+                self.saved_bytes += saved
+                self.transaction_saved_bytes += saved
+                return
+            state.set(fields, payload)
+        return self.send_frame(cmd, payload)
+
+    def _send_ctm_frame(self, cmd, payload):
+        if self.drawing_state is not None:
+            self.drawing_state.set(('ctm',), None)
+        return self.send_frame(cmd, payload)
+
+    def _forget_drawing_state(self):
+        if self.drawing_state is not None:
+            self.drawing_state.forget()
+        if self.ctm_tracker is not None:
+            # Anything running next (e.g. a VM function) should see
+            # the CTM operations requested so far
+            self._flush_ctm()
+            self.ctm_tracker.forget()
+
     # Widgets
 
     def _map_wid(self, idx, min, max):
@@ -778,29 +1830,15 @@ class OSD:
             raise RemoteResponseError(resp, 'error retrieving next offset to upload: {}'.format(resp.error_code))
         return struct.unpack('<L', resp.payload)[0]
 
-    def upload_program(self, f):
-        data = f.read()
-        header_size = self._vm_storage_header_size()
-        total_size = len(data) + header_size
-        max_size = self._vm_storage_size() - header_size
-        if len(data) > max_size:
-            raise ValueError('can\'t upload program of {} bytes, maximum size is {}'.format(len(data), max_size))
-        crc = self._crc32_ieee(data)
-        blob = struct.pack('<LL', total_size, crc)
-        payload = self._pack_upload_blob(0, blob)
+    def upload_program(self, f, window=1):
+        raw = f.read()
+        payload = self._program_header(raw, self._vm_storage_size())
         resp = self.send_frame_sync_resp(CMD.VM_STORAGE_WRITE, payload)
         offset = self._upload_resp_offset(resp)
-        rem = len(data)
-        while rem > 0:
-            s = min(self._vm_max_transfer_block_size(), rem)
-            data_offset = offset - header_size
-            chunk = data[data_offset:data_offset+s]
-            rem -= len(chunk)
-            payload = self._pack_upload_blob(offset, chunk)
-            resp = self.send_frame_sync_resp(CMD.VM_STORAGE_WRITE, payload)
-            offset = self._upload_resp_offset(resp)
+        payloads, check = self._program_upload_transfer(raw, offset)
+        self._send_pipelined(CMD.VM_STORAGE_WRITE, payloads, window, check)
 
-    def download_program(self, f):
+    def download_program(self, f, window=1, retries=3):
         # Read the header
         header_size = self._vm_storage_header_size()
         payload = struct.pack('<LL', 0, header_size)
@@ -808,17 +1846,79 @@ class OSD:
         size, crc = struct.unpack('<LL', resp.payload)
         if size > self._vm_storage_size():
             raise RuntimeError('no valid data found in the vm storage')
-        rem = size - header_size
-        offset = header_size
-        while rem > 0:
-            s = min(self._vm_max_transfer_block_size(), rem)
-            payload = struct.pack('<LL', offset, s)
-            resp = self.send_frame_sync_resp(CMD.VM_STORAGE_READ, payload)
-            f.write(resp.payload)
-            offset += s
-            rem -= s
+        for attempt in range(retries + 1):
+            payloads, check, on_ack, data = self._program_download_transfer(size)
+            self._send_pipelined(CMD.VM_STORAGE_READ, payloads, window, check, on_ack)
+            if self._crc32_ieee(bytes(data)) == crc:
+                f.write(data)
+                return
+            # VM_STORAGE_READ responses don't include their offset, so
+            # a lost request shifts the responses to the following ones
+            # onto the wrong blocks. Download again one block at a time.
+            window = 1
+            self._discard_responses()
+        raise RuntimeError('downloaded program doesn\'t match its CRC after {} retries'.format(retries))
+
+    def _program_header(self, data, storage_size):
+        header_size = self._vm_storage_header_size()
+        total_size = len(data) + header_size
+        max_size = storage_size - header_size
+        if len(data) > max_size:
+            raise ValueError('can\'t upload program of {} bytes, maximum size is {}'.format(len(data), max_size))
+        crc = self._crc32_ieee(data)
+        blob = struct.pack('<LL', total_size, crc)
+        return self._pack_upload_blob(0, blob)
+
+    def _program_upload_transfer(self, raw, offset):
+        data = memoryview(raw)
+        header_size = self._vm_storage_header_size()
+        total_size = len(data) + header_size
+        payloads = []
+        offsets = []
+        block_size = self._vm_max_transfer_block_size()
+        while offset < total_size:
+            data_offset = offset - header_size
+            chunk = data[data_offset:data_offset+block_size].tobytes()
+            payloads.append(self._pack_upload_blob(offset, chunk))
+            offset += len(chunk)
+            offsets.append(offset)
+
+        def check(idx, resp):
+            if isinstance(resp, ResponseError):
+                # The blocks sent after a lost one are rejected, since
+                # they don't continue the stored data. Send them again.
+                return False
+            return resp is not None and self._upload_resp_offset(resp) == offsets[idx]
+
+        return payloads, check
+
+    def _program_download_transfer(self, size):
+        header_size = self._vm_storage_header_size()
+        data = bytearray(size - header_size)
+        view = memoryview(data)
+        block_size = self._vm_max_transfer_block_size()
+        payloads = []
+        for offset in range(header_size, size, block_size):
+            payloads.append(struct.pack('<LL', offset, min(block_size, size - offset)))
+
+        def block(idx):
+            start = idx * block_size
+            return start, min(start + block_size, len(data))
+
+        def check(idx, resp):
+            if isinstance(resp, ResponseError):
+                raise RemoteResponseError(resp, 'error reading vm storage: {}'.format(resp.error_code))
+            start, end = block(idx)
+            return resp is not None and len(resp.payload) == end - start
+
+        def on_ack(idx, resp):
+            start, end = block(idx)
+            view[start:end] = resp.payload
+
+        return payloads, check, on_ack, data
 
     def start_program(self):
+        self._forget_drawing_state()
         resp = self.send_frame_sync_resp(CMD.VM_START)
         if isinstance(resp, ResponseError):
             raise RemoteResponseError(resp, 'error starting program: {}'.format(resp.error_code))
@@ -842,8 +1942,17 @@ class OSD:
         return struct.unpack('<h', resp.payload)[0]
 
     def run_function(self, name, args=None, reply=True):
-        args = args or []
         sym = self._vm_lookup_symbol(name)
+        payload = self._pack_function_call(sym, args, reply)
+        self._forget_drawing_state()
+        if reply:
+            resp = self.send_frame_sync_resp(CMD.VM_EXEC, payload)
+            return struct.unpack('<L', resp.payload)[0]
+        else:
+            self.send_frame(CMD.VM_EXEC, payload)
+
+    def _pack_function_call(self, sym, args, reply):
+        args = args or []
         sym = sym << 1 | 1 if reply else 0
         payload = self._pack_uvarint(sym)
         payload += self._pack_uvarint(len(args))
@@ -859,67 +1968,153 @@ class OSD:
                 payload += struct.pack('<f', item)
             else:
                 raise ValueError('can\'t encode argument {} of type {}'.format(item, type(item)))
-
-        if reply:
-            resp = self.send_frame_sync_resp(CMD.VM_EXEC, payload)
-            return struct.unpack('<L', resp.payload)[0]
-        else:
-            self.send_frame(CMD.VM_EXEC, payload)
+        return payload
 
     # Raw frame handling
 
     def send_frame_sync_resp(self, cmd, payload=None):
         self.send_frame(cmd, payload)
         self.flush_send_buffer()
-        if not self._expect_marker('$', skip=1000):
-            return None
-        if not self._expect_marker('A'):
-            return None
-
-        crc = 0
-        payload_size = 0
-        shift = 0
-        while True:
-            b = self._recv_byte()
-            crc = self._crc8_dvb_s2(crc, b)
-            payload_size |= b << shift
-            if payload_size > 2048:
-                raise RuntimeError("payload size of {} is too big".format(payload_size))
-            if b < 0x80:
-                break
-            shift += 7
-        payload = bytearray()
-        for ii in range(payload_size):
-            b = self._recv_byte()
-            crc = self._crc8_dvb_s2(crc, b)
-            payload.append(b)
-
-        ccrc = self._recv_byte()
-        if crc != ccrc:
-            print("Invalid crc %d, expecting %d" % (ccrc, crc))
-            return None
+        return self._recv_response()
+
+    def _recv_response(self):
+        while not self.recv_buffer:
+            if not self._feed_received(self.conn.read_available()):
+                return None
+        return self._pop_response()
+
+    def _feed_received(self, data):
+        # Returns False if data contained an invalid frame and there's
+        # nothing left to wait for
+        if self.capture is not None:
+            self.capture.received(data)
+        if self.trace:
+            print('R<< {}'.format(_format_payload(bytearray(data))))
+        errors = self._decoder.errors
+        self.recv_buffer.extend(self._decoder.feed(data))
+        if not self.recv_buffer and self._decoder.errors != errors and not self._decoder.pending():
+            print("Invalid response frame ({} CRC errors, {} length errors so far)".format(
+                self._decoder.crc_errors, self._decoder.length_errors))
+            return False
+        return True
 
-        # OSD responses are never bundled
-        cmd = payload[0]
-        resp = Response.decode(cmd, payload[1:])
+    def _pop_response(self):
+        resp = self.recv_buffer.popleft()
         if self.debug:
             print('RESP <<= {}'.format(resp))
         return resp
 
+    def _send_pipelined(self, cmd, payloads, window, check, on_ack=None, retries=3):
+        '''Send each payload in its own frame, keeping up to window requests
+        without a response. check(idx, resp) must return True if resp is
+        the expected response for payloads[idx] or False to send it again.
+        Returns the list of responses'''
+        pipeline = _Pipeline(cmd, payloads, window, check, on_ack, retries)
+        while not pipeline.done():
+            for payload in pipeline.next_requests():
+                self.send_frame(cmd, payload)
+                self.flush_send_buffer()
+            for ii in range(pipeline.handle(self._recv_pipelined_response())):
+                self._recv_pipelined_response()
+        return pipeline.responses
+
+    def _discard_responses(self):
+        # Drop the responses already received and, with a timeout, the
+        # ones still in flight
+        self.recv_buffer.clear()
+        if self.timeout is None:
+            return
+        try:
+            while True:
+                self._feed_received(self.conn.read_available())
+                self.recv_buffer.clear()
+        except IOError:
+            pass
+
+    def _recv_pipelined_response(self):
+        # With a timeout, a lost request or response times out and is
+        # handled as an invalid response, so it's sent again
+        try:
+            return self._recv_response()
+        except IOError:
+            self._abort_partial_frame()
+            return None
+
+    def _abort_partial_frame(self):
+        # A frame with a corrupted length leaves the receiver waiting
+        # for the rest of it, swallowing the frames sent after it.
+        # Responses are complete by the time a read times out, so drop
+        # the partial one. For requests, pad the longest frame the OSD
+        # might be waiting for, so it fails its CRC and the OSD looks
+        # for the next header. When there's no partial frame the
+        # padding is skipped as noise.
+        self.recv_buffer.extend(self._decoder.abort())
+        padding = bytes(bytearray(MAX_SEND_BUFFER_SIZE + 1))
+        self.bytes_written += len(padding)
+        self._conn_write(padding)
+
     def send_frame(self, cmd, payload=None):
         if self.debug:
             print("CMD {} =>> {}".format(cmd, _format_payload(payload)))
-        if len(payload or []) + 1 + len(self.send_buffer) > MAX_SEND_BUFFER_SIZE:
+        size = len(payload) if payload else 0
+        if size + 1 > MAX_SEND_BUFFER_SIZE:
+            # Doesn't fit in the frame buffer, send it on its own
+            if self.ctm_tracker is not None and cmd in _CTM_DEPENDENT_CMDS:
+                self._flush_ctm()
+            if self._frame_len:
+                self.flush_send_buffer()
+            self._write_frame(self._encode_frame(bytearray([cmd]) + payload))
+            return
+        off = self._reserve(cmd, size)
+        if size:
+            self._frame[off:off + size] = payload
+
+    def _reserve(self, cmd, size):
+        # Append cmd to the frame buffer, reserving size bytes for its
+        # payload. Returns the offset of the payload in self._frame.
+        if self.ctm_tracker is not None and cmd in _CTM_DEPENDENT_CMDS:
+            self._flush_ctm()
+        if self._frame_len + 1 + size > MAX_SEND_BUFFER_SIZE:
             self.flush_send_buffer()
+        off = _FRAME_HEADER_SIZE + self._frame_len
+        self._frame[off] = cmd
+        self._frame_len += 1 + size
+        return off + 1
+
+    def _print_cmd(self, off):
+        end = _FRAME_HEADER_SIZE + self._frame_len
+        print("CMD {} =>> {}".format(self._frame[off - 1], _format_payload(bytes(self._frame[off:end]))))
 
-        self.send_buffer.append(cmd)
-        if payload:
-            self.send_buffer.extend(payload)
+    @property
+    def send_buffer(self):
+        '''Copy of the commands waiting to be sent'''
+        return self._frame[_FRAME_HEADER_SIZE:_FRAME_HEADER_SIZE + self._frame_len]
+
+    @send_buffer.setter
+    def send_buffer(self, data):
+        if len(data) > MAX_SEND_BUFFER_SIZE:
+            raise ValueError('send buffer is limited to {} bytes'.format(MAX_SEND_BUFFER_SIZE))
+        self._frame[_FRAME_HEADER_SIZE:_FRAME_HEADER_SIZE + len(data)] = data
+        self._frame_len = len(data)
+
+    def send_commands(self, data):
+        '''Append already encoded commands to the send buffer. data must
+        contain whole commands and fit in a frame.'''
+        n = len(data)
+        if n > MAX_SEND_BUFFER_SIZE:
+            raise ValueError('commands must fit in {} bytes'.format(MAX_SEND_BUFFER_SIZE))
+        if self._frame_len + n > MAX_SEND_BUFFER_SIZE:
+            self.flush_send_buffer()
+        off = _FRAME_HEADER_SIZE + self._frame_len
+        self._frame[off:off + n] = data
+        self._frame_len += n
 
     def set_data_rate(self, dr):
         dr = dr or BAUDRATE
         payload = self._pack_u32(dr)
         resp = self.send_frame_sync_resp(CMD.SET_DATA_RATE, payload)
+        if resp is None or resp.cmd != CMD.SET_DATA_RATE:
+            raise RuntimeError('invalid SET_DATA_RATE response {}'.format(resp))
         new_dr = struct.unpack('<I', resp.payload)[0]
         if new_dr != self.baudrate:
             if self.trace:
@@ -928,38 +2123,119 @@ class OSD:
             self.open()
         return self.baudrate
 
+    def auto_tune_data_rate(self, rates=None, burst_frames=8, timeout=0.5):
+        '''Switch to the fastest data rate that works reliably. Rates
+        above the current one are tried in increasing order: each one is
+        set with SET_DATA_RATE, checked with get_info() and benchmarked
+        with a burst of frames. The first rate that fails to respond or
+        produces CRC errors stops the search and the OSD falls back to
+        the rate with the best throughput, which is returned.'''
+        if self.msp_passthrough or not SerialConn.accepts(self.port):
+            raise RuntimeError('data rate tuning requires a direct serial connection')
+        prev_timeout = self.timeout
+        self.timeout = timeout
+        try:
+            self.open()
+            best = self.baudrate
+            best_throughput = self._probe_data_rate(burst_frames)
+            if best_throughput is None:
+                raise RuntimeError('OSD not responding at {} bps'.format(self.baudrate))
+            for rate in sorted(r for r in (rates or DATA_RATES) if r > self.baudrate):
+                prev = self.baudrate
+                try:
+                    self.set_data_rate(rate)
+                    throughput = self._probe_data_rate(burst_frames)
+                except (IOError, RuntimeError):
+                    throughput = None
+                if self.debug:
+                    print('data rate {}: {}'.format(rate, 'failed' if throughput is None else '{:.0f} bytes/s'.format(throughput)))
+                if throughput is None:
+                    self._fall_back_data_rate(best, (rate, prev))
+                    break
+                if throughput > best_throughput * _DATA_RATE_MIN_GAIN:
+                    best = self.baudrate
+                    best_throughput = throughput
+            if self.baudrate != best:
+                self.set_data_rate(best)
+        finally:
+            self.timeout = prev_timeout
+            self.open()
+        return self.baudrate
+
+    def _probe_data_rate(self, burst_frames):
+        # Returns the throughput in bytes/s from the host to the OSD or
+        # None if the link isn't reliable at the current rate
+        if not self._verify_data_rate():
+            return None
+        if self.send_buffer:
+            self.flush()
+        # CONTEXT_PUSH/CONTEXT_POP pairs don't change the OSD state
+        burst = bytearray([CMD.CONTEXT_PUSH, CMD.CONTEXT_POP] * (MAX_SEND_BUFFER_SIZE // 2))
+        start = time.time()
+        written = self.bytes_written
+        for ii in range(burst_frames):
+            self.send_commands(burst)
+            self.flush_send_buffer()
+        if not self._verify_data_rate():
+            return None
+        return (self.bytes_written - written) / (time.time() - start)
+
+    def _verify_data_rate(self):
+        errors = self._decoder.errors
+        try:
+            resp = self.get_info()
+        except IOError:
+            return False
+        return resp is not None and resp.cmd == CMD.INFO and self._decoder.errors == errors
+
+    def _fall_back_data_rate(self, rate, candidates):
+        # The OSD might have switched to the failed rate or stayed at
+        # the previous one, try to switch it to rate from both
+        for attempt in range(2):
+            for candidate in candidates:
+                self.baudrate = candidate
+                self.open()
+                try:
+                    self.set_data_rate(rate)
+                except (IOError, RuntimeError):
+                    pass
+                self.baudrate = rate
+                self.open()
+                if self._verify_data_rate():
+                    return
+        raise RuntimeError('lost connection to the OSD while changing its data rate, reboot it to restore {} bps'.format(BAUDRATE))
+
     # MSP
 
     def _msp_req(self, cmd, payload=None):
-        payload = payload or []
-        self._conn_write(b'$M<')
+        payload = bytearray(payload or [])
         size = len(payload)
-        self._conn_write(size)
         crc = size ^ cmd
-        self._conn_write(cmd)
         for b in payload:
             crc ^= b
-            self._conn_write(b)
-        self._conn_write(crc)
+        req = bytearray(b'$M<')
+        req.append(size)
+        req.append(cmd)
+        req.extend(payload)
+        req.append(crc)
+        self._conn_write(bytes(req))
 
         self._expect_marker('$')
         self._expect_marker('M')
         self._expect_marker('>')
 
-        resp_size = self._recv_byte()
-        resp_cmd = self._recv_byte()
+        resp_size, resp_cmd = bytearray(self._recv(2))
         if cmd != resp_cmd:
             print('invalid msp response to {} to request {}', resp_cmd, cmd)
             return None
 
+        data = bytearray(self._recv(resp_size + 1))
+        resp = data[:-1]
         resp_crc = resp_size ^ resp_cmd
-        resp = bytearray()
-        for ii in range(0, resp_size):
-            b = self._recv_byte()
-            resp.append(b)
+        for b in resp:
             resp_crc ^= b
 
-        resp_recv_crc = self._recv_byte()
+        resp_recv_crc = data[-1]
         if resp_crc != resp_recv_crc:
             print('received invalid MSP crc {}, expecting {}', resp_recv_crc, resp_crc)
             return None
@@ -1056,57 +2332,74 @@ class OSD:
         self.flush_send_buffer()
 
     def flush_send_buffer(self):
-        self._conn_write(b'$')
-        self._conn_write(b'A')
-        crc = 0
-        length = self._pack_uvarint(len(self.send_buffer))
-        for v in length:
-            crc = self._send_crc_byte(crc, v & 0xff)
-        for b in self.send_buffer:
-            crc = self._send_crc_byte(crc, b & 0xff)
-        self._conn_write(crc)
-        self.send_buffer = bytearray()
-
-    def _send_crc_byte(self, crc, b):
-        crc = self._crc8_dvb_s2(crc, b)
-        self._conn_write(b)
-        return crc
+        # Complete the frame around the commands in the buffer and
+        # send it without copying
+        n = self._frame_len
+        buf = self._frame
+        end = _FRAME_HEADER_SIZE + n
+        if n < 0x80:
+            start = 1
+            buf[3] = n
+        else:
+            start = 0
+            buf[2] = (n & 0x7f) | 0x80
+            buf[3] = n >> 7
+        buf[start] = 0x24 # $
+        buf[start + 1] = 0x41 # A
+        view = memoryview(buf)
+        buf[end] = crc8_dvb_s2(view[start + 2:end])
+        self._frame_len = 0
+        self._write_frame(view[start:end + 1])
+
+    def _write_frame(self, frame):
+        self.bytes_written += len(frame)
+        if self.wire_stats is None:
+            self._conn_write(frame)
+            return
+        start = _timer()
+        self._conn_write(frame)
+        self.wire_stats.frame(frame, _timer() - start)
+
+    def _encode_frame(self, data):
+        # Assemble the whole frame (header, length, commands and CRC)
+        # so it can be sent with a single write
+        frame = bytearray(b'$A')
+        frame.extend(self._pack_uvarint(len(data)))
+        frame.extend(data)
+        frame.append(crc8_dvb_s2(memoryview(frame)[2:]))
+        return bytes(frame)
+
+    def _recv(self, size):
+        data = self.conn.read(size)
+        if self.capture is not None:
+            self.capture.received(data)
+        if self.trace:
+            print('R<< {}'.format(_format_payload(bytearray(data))))
+        return data
 
     def _recv_byte(self):
-        r = self.conn.read()
-        b = r[0]
-        if isinstance(b, str):
-            b = struct.unpack('B', b)[0]
-        if self.trace:
-            print('R<< {0}\t({0:#04x} = {1!r})'.format(b, chr(b)))
-        return b
+        return _bytes_as_ints(self._recv(1))[0]
 
     def _expect_marker(self, mk, skip = 1):
-        while skip > 0:
-            b = self._recv_byte()
-            if b == ord(mk):
-                return True
-            skip -= 1
-        print("Unexpected marker {} ({}), expecting {}".format(chr(b), b, mk))
-        return False
+        skipped = self.conn.skip_until(_str_to_bytes(mk), skip)
+        if skipped < 0:
+            print("Unexpected data, expecting marker {}".format(mk))
+            return False
+        if self.trace:
+            if skipped > 0:
+                print('R<< ({} bytes skipped)'.format(skipped))
+            print('R<< {0}\t({0:#04x} = {1!r})'.format(ord(mk), mk))
+        return True
 
     def _conn_write(self, b):
-        if not isinstance(b, bytes):
+        if isinstance(b, int):
             b = _int_as_bytes(b)
+        if self.capture is not None:
+            self.capture.sent(b)
         if self.trace:
-            for bb in _bytes_as_ints(b):
-                print('W>> {0}\t({0:#04x} = {1!r})'.format(bb, chr(bb)))
+            print('W>> {}'.format(_format_payload(bytearray(b))))
         self.conn.write(b)
 
-    def _crc8_dvb_s2(self, crc, b):
-        crc ^= b
-        for ii in range(8):
-            if crc & 0x80:
-                crc = ((crc << 1) ^ 0xD5) & 0xff
-            else:
-                crc = (crc << 1) & 0xff
-        return crc
-
     def _crc32_ieee(self, data):
         # Python 2 will return a signed value that
         # we need to convert to unsigned. For Python3
@@ -1122,11 +2415,14 @@ if __name__ == '__main__':
     parser.add_argument('--debug', default=False, action='store_true', dest='debug', help='Print debugging information')
     parser.add_argument('--trace', default=False, action='store_true', dest='trace', help='Print all data sent/received')
     parser.add_argument('--upload-font', dest='upload_font', help='Font file to upload')
+    parser.add_argument('--sync-font', dest='sync_font', help='Font file to upload, skipping the characters already present in the OSD')
     parser.add_argument('--upload-program', dest='upload_program', help='Program file to upload for the VM')
     parser.add_argument('--download-program', dest='download_program', help='Download program from the VM and store it in the given file')
     parser.add_argument('--start-program', default=False, action='store_true', dest='start_program', help='Download program from the VM and store it in the given file')
     parser.add_argument('--erase', default=False, action='store_true', dest='erase', help='Erase firmware')
     parser.add_argument('--flash', dest='flash', help='Update file to flash')
+    parser.add_argument('--auto-data-rate', default=False, action='store_true', dest='auto_data_rate', help='Switch to the fastest data rate that works reliably before other operations')
+    parser.add_argument('--window', type=int, default=1, dest='window', help='Number of requests to keep in flight while flashing or uploading')
     parser.add_argument('--flash-nr', default=False, action='store_true', dest='flash_no_reboot', help='Skip rebooting into bootloader mode before flashing')
     parser.add_argument('--hw-version', default=False, action='store_true', dest='hw_version', help='Connect to OSD and print hardware version')
     parser.add_argument('--reboot', default=False, action='store_true', dest='reboot', help='Reboot the OSD')
@@ -1134,9 +2430,36 @@ if __name__ == '__main__':
     parser.add_argument('--msp-passthrough', default=False, action='store_true', dest='msp_passthrough', help='Use MSP passthrough via a INAV/Betaflight to connect to the OSD')
     parser.add_argument('--run', dest='run', help='Upload a program to the VM and start it')
     parser.add_argument('--run-function', dest='run_function', help='Run a function from the VM program. Syntax is <name>[,arg1]...[,argn]')
+    parser.add_argument('--capture', dest='capture', help='Record all data sent/received to the given file, see frskyosd.capture')
+    parser.add_argument('--replay', dest='replay', help='Send the commands recorded in the given capture file')
+    parser.add_argument('--replay-speed', type=float, default=1.0, dest='replay_speed', help='Replay speed relative to the capture, 0 to send as fast as possible')
+    parser.add_argument('--benchmark', nargs='?', const='-', dest='benchmark', help='Benchmark the SDK and write the results as JSON to the given file or stdout. Round trips are measured against the port, or a local mock OSD if the port is "mock"')
     args = parser.parse_args()
 
-    osd = OSD(args.port, msp_passthrough=args.msp_passthrough, debug=args.debug, trace=args.trace)
+    def import_tool(name):
+        # Tools import the SDK as a package, make it importable when
+        # invoked directly as a script
+        import importlib
+        if not __package__:
+            sdk_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            # Ahead of the script directory, where frskyosd is this module
+            if sdk_dir in sys.path:
+                sys.path.remove(sdk_dir)
+            sys.path.insert(0, sdk_dir)
+        return importlib.import_module('frskyosd.' + name)
+
+    capture = None
+    if args.capture:
+        capture = import_tool('capture').CaptureWriter(open(args.capture, 'wb'))
+
+    osd = OSD(args.port, msp_passthrough=args.msp_passthrough, debug=args.debug, trace=args.trace, capture=capture)
+
+    if args.replay:
+        capture_module = import_tool('capture')
+        with open(args.replay, 'rb') as f:
+            records = list(capture_module.read_capture(f))
+        results = capture_module.replay(records, args.port, speed=args.replay_speed or None, baudrate=osd.baudrate)
+        print('Sent {writes} writes ({bytes_sent} bytes), received {responses} of {expected_responses} responses in {elapsed:.2f}s'.format(**results))
 
     if args.reboot or args.reboot_to_bootloader:
         osd.open()
@@ -1149,22 +2472,32 @@ if __name__ == '__main__':
     if args.flash:
         osd.open()
         with open(args.flash, 'rb') as f:
-            osd.flash_firmware(f, args.flash_no_reboot)
+            osd.flash_firmware(f, args.flash_no_reboot, window=args.window)
+
+    if args.auto_data_rate:
+        osd.connect()
+        print('Using {} bps'.format(osd.auto_tune_data_rate()))
 
     if args.upload_font:
         osd.connect()
         with open(args.upload_font, 'rb') as f:
-            osd.upload_font(f)
+            osd.upload_font(f, window=args.window)
+
+    if args.sync_font:
+        osd.connect()
+        with open(args.sync_font, 'rb') as f:
+            skipped = osd.sync_font(f, window=args.window)
+        print('{} characters were already up to date'.format(skipped))
 
     if args.upload_program:
         osd.connect()
         with open(args.upload_program, 'rb') as f:
-            osd.upload_program(f)
+            osd.upload_program(f, window=args.window)
 
     if args.download_program:
         osd.connect()
         with open(args.download_program, 'wb') as f:
-            osd.download_program(f)
+            osd.download_program(f, window=args.window)
 
     if args.start_program:
         osd.connect()
@@ -1181,11 +2514,22 @@ if __name__ == '__main__':
     if args.run_function:
         osd.connect()
         values = args.run_function.split(',', 1)
-        args = None
+        fn_args = None
         if len(values) > 1:
-            args = values[1].split(',')
-        ret = osd.run_function(values[0], args)
+            fn_args = values[1].split(',')
+        ret = osd.run_function(values[0], fn_args)
         if ret is not None:
             print('return value: {}'.format(ret))
 
+    if args.benchmark:
+        bench = import_tool('bench')
+        results = bench.run(None if args.port == 'mock' else args.port)
+        if args.benchmark == '-':
+            bench.write_json(results, sys.stdout)
+        else:
+            with open(args.benchmark, 'w') as f:
+                bench.write_json(results, f)
+
     osd.close()
+    if capture is not None:
+        capture.close()
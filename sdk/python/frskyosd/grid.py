@@ -0,0 +1,104 @@
+from .frskyosd import _str_to_bytes
+
+BLANK = ord(' ')
+
+# Unchanged cells between two changed ones are resent when that's
+# cheaper than starting a new DRAW_GRID_STR_2 (3 bytes of overhead)
+_MAX_GAP = 2
+
+# DRAW_GRID_STR_2 can only draw characters that fit in a byte,
+# DRAW_GRID_CHR_2 is limited to 9 bits
+_MAX_STR_CHR = 255
+
+class GridBuffer(object):
+    '''Host side copy of the character grid. Writes are applied to the
+    buffer and flush() sends only the cells that differ from what the
+    OSD is displaying, coalescing adjacent cells into strings.'''
+
+    def __init__(self, osd, rows=None, columns=None):
+        self.osd = osd
+        self.rows = rows or osd.info.gridRows
+        self.columns = columns or osd.info.gridColumns
+        cells = self.rows * self.columns
+        # (chr, opts) for each cell, row major
+        self._cells = [(BLANK, 0)] * cells
+        # What the OSD is displaying. Assumes it starts blank, use
+        # invalidate() when that's not the case.
+        self._displayed = [(BLANK, 0)] * cells
+
+    def _index(self, col, row):
+        if col < 0 or col >= self.columns or row < 0 or row >= self.rows:
+            raise ValueError('cell ({}, {}) is out of the {}x{} grid'.format(col, row, self.columns, self.rows))
+        return row * self.columns + col
+
+    def put(self, col, row, ch, opts=None):
+        '''Set a single character'''
+        if isinstance(ch, str):
+            ch = ord(ch[0])
+        self._cells[self._index(col, row)] = (int(ch), opts or 0)
+
+    def write(self, col, row, s, opts=None):
+        '''Write a string starting at the given cell, clipped to the row'''
+        opts = opts or 0
+        idx = self._index(col, row)
+        for ii, ch in enumerate(bytearray(_str_to_bytes(s))[:self.columns - col]):
+            self._cells[idx + ii] = (ch, opts)
+
+    def get(self, col, row):
+        '''Returns the (chr, opts) tuple for the given cell'''
+        return self._cells[self._index(col, row)]
+
+    def clear(self, row=None):
+        '''Blank the whole buffer or just a row'''
+        if row is None:
+            self._cells = [(BLANK, 0)] * len(self._cells)
+        else:
+            idx = self._index(0, row)
+            self._cells[idx:idx + self.columns] = [(BLANK, 0)] * self.columns
+
+    def invalidate(self):
+        '''Forget what the OSD is displaying, forcing the next flush to
+        send every cell'''
+        self._displayed = [None] * len(self._cells)
+
+    def _runs(self, row):
+        # Yields (start, end) column ranges that need to be sent
+        start = None
+        end = None
+        base = row * self.columns
+        for col in range(self.columns):
+            idx = base + col
+            if self._cells[idx] == self._displayed[idx]:
+                continue
+            if start is not None and col - end <= _MAX_GAP and self._can_join(base, end, col + 1):
+                end = col + 1
+                continue
+            if start is not None:
+                yield start, end
+            start = col
+            end = col + 1
+        if start is not None:
+            yield start, end
+
+    def _can_join(self, base, start, end):
+        cells = self._cells[base + start - 1:base + end]
+        opts = cells[0][1]
+        return all(ch <= _MAX_STR_CHR and o == opts for ch, o in cells)
+
+    def flush(self):
+        '''Send the changed cells to the OSD. Returns the number of
+        commands sent'''
+        count = 0
+        for row in range(self.rows):
+            for start, end in self._runs(row):
+                base = row * self.columns
+                cells = self._cells[base + start:base + end]
+                if len(cells) == 1:
+                    ch, opts = cells[0]
+                    self.osd.draw_grid_chr(start, row, ch, opts)
+                else:
+                    s = bytearray(ch for ch, _ in cells)
+                    self.osd.draw_grid_str(start, row, s, cells[0][1])
+                self._displayed[base + start:base + end] = cells
+                count += 1
+        return count
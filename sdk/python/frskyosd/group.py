@@ -0,0 +1,192 @@
+'''Drive several OSDs with the same command stream. Requires Python 3.'''
+
+import concurrent.futures
+import struct
+import time
+
+from .frskyosd import CMD, OSD, RemoteResponseError, ResponseError
+
+class LatencyStats(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.min = elapsed if self.min is None else min(self.min, elapsed)
+        self.max = elapsed if self.max is None else max(self.max, elapsed)
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else None
+
+    def as_dict(self):
+        return {'count': self.count, 'avg': self.avg, 'min': self.min, 'max': self.max}
+
+class GroupMember(object):
+    '''An OSD in a group. A member that fails is disabled and its
+    error kept in error, without affecting the rest of the group.'''
+
+    def __init__(self, osd):
+        self.osd = osd
+        self.error = None
+        self.bytes_written = 0
+        self.writes = LatencyStats()
+        self.round_trips = LatencyStats()
+
+    @property
+    def active(self):
+        return self.error is None and self.osd.conn is not None
+
+    def stats(self):
+        return {
+            'port': self.osd.port,
+            'error': str(self.error) if self.error else None,
+            'bytes_written': self.bytes_written,
+            'writes': self.writes.as_dict(),
+            'round_trips': self.round_trips.as_dict(),
+        }
+
+def _per_member(name):
+    # Round trip functions whose responses can't be combined across
+    # the group
+    def fn(self, *args, **kwargs):
+        raise NotImplementedError('{0}() is not supported by OSDGroup, call it on each member, '
+                                  'e.g. group.members[i].osd.{0}()'.format(name))
+    fn.__name__ = name
+    return fn
+
+class OSDGroup(OSD):
+    '''Sends the same commands to every OSD in the group. Drawing
+    functions are called once on the group and each frame is encoded
+    once, then written to all the OSDs in parallel.
+
+    Functions that wait for a response return a list with the
+    response from each member (None for members that failed). Other
+    round trip functions (data rate, font uploads, flashing, VM...)
+    raise NotImplementedError and must be called on each member's
+    osd.'''
+
+    def __init__(self, osds, max_workers=None, **kwargs):
+        super(OSDGroup, self).__init__(None, **kwargs)
+        self.members = [GroupMember(osd) for osd in osds]
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers or len(self.members) or 1)
+
+    def _run(self, fn, members=None):
+        # Call fn(member) on every active member in parallel, returning
+        # a list with the results (None for failed members)
+        members = members if members is not None else self.members
+        futures = [(m, self._executor.submit(fn, m)) for m in members if m.error is None]
+        results = dict((m, None) for m in members)
+        for m, future in futures:
+            try:
+                results[m] = future.result()
+            except Exception as e:
+                m.error = e
+                if self.debug:
+                    print('disabling {}: {}'.format(m.osd.port, e))
+        return [results[m] for m in members]
+
+    def open(self):
+        return any(self._run(lambda m: m.osd.open()))
+
+    def connect(self, force=False):
+        '''Connect to all the OSDs. Returns True if at least one of them
+        connected. Members that couldn't connect are disabled.'''
+        for m in self.members:
+            if force:
+                m.error = None
+        results = self._run(lambda m: m.osd.connect(force))
+        for m, ok in zip(self.members, results):
+            if not ok and m.error is None:
+                m.error = RuntimeError('could not connect')
+        connected = [m.osd.info for m in self.members if m.error is None]
+        # Use the first device to decide which commands to encode
+        self.info = connected[0] if connected else None
+        return self.info is not None
+
+    def is_connected(self):
+        return self.info is not None and any(m.active for m in self.members)
+
+    def close(self):
+        if self.send_buffer:
+            self.flush()
+        self._run(lambda m: m.osd.close())
+        self._executor.shutdown()
+        if self.capture is not None:
+            self.capture.flush()
+
+    def _conn_write(self, b):
+        if self.capture is not None:
+            self.capture.sent(b)
+        if self.trace:
+            print('W>> {} bytes to {} OSDs'.format(len(b), len(self.active_members())))
+
+        def write(m):
+            start = time.time()
+            m.osd.conn.write(b)
+            m.writes.add(time.time() - start)
+            m.bytes_written += len(b)
+
+        self._run(write)
+
+    def _recv_response(self):
+        def recv(m):
+            start = time.time()
+            resp = m.osd._recv_response()
+            m.round_trips.add(time.time() - start)
+            return resp
+
+        return self._run(recv)
+
+    def _widget_set_config(self, wid, config):
+        payload = struct.pack('<B', wid) + config
+        resps = self.send_frame_sync_resp(CMD.WIDGET_SET_CONFIG, payload)
+        for m, resp in zip(self.members, resps):
+            if isinstance(resp, ResponseError) and m.error is None:
+                m.error = RemoteResponseError(resp, 'error configuring widget {}: {}'.format(wid, resp.error_code))
+        return resps
+
+    def get_active_camera(self):
+        resps = self.send_frame_sync_resp(CMD.GET_ACTIVE_CAMERA)
+        return [resp.byte_at(0) if resp is not None else None for resp in resps]
+
+    set_data_rate = _per_member('set_data_rate')
+    auto_tune_data_rate = _per_member('auto_tune_data_rate')
+    upload_font = _per_member('upload_font')
+    read_font = _per_member('read_font')
+    sync_font = _per_member('sync_font')
+    flash_firmware = _per_member('flash_firmware')
+    flash_firmware_bl = _per_member('flash_firmware_bl')
+    erase_firmware = _per_member('erase_firmware')
+    upload_program = _per_member('upload_program')
+    download_program = _per_member('download_program')
+    start_program = _per_member('start_program')
+    run_program = _per_member('run_program')
+    run_function = _per_member('run_function')
+
+    def active_members(self):
+        return [m for m in self.members if m.active]
+
+    def stats(self):
+        '''Returns a dict with the statistics for each member and
+        aggregated for the whole group'''
+        writes = LatencyStats()
+        round_trips = LatencyStats()
+        for m in self.members:
+            for src, dst in ((m.writes, writes), (m.round_trips, round_trips)):
+                if src.count:
+                    dst.count += src.count
+                    dst.total += src.total
+                    dst.min = src.min if dst.min is None else min(dst.min, src.min)
+                    dst.max = src.max if dst.max is None else max(dst.max, src.max)
+        return {
+            'members': [m.stats() for m in self.members],
+            'active': len(self.active_members()),
+            'bytes_written': sum(m.bytes_written for m in self.members),
+            'writes': writes.as_dict(),
+            'round_trips': round_trips.as_dict(),
+        }
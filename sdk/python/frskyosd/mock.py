@@ -0,0 +1,547 @@
+'''Local stand-in for an OSD, serving the UART API over TCP so it can
+be used with OSD('host:port'). The link is emulated with a configurable
+data rate, latency, jitter and bit errors.'''
+
+import binascii
+import collections
+import math
+import random
+import socket
+import struct
+import threading
+import time
+
+from .crc import crc8_dvb_s2
+from .frskyosd import (
+    BAUDRATE,
+    CHAR_HEIGHT,
+    CHAR_WIDTH,
+    CMD,
+    BufferedConn,
+    FLASH_WRITE_END,
+    FONT_CHAR_SIZE,
+    FrameDecoder,
+    _decode_uvarint,
+    iter_commands,
+)
+from .scheduler import BITS_PER_BYTE
+
+# Error code returned when the uploaded program is already stored
+ERROR_PROGRAM_EXISTS = -9
+ERROR_INVALID = -1
+
+# Bytes with pixel data at the start of each font character, the
+# metadata after them can be left out of WRITE_FONT
+_CHAR_DATA_SIZE = CHAR_WIDTH * CHAR_HEIGHT // 4
+
+_VM_STORAGE_HEADER_SIZE = 8
+
+# Config sizes by widget ID, used to validate WIDGET_SET_CONFIG
+_WIDGET_CONFIG_SIZES = {
+    0: 10,
+    1: 18,
+    2: 18,
+    3: 18,
+    4: 18,
+    5: 18,
+    6: 18,
+}
+
+def _frame(payload):
+    # Same encoding as OSD._encode_frame()
+    size = bytearray()
+    n = len(payload)
+    while n >= 0x80:
+        size.append((n & 0xff) | 0x80)
+        n >>= 7
+    size.append(n)
+    body = size + payload
+    return b'$A' + bytes(body) + struct.pack('<B', crc8_dvb_s2(body))
+
+class MockOSD(object):
+    '''Device state and command handling, independent of the
+    transport. handle() takes the payload of a frame and returns the
+    payloads of the responses.
+
+    Drawing commands are passed to canvas.execute() when a canvas is
+    given (e.g. a raster.Canvas). VM programs are stored and validated
+    but not run, vm_exec() returns the value for VM_EXEC calls.'''
+
+    def __init__(self, version=(2, 0, 0), grid=(30, 16), pixels=(360, 288), tv_standard=0,
+                 camera=1, context_stack_size=8, vm_storage_size=8192, symbols=None,
+                 max_data_rate=None, canvas=None):
+        self.version = version
+        self.grid = grid
+        self.pixels = pixels
+        self.tv_standard = tv_standard
+        self.camera = camera
+        self.context_stack_size = context_stack_size
+        self.max_data_rate = max_data_rate
+        self.canvas = canvas
+        self.symbols = dict(symbols or {})
+        self.font = {}
+        self.flash = bytearray()
+        self.vm_storage = bytearray(vm_storage_size)
+        self._vm_written = 0
+        self.widgets = {}
+        self.commands = collections.Counter()
+        self.reboot()
+
+    def reboot(self, to_bootloader=False):
+        self.bootloader = to_bootloader
+        self.data_rate = BAUDRATE
+
+    def handle(self, payload):
+        if self.canvas is not None and not self.bootloader:
+            self.canvas.execute(payload)
+        responses = []
+        for cmd, p in iter_commands(payload):
+            self.commands[cmd] += 1
+            handler = self._HANDLERS.get(cmd)
+            if handler is not None:
+                resp = handler(self, bytes(p))
+                if isinstance(resp, _ErrorResponse):
+                    responses.append(struct.pack('<B', CMD.ERROR) + resp)
+                elif resp is not None:
+                    responses.append(struct.pack('<B', cmd) + resp)
+        return responses
+
+    def _error(self, cmd, code):
+        # Returned as the payload of a CMD.ERROR response
+        return _ErrorResponse(struct.pack('<Bb', cmd, code))
+
+    def _info(self, p):
+        if self.bootloader:
+            return b'B'
+        major, minor, patch = self.version
+        columns, rows = self.grid
+        width, height = self.pixels
+        return b'AGH' + struct.pack('<BBBBBHHBBHB', major, minor, patch, rows, columns, width, height,
+                                    self.tv_standard, 1 if self.camera else 0, 254, self.context_stack_size)
+
+    def _read_font(self, p):
+        addr = struct.unpack('<H', p[:2])[0]
+        return p[:2] + self.font.get(addr, b'\x55' * FONT_CHAR_SIZE)
+
+    def _write_font(self, p):
+        if len(p) < 2 + _CHAR_DATA_SIZE:
+            return self._error(CMD.WRITE_FONT, ERROR_INVALID)
+        addr = struct.unpack('<H', p[:2])[0]
+        data = p[2:2 + FONT_CHAR_SIZE]
+        self.font[addr] = data + bytes(bytearray(FONT_CHAR_SIZE - len(data)))
+        # The firmware only acknowledges the character address
+        return p[:2]
+
+    def _get_active_camera(self, p):
+        return struct.pack('<B', self.camera)
+
+    def _widget_set_config(self, p):
+        wid = bytearray(p)[0]
+        if _WIDGET_CONFIG_SIZES.get(wid) != len(p) - 1:
+            return self._error(CMD.WIDGET_SET_CONFIG, ERROR_INVALID)
+        self.widgets[wid] = p[1:]
+        return p[:1]
+
+    def _reboot(self, p):
+        self.reboot(bool(bytearray(p)[0]) if p else False)
+
+    def _write_flash(self, p):
+        addr = struct.unpack('<L', p[:4])[0]
+        data = p[4:]
+        if addr == FLASH_WRITE_END:
+            return struct.pack('<L', 0)
+        if addr == 0:
+            # Start of a new image, also used to erase it
+            del self.flash[:]
+        if addr > len(self.flash):
+            return self._error(CMD.WRITE_FLASH, ERROR_INVALID)
+        self.flash[addr:addr + len(data)] = data
+        return struct.pack('<L', addr + len(data))
+
+    def _set_data_rate(self, p):
+        rate = struct.unpack('<I', p)[0] or BAUDRATE
+        if self.max_data_rate is not None:
+            rate = min(rate, self.max_data_rate)
+        # Takes effect after the response is sent
+        self.data_rate = rate
+        return struct.pack('<I', rate)
+
+    def _vm_storage_size(self, p):
+        return struct.pack('<L', len(self.vm_storage))
+
+    def _vm_storage_read(self, p):
+        offset, size = struct.unpack('<LL', p)
+        if offset + size > len(self.vm_storage):
+            return self._error(CMD.VM_STORAGE_READ, ERROR_INVALID)
+        return bytes(self.vm_storage[offset:offset + size])
+
+    def _vm_storage_write(self, p):
+        offset = struct.unpack('<L', p[:4])[0]
+        size, pos = _decode_uvarint(bytearray(p), 4)
+        data = p[pos:pos + size]
+        storage = self.vm_storage
+        if offset == 0:
+            if len(data) != _VM_STORAGE_HEADER_SIZE:
+                return self._error(CMD.VM_STORAGE_WRITE, ERROR_INVALID)
+            total_size = struct.unpack('<L', data[:4])[0]
+            if total_size > len(storage):
+                return self._error(CMD.VM_STORAGE_WRITE, ERROR_INVALID)
+            if storage[:_VM_STORAGE_HEADER_SIZE] == data and self._vm_written >= total_size:
+                return self._error(CMD.VM_STORAGE_WRITE, ERROR_PROGRAM_EXISTS)
+            if storage[:_VM_STORAGE_HEADER_SIZE] != data:
+                storage[:_VM_STORAGE_HEADER_SIZE] = data
+                self._vm_written = _VM_STORAGE_HEADER_SIZE
+            # Continue a previous upload of the same program
+            return struct.pack('<L', self._vm_written)
+        if offset > self._vm_written or offset + len(data) > len(storage):
+            return self._error(CMD.VM_STORAGE_WRITE, ERROR_INVALID)
+        storage[offset:offset + len(data)] = data
+        self._vm_written = max(self._vm_written, offset + len(data))
+        return struct.pack('<L', offset + len(data))
+
+    def _vm_program(self):
+        # Returns the stored program or None if it's not valid
+        total_size, crc = struct.unpack('<LL', bytes(self.vm_storage[:_VM_STORAGE_HEADER_SIZE]))
+        if total_size < _VM_STORAGE_HEADER_SIZE or total_size > self._vm_written:
+            return None
+        program = bytes(self.vm_storage[_VM_STORAGE_HEADER_SIZE:total_size])
+        if binascii.crc32(program) % (1 << 32) != crc:
+            return None
+        return program
+
+    def _vm_start(self, p):
+        if self._vm_program() is None:
+            return self._error(CMD.VM_START, ERROR_INVALID)
+        return struct.pack('<L', 0)
+
+    def _vm_lookup_symbol(self, p):
+        size, pos = _decode_uvarint(bytearray(p), 0)
+        name = p[pos:pos + size].rstrip(b'\0').decode('ascii')
+        sym = self.symbols.get(name)
+        if sym is None:
+            return self._error(CMD.VM_LOOKUP_SYMBOL, ERROR_INVALID)
+        return struct.pack('<h', sym)
+
+    def _vm_exec(self, p):
+        data = bytearray(p)
+        sym, pos = _decode_uvarint(data, 0)
+        nargs, pos = _decode_uvarint(data, pos)
+        args = struct.unpack('<{}L'.format(nargs), bytes(data[pos:pos + 4 * nargs]))
+        result = self.vm_exec(sym >> 1, args)
+        if sym & 1:
+            return struct.pack('<L', result & 0xffffffff)
+
+    def vm_exec(self, sym, args):
+        '''Returns the result of calling the function sym with the
+        given arguments, as unsigned 32 bit integers'''
+        return 0
+
+    _HANDLERS = {
+        CMD.INFO: _info,
+        CMD.READ_FONT: _read_font,
+        CMD.WRITE_FONT: _write_font,
+        CMD.GET_ACTIVE_CAMERA: _get_active_camera,
+        CMD.WIDGET_SET_CONFIG: _widget_set_config,
+        CMD.REBOOT: _reboot,
+        CMD.WRITE_FLASH: _write_flash,
+        CMD.SET_DATA_RATE: _set_data_rate,
+        CMD.VM_STORAGE_SIZE: _vm_storage_size,
+        CMD.VM_STORAGE_READ: _vm_storage_read,
+        CMD.VM_STORAGE_WRITE: _vm_storage_write,
+        CMD.VM_START: _vm_start,
+        CMD.VM_LOOKUP_SYMBOL: _vm_lookup_symbol,
+        CMD.VM_EXEC: _vm_exec,
+    }
+
+class _ErrorResponse(bytes):
+    # Payload for a CMD.ERROR response instead of the request's command
+    pass
+
+class _BitErrors(object):
+    # Flips each bit of a stream with probability ber. The distance to
+    # the next error is drawn instead of a random number per bit and
+    # kept between calls, so the errors don't depend on how the stream
+    # is split.
+
+    def __init__(self, seed):
+        self._rng = random.Random(seed)
+        self._ber = 0
+        self._skip = None
+
+    def _next_skip(self):
+        if self._ber >= 1:
+            return 0
+        return int(math.log(1 - self._rng.random()) / math.log(1 - self._ber))
+
+    def apply(self, data, ber):
+        if ber != self._ber:
+            self._ber = ber
+            self._skip = self._next_skip() if ber > 0 else None
+        if self._skip is None:
+            return data
+        data = bytearray(data)
+        nbits = len(data) * 8
+        pos = self._skip
+        while pos < nbits:
+            data[pos >> 3] ^= 1 << (pos & 7)
+            pos += 1 + self._next_skip()
+        self._skip = pos - nbits
+        return data
+
+class _Link(object):
+    # One direction of the emulated serial link
+
+    def __init__(self):
+        self.busy_until = 0
+
+    def transmit(self, size, start, data_rate):
+        # Returns when the last byte sent at start is received
+        start = max(start, self.busy_until)
+        self.busy_until = start + size * BITS_PER_BYTE / float(data_rate)
+        return self.busy_until
+
+class MockConn(BufferedConn):
+    '''Connection handing the frames directly to a MockOSD in the same
+    thread, without emulating the link:
+
+        osd = OSD('mock')
+        osd.conn = MockConn()
+        osd.info = osd.get_info()
+
+    bytes_out counts the bytes written by the OSD.'''
+
+    def __init__(self, device=None):
+        super(MockConn, self).__init__()
+        self.device = device if device is not None else MockOSD()
+        self.bytes_out = 0
+        self._decoder = FrameDecoder()
+        self._pending = bytearray()
+
+    def write(self, b):
+        self.bytes_out += len(b)
+        for payload in self._decoder.feed_payloads(b):
+            for resp in self.device.handle(payload):
+                self._pending.extend(_frame(bytearray(resp)))
+
+    def _read_available(self):
+        if not self._pending:
+            raise IOError('no response from the mock OSD')
+        data = bytes(self._pending)
+        del self._pending[:]
+        return data
+
+    def close(self):
+        pass
+
+class MockOSDServer(object):
+    '''Serves a MockOSD over TCP, emulating the timing and errors of
+    the serial link:
+
+        with MockOSDServer(latency=0.002, jitter=0.001) as server:
+            osd = OSD(server.address)
+            osd.connect()
+
+    Data in both directions is delayed by the time it takes to send
+    it at the device data rate, which changes after SET_DATA_RATE like
+    a real device. Each response is also delayed by latency plus a
+    random jitter between 0 and jitter seconds. bit_error_rate is the
+    probability of flipping each bit in either direction, either as a
+    number or a function taking the data rate. Use seed to make the
+    jitter and errors reproducible. With emulate_link=False data is
+    handled as soon as it arrives, to measure the host side alone.
+
+    The device state is kept across connections, since OSD reconnects
+    when it changes the data rate.'''
+
+    RECV_SIZE = 64
+
+    def __init__(self, device=None, host='127.0.0.1', port=0, latency=0, jitter=0, bit_error_rate=0, seed=None, emulate_link=True):
+        self.device = device if device is not None else MockOSD()
+        self.latency = latency
+        self.jitter = jitter
+        self.bit_error_rate = bit_error_rate
+        self.emulate_link = emulate_link
+        self._rng = random.Random(seed)
+        self._rx_errors = _BitErrors(self._rng.random())
+        self._tx_errors = _BitErrors(self._rng.random())
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(1)
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.responses = 0
+        self.crc_errors = 0
+
+    @property
+    def address(self):
+        host, port = self._sock.getsockname()[:2]
+        return '{}:{}'.format(host, port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        '''Serve in a background thread'''
+        self._running = True
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        try:
+            # Unblock accept()
+            socket.create_connection(self._sock.getsockname()[:2]).close()
+        except socket.error:
+            pass
+        if self._thread is not None:
+            self._thread.join()
+        self._sock.close()
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            conn, addr = self._sock.accept()
+            if not self._running:
+                conn.close()
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _bit_error_rate(self):
+        ber = self.bit_error_rate
+        return ber(self.device.data_rate) if callable(ber) else ber
+
+    def _serve(self, conn):
+        self.connections += 1
+        rx = _Link()
+        tx = _Link()
+        sender = _Sender(conn)
+        decoder = FrameDecoder()
+        try:
+            while self._running:
+                try:
+                    data = conn.recv(self.RECV_SIZE)
+                except socket.error:
+                    break
+                if not data:
+                    break
+                now = time.time()
+                self.bytes_in += len(data)
+                if self.emulate_link:
+                    ready = rx.transmit(len(data), now, self.device.data_rate)
+                    if ready > now:
+                        time.sleep(ready - now)
+                data = self._rx_errors.apply(data, self._bit_error_rate())
+                crc_errors = decoder.crc_errors
+                payloads = decoder.feed_payloads(data)
+                self.crc_errors += decoder.crc_errors - crc_errors
+                for payload in payloads:
+                    self.frames_in += 1
+                    with self._lock:
+                        self._handle(payload, tx, sender)
+        finally:
+            sender.close()
+            conn.close()
+
+    def _handle(self, payload, tx, sender):
+        device = self.device
+        data_rate = device.data_rate
+        for resp in device.handle(payload):
+            frame = _frame(bytearray(resp))
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            when = time.time() + delay
+            if self.emulate_link:
+                when = tx.transmit(len(frame), when, data_rate)
+            frame = self._tx_errors.apply(frame, self._bit_error_rate())
+            self.bytes_out += len(frame)
+            self.responses += 1
+            sender.send(when, frame)
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'responses': self.responses,
+            'crc_errors': self.crc_errors,
+            'data_rate': self.device.data_rate,
+        }
+
+class _Sender(object):
+    # Writes the responses to the connection at the time they're
+    # fully received by the host
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, when, data):
+        with self._cond:
+            self._queue.append((when, data))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                when, data = self._queue.popleft()
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._conn.sendall(bytes(data))
+            except socket.error:
+                return
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Mock OSD server, use host:port as the OSD port')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=7000, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added before each response')
+    parser.add_argument('--jitter', type=float, default=0, help='Maximum random delay in seconds added to the latency')
+    parser.add_argument('--bit-error-rate', type=float, default=0, dest='bit_error_rate', help='Probability of corrupting each bit')
+    parser.add_argument('--max-data-rate', type=int, dest='max_data_rate', help='Highest data rate accepted by SET_DATA_RATE')
+    parser.add_argument('--seed', type=int, help='Seed for the jitter and bit errors')
+    args = parser.parse_args()
+
+    device = MockOSD(max_data_rate=args.max_data_rate)
+    server = MockOSDServer(device, host=args.host, port=args.port, latency=args.latency,
+                           jitter=args.jitter, bit_error_rate=args.bit_error_rate, seed=args.seed)
+    print('Mock OSD listening on {}'.format(server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,696 @@
+'''Software rasterizer emulating the OSD canvas, allowing drawing code
+to be tested and profiled without a device. Requires NumPy.'''
+
+import collections
+import math
+import struct
+
+import numpy
+
+from . import ctm
+from .frskyosd import (
+    BITMAP_OPTS,
+    CHAR_HEIGHT,
+    CHAR_WIDTH,
+    CMD,
+    COLOR,
+    FONT_CHAR_SIZE,
+    OUTLINE,
+    FrameDecoder,
+    _decode_uvarint,
+    iter_commands,
+    parse_mcm,
+)
+
+# Bytes with pixel data at the start of each font character
+_CHAR_DATA_SIZE = CHAR_WIDTH * CHAR_HEIGHT // 4
+
+# Used when the device doesn't report its stack size
+_DEFAULT_CONTEXT_STACK_SIZE = 8
+
+# Outline bit and the offset of the outline pixels for each line pixel
+_OUTLINE_OFFSETS = (
+    (OUTLINE.TOP, 0, -1),
+    (OUTLINE.RIGHT, 1, 0),
+    (OUTLINE.BOTTOM, 0, 1),
+    (OUTLINE.LEFT, -1, 0),
+)
+
+# Gray levels used by to_pgm() for each color
+_PGM_LEVELS = numpy.array([0, 96, 255, 160], numpy.uint8)
+
+def _round(v):
+    return int(math.floor(v + 0.5))
+
+def _point(p, off=0):
+    v = p[off] | p[off + 1] << 8 | p[off + 2] << 16
+    x = v & 0xfff
+    y = v >> 12
+    # Sign extend the 12 bit coordinates
+    return (x - 0x1000 if x & 0x800 else x, y - 0x1000 if y & 0x800 else y)
+
+def _rect(p, off=0):
+    x, y = _point(p, off)
+    w, h = _point(p, off + 3)
+    # Normalize negative sizes
+    if w < 0:
+        x, w = x + w, -w
+    if h < 0:
+        y, h = y + h, -h
+    return x, y, w, h
+
+def _blob(p, off):
+    n, pos = _decode_uvarint(p, off)
+    return bytes(p[pos:pos + n])
+
+def _c_str(b):
+    idx = b.find(b'\0')
+    return b if idx < 0 else b[:idx]
+
+def _decode_bitmap(data, w, h):
+    # 2bpp, 4 pixels per byte starting at the MSB
+    data = numpy.frombuffer(bytes(data), numpy.uint8)
+    pixels = (data[:, None] >> numpy.array([6, 4, 2, 0], numpy.uint8)) & 3
+    pixels = pixels.reshape(-1)
+    if len(pixels) < w * h:
+        pixels = numpy.concatenate((pixels, numpy.full(w * h - len(pixels), COLOR.TRANSPARENT, numpy.uint8)))
+    return pixels[:w * h].reshape(h, w)
+
+def _line_pixels(x0, y0, x1, y1):
+    # One pixel per step along the major axis, rounding the other
+    # coordinate with integer arithmetic
+    steps = max(abs(x1 - x0), abs(y1 - y0))
+    if steps == 0:
+        return numpy.array([x0], numpy.int64), numpy.array([y0], numpy.int64)
+    t = numpy.arange(steps + 1, dtype=numpy.int64)
+    xs = x0 + (2 * (x1 - x0) * t + steps) // (2 * steps)
+    ys = y0 + (2 * (y1 - y0) * t + steps) // (2 * steps)
+    return xs, ys
+
+def _thicken(xs, ys, width):
+    if width <= 1:
+        return xs, ys
+    offsets = numpy.arange(width) - (width - 1) // 2
+    xs = (xs[:, None, None] + offsets[None, None, :]) + numpy.zeros((1, width, 1), numpy.int64)
+    ys = (ys[:, None, None] + offsets[None, :, None]) + numpy.zeros((1, 1, width), numpy.int64)
+    return xs.reshape(-1), ys.reshape(-1)
+
+class _Context(object):
+    # Drawing state saved by CONTEXT_PUSH
+
+    def __init__(self, width, height):
+        self.ctm = ctm.IDENTITY
+        self.invert = False
+        self.stroke_color = COLOR.WHITE
+        self.fill_color = COLOR.WHITE
+        self.stroke_width = 1
+        self.outline = OUTLINE.NONE
+        self.outline_color = COLOR.BLACK
+        self.cursor = (0, 0)
+        self.clip = (0, 0, width, height)
+
+    def copy(self):
+        c = _Context.__new__(_Context)
+        c.__dict__.update(self.__dict__)
+        return c
+
+class Canvas(object):
+    '''Renders the command stream sent to an OSD into a framebuffer.
+    pixels is a NumPy array indexed as [y, x] with the COLOR of each
+    pixel, sized from the OSD info. Use attach() to draw with an OSD:
+
+        canvas = Canvas(info, font=open('font.mcm', 'rb'))
+        osd = canvas.attach(OSD(None))
+        osd.stroke_rect((10, 10, 50, 20))
+        osd.flush()
+        canvas.pixels[10, 10] == COLOR.WHITE
+
+    Drawing inside a transaction goes to a back buffer, copied into
+    pixels on commit. Characters and bitmaps are positioned with the
+    CTM but not rotated or scaled. Commands that can't be emulated
+    (e.g. widgets or VM calls) are counted in ignored and don't
+    generate responses.'''
+
+    def __init__(self, info, font=None):
+        self.info = info
+        self.width = info.pixelWidth
+        self.height = info.pixelHeight
+        self.grid_width = self.width // info.gridColumns if info.gridColumns else CHAR_WIDTH
+        self.grid_height = self.height // info.gridRows if info.gridRows else CHAR_HEIGHT
+        self.stack_size = info.contextStackSize or _DEFAULT_CONTEXT_STACK_SIZE
+        self.pixels = numpy.full((self.height, self.width), COLOR.TRANSPARENT, numpy.uint8)
+        self._target = self.pixels
+        self._decoder = FrameDecoder()
+        self._glyphs = numpy.zeros((0, CHAR_HEIGHT, CHAR_WIDTH), numpy.uint8)
+        self.commands = 0
+        self.transactions = 0
+        self.missing_chars = 0
+        self.ignored = collections.Counter()
+        self._handlers = dict((cmd, getattr(self, name)) for cmd, name in self._HANDLERS.items())
+        if font is not None:
+            self.load_font(font)
+        self._reset()
+
+    def _reset(self):
+        self._ctx = _Context(self.width, self.height)
+        self._stack = []
+
+    # Fonts
+
+    def load_font(self, font):
+        '''Load a MAX7456 font in MCM format'''
+        data = parse_mcm(font)
+        for ii in range(len(data) // FONT_CHAR_SIZE):
+            self.set_char(ii, data[ii * FONT_CHAR_SIZE:(ii + 1) * FONT_CHAR_SIZE])
+
+    def set_char(self, ch, data):
+        '''Set the character at ch from its FONT_CHAR_SIZE bytes'''
+        if ch >= len(self._glyphs):
+            grow = numpy.full((ch + 1 - len(self._glyphs), CHAR_HEIGHT, CHAR_WIDTH), COLOR.TRANSPARENT, numpy.uint8)
+            self._glyphs = numpy.concatenate((self._glyphs, grow))
+        self._glyphs[ch] = _decode_bitmap(data[:_CHAR_DATA_SIZE], CHAR_WIDTH, CHAR_HEIGHT)
+
+    def _glyph(self, ch):
+        if ch < len(self._glyphs):
+            return self._glyphs[ch]
+        self.missing_chars += 1
+        return None
+
+    # Connection interface
+
+    def attach(self, osd):
+        '''Make osd draw into the canvas, returning it'''
+        osd.conn = self
+        osd.info = self.info
+        return osd
+
+    def write(self, b):
+        self.feed(b)
+
+    def close(self):
+        pass
+
+    def feed(self, data):
+        '''Feed data in the wire format, executing the commands of each
+        completed frame'''
+        for payload in self._decoder.feed_payloads(data):
+            self.execute(payload)
+
+    def execute(self, data):
+        '''Execute the commands in the payload of a frame'''
+        handlers = self._handlers
+        for cmd, payload in iter_commands(data):
+            self.commands += 1
+            handler = handlers.get(cmd)
+            if handler is None:
+                self.ignored[cmd] += 1
+            else:
+                handler(payload)
+
+    def to_pgm(self, f):
+        '''Write the canvas to f as a binary PGM image'''
+        f.write('P5\n{} {}\n255\n'.format(self.width, self.height).encode('ascii'))
+        f.write(_PGM_LEVELS[self.pixels].tobytes())
+
+    # Pixels
+
+    def _ink(self, color):
+        if self._ctx.invert and color in (COLOR.BLACK, COLOR.WHITE):
+            return COLOR.WHITE - color
+        return color
+
+    def _plot(self, xs, ys, color):
+        x0, y0, x1, y1 = self._ctx.clip
+        visible = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+        self._target[ys[visible], xs[visible]] = self._ink(color)
+
+    def _clip_box(self, x0, y0, x1, y1):
+        # Intersect the [x0, x1) [y0, y1) box with the clipping rect
+        cx0, cy0, cx1, cy1 = self._ctx.clip
+        return max(x0, cx0), max(y0, cy0), min(x1, cx1), min(y1, cy1)
+
+    def _transform(self, x, y):
+        tx, ty = ctm.apply(self._ctx.ctm, x, y)
+        return _round(tx), _round(ty)
+
+    def _axis_aligned(self):
+        m = self._ctx.ctm
+        return m[1] == 0 and m[2] == 0
+
+    # Lines and shapes
+
+    def _stroke_segment(self, p0, p1, outline=False):
+        c = self._ctx
+        xs, ys = _thicken(*(_line_pixels(p0[0], p0[1], p1[0], p1[1]) + (c.stroke_width,)))
+        if outline and c.outline:
+            ox = []
+            oy = []
+            for bit, dx, dy in _OUTLINE_OFFSETS:
+                if c.outline & bit:
+                    ox.append(xs + dx)
+                    oy.append(ys + dy)
+            ox = numpy.concatenate(ox)
+            oy = numpy.concatenate(oy)
+            # Outlines never cover the line itself
+            keep = ~numpy.isin((oy << 16) + ox, (ys << 16) + xs)
+            self._plot(ox[keep], oy[keep], c.outline_color)
+        self._plot(xs, ys, c.stroke_color)
+
+    def _stroke_polygon(self, points):
+        for ii in range(len(points)):
+            self._stroke_segment(points[ii - 1], points[ii])
+
+    def _fill_triangle(self, p1, p2, p3, color):
+        xs = (p1[0], p2[0], p3[0])
+        ys = (p1[1], p2[1], p3[1])
+        x0, y0, x1, y1 = self._clip_box(min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        py, px = numpy.mgrid[y0:y1, x0:x1]
+        inside_pos = numpy.ones(px.shape, bool)
+        inside_neg = numpy.ones(px.shape, bool)
+        for a, b in ((p1, p2), (p2, p3), (p3, p1)):
+            e = (b[0] - a[0]) * (py - a[1]) - (b[1] - a[1]) * (px - a[0])
+            inside_pos &= e >= 0
+            inside_neg &= e <= 0
+        inside = inside_pos | inside_neg
+        # Include the edges, covering thin triangles completely
+        edges = [_line_pixels(a[0], a[1], b[0], b[1]) for a, b in ((p1, p2), (p2, p3), (p3, p1))]
+        xs = numpy.concatenate([px[inside]] + [e[0] for e in edges])
+        ys = numpy.concatenate([py[inside]] + [e[1] for e in edges])
+        self._plot(xs, ys, color)
+
+    def _rect_corners(self, x, y, w, h):
+        return [self._transform(px, py) for px, py in ((x, y), (x + w - 1, y), (x + w - 1, y + h - 1), (x, y + h - 1))]
+
+    def _fill_rect(self, r, color):
+        x, y, w, h = r
+        if w == 0 or h == 0:
+            return
+        corners = self._rect_corners(x, y, w, h)
+        if self._axis_aligned():
+            xs = [p[0] for p in corners]
+            ys = [p[1] for p in corners]
+            x0, y0, x1, y1 = self._clip_box(min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+            if x0 < x1 and y0 < y1:
+                self._target[y0:y1, x0:x1] = self._ink(color)
+            return
+        self._fill_triangle(corners[0], corners[1], corners[2], color)
+        self._fill_triangle(corners[0], corners[2], corners[3], color)
+
+    def _stroke_rect(self, r):
+        x, y, w, h = r
+        if w == 0 or h == 0:
+            return
+        self._stroke_polygon(self._rect_corners(x, y, w, h))
+
+    def _ellipse_mask(self, cx, cy, rx, ry, x0, y0, x1, y1):
+        py, px = numpy.mgrid[y0:y1, x0:x1]
+        rx = max(rx, 0.5)
+        ry = max(ry, 0.5)
+        return px, py, ((px - cx) / rx) ** 2 + ((py - cy) / ry) ** 2 <= 1
+
+    def _ellipse_polygon(self, r):
+        x, y, w, h = r
+        cx = x + (w - 1) / 2.0
+        cy = y + (h - 1) / 2.0
+        rx = (w - 1) / 2.0
+        ry = (h - 1) / 2.0
+        n = max(16, int(math.pi * (rx + ry) / 2))
+        return [self._transform(cx + rx * math.cos(t), cy + ry * math.sin(t))
+                for t in (2 * math.pi * ii / n for ii in range(n))], self._transform(cx, cy)
+
+    def _draw_ellipse(self, r, fill, stroke):
+        x, y, w, h = r
+        if w == 0 or h == 0:
+            return
+        c = self._ctx
+        if not self._axis_aligned():
+            points, center = self._ellipse_polygon(r)
+            if fill:
+                for ii in range(len(points)):
+                    self._fill_triangle(center, points[ii - 1], points[ii], c.fill_color)
+            if stroke:
+                self._stroke_polygon(points)
+            return
+        m = c.ctm
+        cx, cy = ctm.apply(m, x + (w - 1) / 2.0, y + (h - 1) / 2.0)
+        rx = abs(m[0]) * (w - 1) / 2.0
+        ry = abs(m[3]) * (h - 1) / 2.0
+        x0, y0, x1, y1 = self._clip_box(int(math.floor(cx - rx)), int(math.floor(cy - ry)),
+                                        int(math.ceil(cx + rx)) + 1, int(math.ceil(cy + ry)) + 1)
+        if x0 >= x1 or y0 >= y1:
+            return
+        px, py, inside = self._ellipse_mask(cx, cy, rx, ry, x0, y0, x1, y1)
+        if fill:
+            self._plot(px[inside], py[inside], c.fill_color)
+        if stroke:
+            sw = c.stroke_width
+            if rx >= sw and ry >= sw:
+                inner = self._ellipse_mask(cx, cy, rx - sw, ry - sw, x0, y0, x1, y1)[2]
+                inside &= ~inner
+            self._plot(px[inside], py[inside], c.stroke_color)
+
+    # Bitmaps and characters
+
+    def _blit(self, x, y, bitmap, opts, mask_color=None, erase_first=False):
+        h, w = bitmap.shape
+        x0, y0, x1, y1 = self._clip_box(x, y, x + w, y + h)
+        if x0 >= x1 or y0 >= y1:
+            return
+        target = self._target[y0:y1, x0:x1]
+        if erase_first:
+            target[...] = COLOR.TRANSPARENT
+        values = bitmap[y0 - y:y1 - y, x0 - x:x1 - x].copy()
+        transparent = values == COLOR.TRANSPARENT
+        invert = bool(opts & BITMAP_OPTS.INVERSE) != self._ctx.invert
+        if mask_color is not None:
+            values[...] = self._ink(mask_color)
+            draw = ~transparent
+        else:
+            if invert:
+                bw = (values == COLOR.BLACK) | (values == COLOR.WHITE)
+                values[bw] = COLOR.WHITE - values[bw]
+            if opts & BITMAP_OPTS.SOLID_BG:
+                values[transparent] = COLOR.BLACK
+                draw = None
+            elif opts & BITMAP_OPTS.ERASE_TRANSPARENT:
+                draw = None
+            else:
+                draw = ~transparent
+        if draw is None:
+            target[...] = values
+        else:
+            target[draw] = values[draw]
+
+    def _draw_chars(self, x, y, chars, opts, mask_color=None, erase_first=False):
+        for ii, ch in enumerate(chars):
+            glyph = self._glyph(ch)
+            cx = x + ii * CHAR_WIDTH
+            if glyph is None:
+                if erase_first:
+                    x0, y0, x1, y1 = self._clip_box(cx, y, cx + CHAR_WIDTH, y + CHAR_HEIGHT)
+                    if x0 < x1 and y0 < y1:
+                        self._target[y0:y1, x0:x1] = COLOR.TRANSPARENT
+                continue
+            self._blit(cx, y, glyph, opts, mask_color, erase_first)
+
+    def _draw_grid(self, gx, gy, chars, opts, mask_color=None):
+        x = gx * self.grid_width
+        y = gy * self.grid_height
+        self._draw_chars(x, y, chars, opts, mask_color, erase_first=True)
+
+    # Command handlers
+
+    def _transaction_begin(self, p):
+        self.transactions += 1
+        self._target = self.pixels.copy()
+
+    def _transaction_commit(self, p):
+        if self._target is not self.pixels:
+            self.pixels[...] = self._target
+            self._target = self.pixels
+
+    def _set_stroke_color(self, p):
+        self._ctx.stroke_color = p[0]
+
+    def _set_fill_color(self, p):
+        self._ctx.fill_color = p[0]
+
+    def _set_stroke_and_fill_color(self, p):
+        self._ctx.stroke_color = self._ctx.fill_color = p[0]
+
+    def _set_color_inversion(self, p):
+        self._ctx.invert = bool(p[0])
+
+    def _set_pixel(self, p):
+        self._set_pixel_to(p, p[3])
+
+    def _set_pixel_to_stroke_color(self, p):
+        self._set_pixel_to(p, self._ctx.stroke_color)
+
+    def _set_pixel_to_fill_color(self, p):
+        self._set_pixel_to(p, self._ctx.fill_color)
+
+    def _set_pixel_to(self, p, color):
+        x, y = self._transform(*_point(p))
+        self._plot(numpy.array([x]), numpy.array([y]), color)
+
+    def _set_stroke_width(self, p):
+        self._ctx.stroke_width = p[0]
+
+    def _set_line_outline_type(self, p):
+        self._ctx.outline = p[0]
+
+    def _set_line_outline_color(self, p):
+        self._ctx.outline_color = p[0]
+
+    def _clip_to_rect(self, p):
+        x, y, w, h = _rect(p)
+        self._ctx.clip = (max(x, 0), max(y, 0), min(x + w, self.width), min(y + h, self.height))
+
+    def _clear_screen(self, p):
+        self._target[...] = COLOR.TRANSPARENT
+
+    def _clear_rect(self, p):
+        # Uses screen coordinates, ignoring the CTM and clipping
+        x, y, w, h = _rect(p)
+        self._target[max(y, 0):max(y + h, 0), max(x, 0):max(x + w, 0)] = COLOR.TRANSPARENT
+
+    def _drawing_reset(self, p):
+        self._reset()
+
+    def _draw_bitmap(self, p, mask=False):
+        x, y = self._transform(*_point(p))
+        w, h = _point(p, 3)
+        opts = p[6]
+        color = p[7] if mask else None
+        data = _blob(p, 8 if mask else 7)
+        if w > 0 and h > 0:
+            self._blit(x, y, _decode_bitmap(data, w, h), opts, color)
+
+    def _draw_bitmap_mask(self, p):
+        self._draw_bitmap(p, mask=True)
+
+    def _draw_char(self, p, mask=False):
+        x, y = self._transform(*_point(p))
+        ch, opts = struct.unpack('<HB', p[3:6])
+        self._draw_chars(x, y, [ch], opts, p[6] if mask else None)
+
+    def _draw_char_mask(self, p):
+        self._draw_char(p, mask=True)
+
+    def _draw_string(self, p, mask=False):
+        x, y = self._transform(*_point(p))
+        opts = p[3]
+        color = p[4] if mask else None
+        s = _c_str(_blob(p, 5 if mask else 4))
+        self._draw_chars(x, y, bytearray(s), opts, color)
+
+    def _draw_string_mask(self, p):
+        self._draw_string(p, mask=True)
+
+    def _move_to_point(self, p):
+        self._ctx.cursor = _point(p)
+
+    def _stroke_line_to_point(self, p):
+        c = self._ctx
+        point = _point(p)
+        self._stroke_segment(self._transform(*c.cursor), self._transform(*point), outline=True)
+        c.cursor = point
+
+    def _triangle_points(self, p):
+        return [self._transform(*_point(p, off)) for off in (0, 3, 6)]
+
+    def _stroke_triangle(self, p):
+        self._stroke_polygon(self._triangle_points(p))
+
+    def _fill_triangle_cmd(self, p):
+        self._fill_triangle(*(self._triangle_points(p) + [self._ctx.fill_color]))
+
+    def _fill_stroke_triangle(self, p):
+        points = self._triangle_points(p)
+        self._fill_triangle(*(points + [self._ctx.fill_color]))
+        self._stroke_polygon(points)
+
+    def _stroke_rect_cmd(self, p):
+        self._stroke_rect(_rect(p))
+
+    def _fill_rect_cmd(self, p):
+        self._fill_rect(_rect(p), self._ctx.fill_color)
+
+    def _fill_stroke_rect(self, p):
+        r = _rect(p)
+        self._fill_rect(r, self._ctx.fill_color)
+        self._stroke_rect(r)
+
+    def _stroke_ellipse_in_rect(self, p):
+        self._draw_ellipse(_rect(p), False, True)
+
+    def _fill_ellipse_in_rect(self, p):
+        self._draw_ellipse(_rect(p), True, False)
+
+    def _fill_stroke_ellipse_in_rect(self, p):
+        self._draw_ellipse(_rect(p), True, True)
+
+    def _ctm_compose(self, m, rev=False):
+        c = self._ctx
+        c.ctm = ctm.multiply(m, c.ctm) if rev else ctm.multiply(c.ctm, m)
+
+    def _ctm_reset(self, p):
+        self._ctx.ctm = ctm.IDENTITY
+
+    def _ctm_set(self, p):
+        self._ctx.ctm = struct.unpack('<6f', p)
+
+    def _ctm_translate(self, p, rev=False):
+        self._ctm_compose(ctm.translation(*struct.unpack('<ff', p)), rev)
+
+    def _ctm_scale(self, p, rev=False):
+        self._ctm_compose(ctm.scaling(*struct.unpack('<ff', p)), rev)
+
+    def _ctm_rotate(self, p, rev=False):
+        self._ctm_compose(ctm.rotation(struct.unpack('<f', p)[0]), rev)
+
+    def _ctm_rotate_about(self, p, rev=False):
+        r, cx, cy = struct.unpack('<fff', p)
+        self._ctm_compose(ctm.about(ctm.rotation(r), cx, cy), rev)
+
+    def _ctm_shear(self, p, rev=False):
+        self._ctm_compose(ctm.shearing(*struct.unpack('<ff', p)), rev)
+
+    def _ctm_shear_about(self, p, rev=False):
+        sx, sy, cx, cy = struct.unpack('<ffff', p)
+        self._ctm_compose(ctm.about(ctm.shearing(sx, sy), cx, cy), rev)
+
+    def _ctm_multiply(self, p, rev=False):
+        self._ctm_compose(struct.unpack('<6f', p), rev)
+
+    def _ctm_i16translate(self, p, rev=False):
+        self._ctm_compose(ctm.translation(*struct.unpack('<hh', p)), rev)
+
+    def _ctm_u16rotate(self, p, rev=False):
+        self._ctm_compose(ctm.rotation(struct.unpack('<H', p)[0] * 2 * math.pi / 0x10000), rev)
+
+    def _ctm_translate_rev(self, p):
+        self._ctm_translate(p, True)
+
+    def _ctm_scale_rev(self, p):
+        self._ctm_scale(p, True)
+
+    def _ctm_rotate_rev(self, p):
+        self._ctm_rotate(p, True)
+
+    def _ctm_rotate_about_rev(self, p):
+        self._ctm_rotate_about(p, True)
+
+    def _ctm_shear_rev(self, p):
+        self._ctm_shear(p, True)
+
+    def _ctm_shear_about_rev(self, p):
+        self._ctm_shear_about(p, True)
+
+    def _ctm_multiply_rev(self, p):
+        self._ctm_multiply(p, True)
+
+    def _ctm_i16translate_rev(self, p):
+        self._ctm_i16translate(p, True)
+
+    def _ctm_u16rotate_rev(self, p):
+        self._ctm_u16rotate(p, True)
+
+    def _context_push(self, p):
+        # The current context counts towards the stack size
+        if len(self._stack) + 1 < self.stack_size:
+            self._stack.append(self._ctx.copy())
+
+    def _context_pop(self, p):
+        if self._stack:
+            self._ctx = self._stack.pop()
+
+    def _draw_grid_chr(self, p):
+        gx, gy, ch, opts = struct.unpack('<BBHB', p)
+        self._draw_grid(gx, gy, [ch], opts)
+
+    def _draw_grid_str(self, p):
+        gx, gy, opts = struct.unpack('<BBB', p[:3])
+        self._draw_grid(gx, gy, bytearray(_c_str(_blob(p, 3))), opts)
+
+    def _draw_grid_chr_2(self, p):
+        v = p[0] | p[1] << 8 | p[2] << 16
+        mask_color = (v >> 22) & 3 if v & (1 << 21) else None
+        self._draw_grid(v & 31, (v >> 5) & 15, [(v >> 9) & 511], (v >> 18) & 7, mask_color)
+
+    def _draw_grid_str_2(self, p):
+        v = p[0] | p[1] << 8
+        n = v >> 12
+        s = bytes(p[2:2 + n]) if n else _blob(p, 2)
+        self._draw_grid(v & 31, (v >> 5) & 15, bytearray(s), (v >> 9) & 7)
+
+    def _write_font(self, p):
+        if len(p) >= 2 + _CHAR_DATA_SIZE:
+            self.set_char(struct.unpack('<H', p[:2])[0], bytes(p[2:]))
+
+    _HANDLERS = {
+        CMD.TRANSACTION_BEGIN: '_transaction_begin',
+        CMD.TRANSACTION_BEGIN_PROFILED: '_transaction_begin',
+        CMD.TRANSACTION_COMMIT: '_transaction_commit',
+        CMD.SET_STROKE_COLOR: '_set_stroke_color',
+        CMD.SET_FILL_COLOR: '_set_fill_color',
+        CMD.SET_STROKE_AND_FILL_COLOR: '_set_stroke_and_fill_color',
+        CMD.SET_COLOR_INVERSION: '_set_color_inversion',
+        CMD.SET_PIXEL: '_set_pixel',
+        CMD.SET_PIXEL_TO_STROKE_COLOR: '_set_pixel_to_stroke_color',
+        CMD.SET_PIXEL_TO_FILL_COLOR: '_set_pixel_to_fill_color',
+        CMD.SET_STROKE_WIDTH: '_set_stroke_width',
+        CMD.SET_LINE_OUTLINE_TYPE: '_set_line_outline_type',
+        CMD.SET_LINE_OUTLINE_COLOR: '_set_line_outline_color',
+        CMD.CLIP_TO_RECT: '_clip_to_rect',
+        CMD.CLEAR_SCREEN: '_clear_screen',
+        CMD.CLEAR_RECT: '_clear_rect',
+        CMD.DRAWING_RESET: '_drawing_reset',
+        CMD.DRAW_BITMAP: '_draw_bitmap',
+        CMD.DRAW_BITMAP_MASK: '_draw_bitmap_mask',
+        CMD.DRAW_CHAR: '_draw_char',
+        CMD.DRAW_CHAR_MASK: '_draw_char_mask',
+        CMD.DRAW_STRING: '_draw_string',
+        CMD.DRAW_STRING_MASK: '_draw_string_mask',
+        CMD.MOVE_TO_POINT: '_move_to_point',
+        CMD.STROKE_LINE_TO_POINT: '_stroke_line_to_point',
+        CMD.STROKE_TRIANGLE: '_stroke_triangle',
+        CMD.FILL_TRIANGLE: '_fill_triangle_cmd',
+        CMD.FILL_STROKE_TRIANGLE: '_fill_stroke_triangle',
+        CMD.STROKE_RECT: '_stroke_rect_cmd',
+        CMD.FILL_RECT: '_fill_rect_cmd',
+        CMD.FILL_STROKE_RECT: '_fill_stroke_rect',
+        CMD.STROKE_ELLIPSE_IN_RECT: '_stroke_ellipse_in_rect',
+        CMD.FILL_ELLIPSE_IN_RECT: '_fill_ellipse_in_rect',
+        CMD.FILL_STROKE_ELLIPSE_IN_RECT: '_fill_stroke_ellipse_in_rect',
+        CMD.CTM_RESET: '_ctm_reset',
+        CMD.CTM_SET: '_ctm_set',
+        CMD.CTM_TRANSLATE: '_ctm_translate',
+        CMD.CTM_SCALE: '_ctm_scale',
+        CMD.CTM_ROTATE: '_ctm_rotate',
+        CMD.CTM_ROTATE_ABOUT: '_ctm_rotate_about',
+        CMD.CTM_SHEAR: '_ctm_shear',
+        CMD.CTM_SHEAR_ABOUT: '_ctm_shear_about',
+        CMD.CTM_MULTIPLY: '_ctm_multiply',
+        CMD.CTM_TRANSLATE_REV: '_ctm_translate_rev',
+        CMD.CTM_SCALE_REV: '_ctm_scale_rev',
+        CMD.CTM_ROTATE_REV: '_ctm_rotate_rev',
+        CMD.CTM_ROTATE_ABOUT_REV: '_ctm_rotate_about_rev',
+        CMD.CTM_SHEAR_REV: '_ctm_shear_rev',
+        CMD.CTM_SHEAR_ABOUT_REV: '_ctm_shear_about_rev',
+        CMD.CTM_MULTIPLY_REV: '_ctm_multiply_rev',
+        CMD.CTM_I16TRANSLATE: '_ctm_i16translate',
+        CMD.CTM_U16ROTATE: '_ctm_u16rotate',
+        CMD.CTM_I16TRANSLATE_REV: '_ctm_i16translate_rev',
+        CMD.CTM_U16_ROTATE_REV: '_ctm_u16rotate_rev',
+        CMD.CONTEXT_PUSH: '_context_push',
+        CMD.CONTEXT_POP: '_context_pop',
+        CMD.DRAW_GRID_CHR: '_draw_grid_chr',
+        CMD.DRAW_GRID_STR: '_draw_grid_str',
+        CMD.DRAW_GRID_CHR_2: '_draw_grid_chr_2',
+        CMD.DRAW_GRID_STR_2: '_draw_grid_str_2',
+        CMD.WRITE_FONT: '_write_font',
+    }
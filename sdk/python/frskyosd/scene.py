@@ -0,0 +1,323 @@
+import collections
+
+from . import ctm
+from .frskyosd import CHAR_WIDTH, CHAR_HEIGHT, COLOR, OUTLINE
+
+# Pixels added around each node's bounds to account for
+# outlines and antialiasing
+_BOUNDS_MARGIN = 1
+
+_OPS = {
+    'translate': ctm.translation,
+    'scale': ctm.scaling,
+    'rotate': ctm.rotation,
+}
+
+def _transform_matrix(transform):
+    # CTM operations post-multiply the matrix, so with row vectors
+    # the first operation is the first one applied to the point
+    m = ctm.IDENTITY
+    for op in transform:
+        try:
+            fn = _OPS[op[0]]
+        except KeyError:
+            raise ValueError('invalid transform operation {}'.format(op[0]))
+        m = ctm.multiply(m, fn(*op[1:]))
+    return m
+
+def _rect_points(r):
+    x, y, w, h = r
+    return ((x, y), (x + w, y), (x, y + h), (x + w, y + h))
+
+def _bounds(points, margin=_BOUNDS_MARGIN):
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin)
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+class Node(object):
+    '''Base class for scene nodes. Nodes are compared by value, so
+    setting a node equal to the committed one doesn't generate any
+    commands. transform is an optional sequence of CTM operations
+    applied before drawing the node, in the same order the CTM
+    functions would be called: ('translate', tx, ty), ('scale', sx, sy)
+    or ('rotate', angle).'''
+
+    def __init__(self, transform=None):
+        self.transform = tuple(tuple(op) for op in (transform or ()))
+
+    def _args(self):
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.transform == other.transform and self._args() == other._args()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), self.transform, self._args()))
+
+    def _points(self):
+        '''Points enclosing the node, before applying the transform'''
+        raise NotImplementedError
+
+    def bounds(self):
+        '''Returns (x0, y0, x1, y1) in screen coordinates'''
+        m = _transform_matrix(self.transform)
+        points = [ctm.apply(m, x, y) for x, y in self._points()]
+        return _bounds(points)
+
+    def draw(self, osd, erase=False):
+        osd.context_push()
+        for op in self.transform:
+            getattr(osd, 'ctm_' + op[0])(*op[1:])
+        self._draw(osd, erase)
+        osd.context_pop()
+
+    def _draw(self, osd, erase):
+        raise NotImplementedError
+
+    def _color(self, color, erase):
+        return COLOR.TRANSPARENT if erase else color
+
+class Rect(Node):
+    '''A rectangle given as (x, y, w, h), filled and/or stroked'''
+
+    def __init__(self, rect, stroke=None, fill=None, transform=None):
+        super(Rect, self).__init__(transform)
+        self.rect = tuple(rect)
+        self.stroke = stroke
+        self.fill = fill
+
+    def _args(self):
+        return (self.rect, self.stroke, self.fill)
+
+    def _points(self):
+        return _rect_points(self.rect)
+
+    def draw(self, osd, erase=False):
+        if erase and not self.transform:
+            # Clearing the area is cheaper than filling it
+            x0, y0, x1, y1 = self.bounds()
+            osd.clear_rect((x0, y0, x1 - x0, y1 - y0))
+            return
+        super(Rect, self).draw(osd, erase)
+
+    def _draw(self, osd, erase):
+        if self.stroke is not None:
+            osd.set_stroke_color(self._color(self.stroke, erase))
+        if self.fill is not None:
+            osd.set_fill_color(self._color(self.fill, erase))
+        if self.stroke is not None and self.fill is not None:
+            self._fill_stroke(osd)
+        elif self.fill is not None:
+            self._fill(osd)
+        elif self.stroke is not None:
+            self._stroke(osd)
+
+    def _fill_stroke(self, osd):
+        osd.fill_stroke_rect(self.rect)
+
+    def _fill(self, osd):
+        osd.fill_rect(self.rect)
+
+    def _stroke(self, osd):
+        osd.stroke_rect(self.rect)
+
+class Ellipse(Rect):
+    '''An ellipse inscribed in the rectangle (x, y, w, h)'''
+
+    def draw(self, osd, erase=False):
+        # An ellipse can't be erased with CLEAR_RECT without
+        # also erasing its surroundings
+        Node.draw(self, osd, erase)
+
+    def _fill_stroke(self, osd):
+        osd.fill_stroke_ellipse_in_rect(self.rect)
+
+    def _fill(self, osd):
+        osd.fill_ellipse_in_rect(self.rect)
+
+    def _stroke(self, osd):
+        osd.stroke_ellipse_in_rect(self.rect)
+
+class Triangle(Node):
+    '''A triangle given by its 3 points, filled and/or stroked'''
+
+    def __init__(self, p1, p2, p3, stroke=None, fill=None, transform=None):
+        super(Triangle, self).__init__(transform)
+        self.points = (tuple(p1), tuple(p2), tuple(p3))
+        self.stroke = stroke
+        self.fill = fill
+
+    def _args(self):
+        return (self.points, self.stroke, self.fill)
+
+    def _points(self):
+        return self.points
+
+    def _draw(self, osd, erase):
+        if self.stroke is not None:
+            osd.set_stroke_color(self._color(self.stroke, erase))
+        if self.fill is not None:
+            osd.set_fill_color(self._color(self.fill, erase))
+        if self.stroke is not None and self.fill is not None:
+            osd.fill_stroke_triangle(*self.points)
+        elif self.fill is not None:
+            osd.fill_triangle(*self.points)
+        elif self.stroke is not None:
+            osd.stroke_triangle(*self.points)
+
+class Line(Node):
+    '''A polyline going through all the given points. With
+    outline_color=None the outline uses the current outline color.'''
+
+    def __init__(self, points, color, outline_type=OUTLINE.NONE, outline_color=None, width=1, transform=None):
+        super(Line, self).__init__(transform)
+        self.line_points = tuple(tuple(p) for p in points)
+        if len(self.line_points) < 2:
+            raise ValueError('a line needs at least 2 points')
+        self.color = color
+        self.outline_type = outline_type
+        self.outline_color = outline_color
+        self.width = width
+
+    def _args(self):
+        return (self.line_points, self.color, self.outline_type, self.outline_color, self.width)
+
+    def _points(self):
+        return self.line_points
+
+    def bounds(self):
+        x0, y0, x1, y1 = super(Line, self).bounds()
+        m = self.width + (1 if self.outline_type != OUTLINE.NONE else 0)
+        return (x0 - m, y0 - m, x1 + m, y1 + m)
+
+    def _draw(self, osd, erase):
+        # The context is inherited from the caller, so set everything
+        # the line depends on
+        osd.set_stroke_color(self._color(self.color, erase))
+        osd.set_stroke_width(self.width)
+        osd.set_line_outline_type(self.outline_type)
+        if self.outline_type != OUTLINE.NONE:
+            if erase:
+                osd.set_line_outline_color(COLOR.TRANSPARENT)
+            elif self.outline_color is not None:
+                osd.set_line_outline_color(self.outline_color)
+        osd.move_to_point(*self.line_points[0])
+        for p in self.line_points[1:]:
+            osd.stroke_line_to_point(*p)
+
+class String(Node):
+    '''A string drawn with its top left corner at (x, y)'''
+
+    def __init__(self, x, y, s, opts=None, transform=None):
+        super(String, self).__init__(transform)
+        self.x = x
+        self.y = y
+        self.s = s
+        self.opts = opts or 0
+
+    def _args(self):
+        return (self.x, self.y, self.s, self.opts)
+
+    def _points(self):
+        return _rect_points((self.x, self.y, len(self.s) * CHAR_WIDTH, CHAR_HEIGHT))
+
+    def _draw(self, osd, erase):
+        if erase:
+            osd.draw_str_mask(self.x, self.y, self.s, COLOR.TRANSPARENT, self.opts)
+        else:
+            osd.draw_str(self.x, self.y, self.s, self.opts)
+
+class Char(Node):
+    '''A single character drawn with its top left corner at (x, y)'''
+
+    def __init__(self, x, y, ch, opts=None, transform=None):
+        super(Char, self).__init__(transform)
+        if isinstance(ch, str):
+            ch = ord(ch[0])
+        self.x = x
+        self.y = y
+        self.ch = int(ch)
+        self.opts = opts or 0
+
+    def _args(self):
+        return (self.x, self.y, self.ch, self.opts)
+
+    def _points(self):
+        return _rect_points((self.x, self.y, CHAR_WIDTH, CHAR_HEIGHT))
+
+    def _draw(self, osd, erase):
+        if erase:
+            osd.draw_chr_mask(self.x, self.y, self.ch, COLOR.TRANSPARENT, self.opts)
+        else:
+            osd.draw_chr(self.x, self.y, self.ch, self.opts)
+
+class Scene(object):
+    '''Retained mode drawing on top of an OSD. Nodes are added under a
+    key and kept until they're removed. Each commit() compares the scene
+    against the previously committed one, erasing the nodes that changed
+    or were removed and drawing the ones that changed or were added.
+    Unchanged nodes are only redrawn when they overlap with an erased
+    area or are above a node that was redrawn.'''
+
+    def __init__(self, osd):
+        self.osd = osd
+        self._nodes = collections.OrderedDict()
+        self._committed = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        return self._nodes[key]
+
+    def __contains__(self, key):
+        return key in self._nodes
+
+    def set(self, key, node):
+        '''Add or replace the node identified by key. New nodes are
+        drawn above the existing ones'''
+        self._nodes[key] = node
+
+    def remove(self, key):
+        self._nodes.pop(key, None)
+
+    def clear(self):
+        self._nodes.clear()
+
+    def invalidate(self):
+        '''Forget what was committed, e.g. after the screen was cleared.
+        The next commit will draw every node.'''
+        self._committed.clear()
+
+    def commit(self, transaction=True):
+        '''Send the commands needed to update the screen. Returns a tuple
+        with the number of erased and drawn nodes'''
+        prev = self._committed
+        cur = self._nodes
+        erase = [node for key, node in prev.items() if cur.get(key) != node]
+        changed = set(key for key, node in cur.items() if prev.get(key) != node)
+        if not erase and not changed:
+            return (0, 0)
+
+        if transaction:
+            self.osd.transaction_begin()
+        erased = []
+        for node in erase:
+            node.draw(self.osd, erase=True)
+            erased.append(node.bounds())
+        drawn = []
+        ndrawn = 0
+        for key, node in cur.items():
+            bounds = node.bounds()
+            if key in changed or any(_intersects(bounds, b) for b in erased) or \
+                    any(_intersects(bounds, b) for b in drawn):
+                node.draw(self.osd)
+                drawn.append(bounds)
+                ndrawn += 1
+        if transaction:
+            self.osd.transaction_commit()
+        self._committed = collections.OrderedDict(cur)
+        return (len(erase), ndrawn)
@@ -0,0 +1,95 @@
+import time
+
+# Start, 8 data bits and stop bit for each byte on a serial link
+BITS_PER_BYTE = 10
+
+# Weight of the last frame when estimating the size of the next one
+_SIZE_ALPHA = 0.25
+
+class FrameScheduler(object):
+    '''Paces drawing to a target frame rate without exceeding the
+    link bandwidth. The link is modeled from the OSD data rate: each
+    frame keeps it busy for its size in bits divided by the rate.
+    A frame is only drawn when the data already written plus the
+    estimated size of the frame can be sent before the next frame is
+    due. Otherwise the frame is dropped rather than queued, so values
+    are read when the link can actually take them and never arrive
+    late.
+
+    Drawing is done by a callback. Drawing code that tracks what is
+    on screen (e.g. Scene or GridBuffer) merges the dropped frames
+    into the next one, since its commit() sends the differences
+    against the last frame that was actually sent.'''
+
+    def __init__(self, osd, fps=10, rate=None):
+        self.osd = osd
+        self.fps = fps
+        # Link rate in bytes/s, derived from the OSD data rate if None
+        self.rate = rate
+        self.frame_size = None
+        self.frames = 0
+        self.dropped = 0
+        self._busy_until = 0
+
+    @property
+    def interval(self):
+        return 1.0 / self.fps
+
+    def _byte_time(self):
+        return 1.0 / (self.rate or float(self.osd.baudrate) / BITS_PER_BYTE)
+
+    def backlog(self, now=None):
+        '''Returns the estimated time in seconds the link needs to
+        send the data already written'''
+        now = time.time() if now is None else now
+        return max(0, self._busy_until - now)
+
+    def ready(self, now=None):
+        '''Returns True if a frame can be sent now'''
+        expected = (self.frame_size or 0) * self._byte_time()
+        # Frames taking longer than the interval to send are allowed
+        # once the link is idle, lowering the frame rate
+        return self.backlog(now) + expected <= max(self.interval, expected)
+
+    def frame(self, draw):
+        '''Call draw() and send the commands it generates if the link
+        has room for them, otherwise drop the frame. Returns True if
+        the frame was sent.'''
+        now = time.time()
+        if not self.ready(now):
+            self.dropped += 1
+            return False
+        start = self.osd.bytes_written
+        draw()
+        if self.osd.send_buffer:
+            self.osd.flush()
+        size = self.osd.bytes_written - start
+        self._busy_until = max(now, self._busy_until) + size * self._byte_time()
+        if self.frame_size is None:
+            self.frame_size = size
+        else:
+            self.frame_size += (size - self.frame_size) * _SIZE_ALPHA
+        self.frames += 1
+        return True
+
+    def run(self, draw, frames=None):
+        '''Call frame(draw) at the target frame rate, forever or until
+        the given number of frames has been sent. When running late,
+        missed frames are skipped instead of sent in a burst.'''
+        due = time.time()
+        while frames is None or self.frames < frames:
+            self.frame(draw)
+            due += self.interval
+            now = time.time()
+            if due < now:
+                due = now
+            else:
+                time.sleep(due - now)
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'frame_size': self.frame_size,
+            'backlog': self.backlog(),
+        }
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The SDK isn't installed, import frskyosd and the demos from the
+# directory above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
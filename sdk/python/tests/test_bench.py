@@ -0,0 +1,41 @@
+'''pytest-benchmark versions of the frskyosd.bench encoding and scene
+benchmarks. Run them from the SDK directory with:
+
+    python -m pytest tests --benchmark-json results.json'''
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from frskyosd import bench
+
+def _scene_cases():
+    for module_name, cls, names in bench.SCENES:
+        for name in names:
+            yield module_name, cls, name
+
+@pytest.mark.parametrize('name,fn', bench.PRIMITIVES, ids=[name for name, fn in bench.PRIMITIVES])
+def test_encode(benchmark, name, fn):
+    osd = bench._mock_osd()
+    conn = bench._CountingConn()
+    osd.conn = conn
+    benchmark(fn, osd)
+    osd.flush_send_buffer()
+    if not name.startswith('_pack'):
+        assert conn.bytes_out > 0
+
+@pytest.mark.parametrize('module_name,cls,name', list(_scene_cases()),
+                         ids=['{}.{}'.format(m, n) for m, c, n in _scene_cases()])
+def test_scene(benchmark, module_name, cls, name):
+    module = pytest.importorskip(module_name)
+    osd = bench._mock_osd()
+    draw = bench._scene_draw(module, cls, name, osd)
+    # First frame against the mock, since widgets configure themselves
+    # with round trips
+    draw()
+    osd.flush_send_buffer()
+    conn = bench._CountingConn()
+    osd.conn = conn
+    benchmark(draw)
+    osd.flush_send_buffer()
+    assert conn.bytes_out > 0
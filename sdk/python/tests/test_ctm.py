@@ -0,0 +1,122 @@
+import math
+
+import pytest
+
+from frskyosd import CMD, OSD, MockConn, bench, ctm
+
+def _scene_cases():
+    for module_name, cls, names in bench.SCENES:
+        for name in names:
+            yield module_name, cls, name
+
+def _render(module, cls, name, **kwargs):
+    # Returns the bytes sent and the pixels of three frames of a scene
+    raster = pytest.importorskip('frskyosd.raster')
+
+    class CountingCanvas(raster.Canvas):
+        bytes_out = 0
+
+        def write(self, b):
+            self.bytes_out += len(b)
+            raster.Canvas.write(self, b)
+
+    osd = OSD('mock', **kwargs)
+    osd.conn = MockConn()
+    osd.info = osd.get_info()
+    draw = bench._scene_draw(module, cls, name, osd)
+    # First frame against the mock, since widgets configure themselves
+    # with round trips
+    draw()
+    osd.flush_send_buffer()
+    canvas = CountingCanvas(osd.info)
+    osd.conn = canvas
+    for ii in range(3):
+        draw()
+    osd.flush_send_buffer()
+    return canvas.bytes_out, canvas.pixels
+
+@pytest.mark.parametrize('options', [{}, {'ctm_tolerance': None}, {'track_state': True}],
+                         ids=['compact', 'float', 'track_state'])
+@pytest.mark.parametrize('module_name,cls,name', list(_scene_cases()),
+                         ids=['{}.{}'.format(m, n) for m, c, n in _scene_cases()])
+def test_compose_ctm_scenes(module_name, cls, name, options):
+    module = pytest.importorskip(module_name)
+    plain_bytes, plain_pixels = _render(module, cls, name, **options)
+    composed_bytes, composed_pixels = _render(module, cls, name, compose_ctm=True, **options)
+    assert composed_bytes <= plain_bytes
+    assert (composed_pixels == plain_pixels).all()
+
+def _mock_osd(**kwargs):
+    osd = OSD('mock', **kwargs)
+    osd.conn = MockConn()
+    osd.info = osd.get_info()
+    return osd
+
+def test_compose_ctm_rotation_uses_compact_commands():
+    osd = _mock_osd(compose_ctm=True)
+    osd.drawing_reset()
+    osd.ctm_translate(180, 144)
+    osd.ctm_rotate(math.pi / 2)
+    osd.ctm_translate(10, 0)
+    osd.fill_rect((0, 0, 5, 5))
+    cmds = bytes(osd.send_buffer)
+    assert CMD.CTM_SET not in bytearray(cmds)
+    assert len(cmds) <= 1 + 3 + 5 + 7
+
+def test_compose_ctm_push_pop():
+    osd = _mock_osd(compose_ctm=True)
+    tracker = osd.ctm_tracker
+    osd.drawing_reset()
+    osd.ctm_translate(10, 20)
+    osd.context_push()
+    osd.ctm_scale(2, 2)
+    osd.fill_rect((0, 0, 5, 5))
+    assert ctm.equal(tracker.device, ctm.multiply(ctm.translation(10, 20), ctm.scaling(2, 2)))
+    osd.context_pop()
+    assert ctm.equal(tracker.device, ctm.translation(10, 20))
+    # Operations inside a context that draws nothing are never sent
+    osd.flush_send_buffer()
+    osd.context_push()
+    osd.ctm_rotate(1)
+    osd.context_pop()
+    assert bytes(osd.send_buffer) == bytes(bytearray([CMD.CONTEXT_PUSH, CMD.CONTEXT_POP]))
+
+def _op_size(op):
+    # Command plus float32 arguments
+    return 1 + 4 * (len(op) - 1)
+
+def test_tracker_push_pop():
+    tracker = ctm.CTMTracker()
+    tracker.drawing_reset()
+    tracker.compose(('translate', 10, 20))
+    assert tracker.update(_op_size) == [('translate', 10, 20)]
+    tracker.push()
+    tracker.compose(('scale', 2, 2))
+    assert tracker.update(_op_size) == [('scale', 2, 2)]
+    tracker.pop()
+    assert ctm.equal(tracker.device, ctm.translation(10, 20))
+    # The OSD restores the CTM when popping too
+    assert tracker.update(_op_size) == []
+
+def test_tracker_pop_restores_pending_ops():
+    tracker = ctm.CTMTracker()
+    tracker.drawing_reset()
+    tracker.compose(('translate', 10, 20))
+    tracker.push()
+    tracker.compose(('rotate', 1))
+    tracker.pop()
+    assert tracker.update(_op_size) == [('translate', 10, 20)]
+
+def test_tracker_pop_past_start_forgets():
+    tracker = ctm.CTMTracker()
+    tracker.drawing_reset()
+    tracker.pop()
+    assert tracker.device is None and tracker.logical is None
+    # Reversed operations can't be composed with an unknown CTM
+    assert not tracker.compose(('translate_rev', 1, 2))
+    assert tracker.compose(('translate', 1, 2))
+    assert tracker.compose(('translate', 3, 4))
+    ops = tracker.update(_op_size)
+    assert len(ops) == 1
+    m, rev = ctm.op_matrix(ops[0])
+    assert not rev and ctm.equal(m, ctm.translation(4, 6))
@@ -0,0 +1,94 @@
+import pytest
+
+from frskyosd import CMD, COLOR, OSD, DisplayList, MockConn
+
+def _mock_osd(**kwargs):
+    osd = OSD('mock', **kwargs)
+    osd.conn = MockConn()
+    osd.info = osd.get_info()
+    return osd
+
+def _draw(osd, x, y, color, text, value):
+    osd.set_stroke_color(color)
+    osd.move_to_point(x, y)
+    osd.stroke_line_to_point(10, 20)
+    osd.fill_triangle((x, y), (1, 2), (x, y))
+    osd.fill_rect((x, y, 5, 6))
+    osd.draw_str(x, y, text.ljust(8, '\0'))
+    osd.draw_chr_mask(x, y, 'A', color)
+    osd.widget_sidebar_draw(0, value)
+
+@pytest.fixture
+def recorded():
+    osd = _mock_osd()
+    dl = DisplayList(osd)
+    p = dl.point('p')
+    color = dl.color('color', COLOR.WHITE)
+    text = dl.string('text', 8, 'abc')
+    value = dl.i24('value')
+    with dl.record() as r:
+        r.set_stroke_color(color)
+        r.move_to_point(*p)
+        r.stroke_line_to_point(10, 20)
+        r.fill_triangle(p, (1, 2), p)
+        r.fill_rect((p, p, 5, 6))
+        r.draw_str(p, p, text)
+        r.draw_chr_mask(p, p, 'A', color)
+        r.widget_sidebar_draw(0, value)
+    return osd, dl
+
+@pytest.mark.parametrize('x,y,color,text,value', [
+    (3, -4, COLOR.BLACK, 'hello', -5),
+    (300, 200, COLOR.GRAY, 'abcdefgh', 70000),
+])
+def test_replay_matches_drawing(recorded, x, y, color, text, value):
+    osd, dl = recorded
+    dl.replay(p=(x, y), color=color, text=text, value=value)
+    expected = _mock_osd()
+    _draw(expected, x, y, color, text, value)
+    assert osd.send_buffer == expected.send_buffer
+
+def test_update_keeps_other_slots(recorded):
+    osd, dl = recorded
+    dl.update(p=(7, 8), text='x', value=1)
+    dl.replay(color=COLOR.BLACK)
+    expected = _mock_osd()
+    _draw(expected, 7, 8, COLOR.BLACK, 'x', 1)
+    assert osd.send_buffer == expected.send_buffer
+
+def test_slot_values_are_checked(recorded):
+    osd, dl = recorded
+    with pytest.raises(ValueError):
+        dl.update(text='too long for the slot')
+    with pytest.raises(ValueError):
+        dl.update(missing=1)
+    with pytest.raises(RuntimeError):
+        dl.update(color=COLOR._MAX + 1)
+
+def test_long_lists_are_split_into_frames():
+    osd = _mock_osd()
+    dl = DisplayList(osd)
+    p = dl.point('p')
+    with dl.record() as r:
+        for ii in range(200):
+            r.move_to_point(*p)
+    dl.replay(p=(1, 2))
+    osd.flush_send_buffer()
+    assert osd.conn.device.commands[CMD.MOVE_TO_POINT] == 200
+
+def test_replay_invalidates_tracked_state():
+    osd = _mock_osd(track_state=True)
+    dl = DisplayList(osd)
+    color = dl.color('color', COLOR.WHITE)
+    with dl.record() as r:
+        r.set_fill_color(color)
+    osd.drawing_reset()
+    osd.set_fill_color(COLOR.BLACK)
+    dl.replay()
+    osd.set_fill_color(COLOR.BLACK)
+    expected = _mock_osd()
+    expected.drawing_reset()
+    expected.set_fill_color(COLOR.BLACK)
+    expected.set_fill_color(COLOR.WHITE)
+    expected.set_fill_color(COLOR.BLACK)
+    assert osd.send_buffer == expected.send_buffer
@@ -0,0 +1,89 @@
+from frskyosd import COLOR, OSD, OUTLINE, MockConn, MockOSD
+
+def _mock_osd(**kwargs):
+    osd = OSD('mock', **kwargs)
+    osd.conn = MockConn(MockOSD(symbols={'draw': 3}))
+    osd.info = osd.get_info()
+    return osd
+
+def test_repeated_state_is_elided():
+    osd = _mock_osd(track_state=True)
+    osd.drawing_reset()
+    osd.set_stroke_color(COLOR.WHITE)
+    osd.set_stroke_color(COLOR.WHITE)
+    osd.set_stroke_width(2)
+    osd.set_stroke_width(2)
+    osd.set_color_inversion(False)
+    expected = _mock_osd()
+    expected.drawing_reset()
+    expected.set_stroke_color(COLOR.WHITE)
+    expected.set_stroke_width(2)
+    assert osd.send_buffer == expected.send_buffer
+    assert osd.saved_bytes == 2 + 2 + 2
+
+def test_unknown_state_is_sent():
+    osd = _mock_osd(track_state=True)
+    osd.set_color_inversion(False)
+    osd.set_fill_color(COLOR.BLACK)
+    osd.set_fill_color(COLOR.BLACK)
+    expected = _mock_osd()
+    expected.set_color_inversion(False)
+    expected.set_fill_color(COLOR.BLACK)
+    assert osd.send_buffer == expected.send_buffer
+
+def test_stroke_and_fill_color():
+    osd = _mock_osd(track_state=True)
+    osd.set_stroke_and_fill_color(COLOR.WHITE)
+    osd.set_stroke_color(COLOR.WHITE)
+    osd.set_fill_color(COLOR.WHITE)
+    osd.set_fill_color(COLOR.GRAY)
+    osd.set_stroke_and_fill_color(COLOR.WHITE)
+    expected = _mock_osd()
+    expected.set_stroke_and_fill_color(COLOR.WHITE)
+    expected.set_fill_color(COLOR.GRAY)
+    expected.set_stroke_and_fill_color(COLOR.WHITE)
+    assert osd.send_buffer == expected.send_buffer
+
+def test_state_restored_by_pop():
+    osd = _mock_osd(track_state=True)
+    osd.drawing_reset()
+    osd.set_line_outline_type(OUTLINE.TOP)
+    osd.context_push()
+    osd.set_line_outline_type(OUTLINE.TOP)
+    osd.set_line_outline_type(OUTLINE.BOTTOM)
+    osd.context_pop()
+    osd.set_line_outline_type(OUTLINE.TOP)
+    osd.set_line_outline_type(OUTLINE.BOTTOM)
+    expected = _mock_osd()
+    expected.drawing_reset()
+    expected.set_line_outline_type(OUTLINE.TOP)
+    expected.context_push()
+    expected.set_line_outline_type(OUTLINE.BOTTOM)
+    expected.context_pop()
+    expected.set_line_outline_type(OUTLINE.BOTTOM)
+    assert osd.send_buffer == expected.send_buffer
+
+def test_pop_of_untracked_context_forgets_state():
+    osd = _mock_osd(track_state=True)
+    osd.set_stroke_color(COLOR.WHITE)
+    # Pops a context pushed before the state was known
+    osd.context_pop()
+    osd.set_stroke_color(COLOR.WHITE)
+    expected = _mock_osd()
+    expected.set_stroke_color(COLOR.WHITE)
+    expected.context_pop()
+    expected.set_stroke_color(COLOR.WHITE)
+    assert osd.send_buffer == expected.send_buffer
+
+def test_vm_functions_forget_state():
+    osd = _mock_osd(track_state=True)
+    osd.drawing_reset()
+    osd.set_stroke_color(COLOR.WHITE)
+    osd.run_function('draw', reply=False)
+    osd.set_stroke_color(COLOR.WHITE)
+    expected = _mock_osd()
+    expected.drawing_reset()
+    expected.set_stroke_color(COLOR.WHITE)
+    expected.run_function('draw', reply=False)
+    expected.set_stroke_color(COLOR.WHITE)
+    assert osd.send_buffer == expected.send_buffer
@@ -0,0 +1,76 @@
+import pytest
+
+from frskyosd import MAX_RESPONSE_SIZE, FrameDecoder
+from frskyosd.mock import _frame
+
+def _f(payload):
+    return bytes(_frame(bytearray(payload)))
+
+def _payloads(decoder, data):
+    return [bytes(p) for p in decoder.feed_payloads(data)]
+
+def test_frames_split_across_feeds():
+    decoder = FrameDecoder()
+    data = _f(b'\x10first') + _f(b'\x11' * 200) + _f(b'\x12last')
+    payloads = []
+    for ii in range(len(data)):
+        payloads.extend(_payloads(decoder, data[ii:ii + 1]))
+    assert payloads == [b'\x10first', b'\x11' * 200, b'\x12last']
+    assert decoder.frames == 3
+    assert decoder.errors == 0
+    assert decoder.pending() == 0
+
+def test_noise_is_skipped():
+    decoder = FrameDecoder()
+    assert _payloads(decoder, b'noise$' + _f(b'\x10a') + b'$$') == [b'\x10a']
+    assert decoder.skipped_bytes == len(b'noise$') + 1
+    # A trailing '$' might start the next header
+    assert decoder.pending() == 1
+    assert _payloads(decoder, _f(b'\x10b')[1:]) == [b'\x10b']
+
+def test_crc_error_resyncs_in_buffered_data():
+    decoder = FrameDecoder()
+    bad = bytearray(_f(b'\x10' + b'x' * 20))
+    bad[-1] ^= 0xff
+    good = _f(b'\x11ok')
+    assert _payloads(decoder, bytes(bad) + good) == [b'\x11ok']
+    assert decoder.crc_errors == 1
+
+def test_corrupted_length_resyncs_on_next_header():
+    # The length claims more bytes than the frame has, so the next
+    # frame ends up inside it
+    bad = bytearray(_f(b'\x10abc'))
+    bad[2] = 20
+    good = _f(b'\x11' + b'y' * 20)
+    decoder = FrameDecoder()
+    assert _payloads(decoder, bytes(bad) + good) == [b'\x11' + b'y' * 20]
+    assert decoder.crc_errors == 1
+
+def test_lengths_over_the_limit_are_rejected():
+    bad = bytearray(_f(b'\x10abc'))
+    bad[2] = MAX_RESPONSE_SIZE + 1
+    good = _f(b'\x11ok')
+    decoder = FrameDecoder(MAX_RESPONSE_SIZE)
+    # Rejected as soon as the length is read, without waiting for
+    # the bytes it claims
+    assert _payloads(decoder, bytes(bad) + good) == [b'\x11ok']
+    assert decoder.length_errors == 1
+    assert decoder.pending() == 0
+
+def test_abort_drops_partial_frame():
+    bad = bytearray(_f(b'\x10abc'))
+    bad[2] = 60
+    good = _f(b'\x03\x01\x00')
+    decoder = FrameDecoder(MAX_RESPONSE_SIZE)
+    assert _payloads(decoder, bytes(bad) + good) == []
+    assert decoder.pending() == len(bad) + len(good)
+    responses = decoder.abort()
+    assert [(r.cmd, r.payload) for r in responses] == [(3, b'\x01\x00')]
+    assert decoder.length_errors == 1
+    assert decoder.pending() == 0
+
+@pytest.mark.parametrize('size', [0, 1, 127, 128, 254])
+def test_payload_sizes(size):
+    payload = bytes(bytearray(ii & 0xff for ii in range(size)))
+    decoder = FrameDecoder()
+    assert _payloads(decoder, _f(payload)) == [payload]
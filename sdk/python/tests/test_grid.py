@@ -0,0 +1,71 @@
+from frskyosd import GridBuffer
+
+class _GridOSD(object):
+    # Records the grid commands sent by a GridBuffer
+
+    def __init__(self):
+        self.calls = []
+
+    def draw_grid_chr(self, gx, gy, ch, opts=None):
+        self.calls.append(('chr', gx, gy, ch, opts))
+
+    def draw_grid_str(self, gx, gy, s, opts=None):
+        self.calls.append(('str', gx, gy, bytes(s), opts))
+
+def _grid():
+    osd = _GridOSD()
+    return GridBuffer(osd, rows=4, columns=10), osd
+
+def test_adjacent_cells_are_joined():
+    grid, osd = _grid()
+    grid.write(2, 1, 'abc')
+    assert grid.flush() == 1
+    assert osd.calls == [('str', 2, 1, b'abc', 0)]
+
+def test_single_cell_uses_chr():
+    grid, osd = _grid()
+    grid.put(9, 3, 'x', 1)
+    grid.flush()
+    assert osd.calls == [('chr', 9, 3, ord('x'), 1)]
+
+def test_small_gaps_are_resent():
+    grid, osd = _grid()
+    grid.write(0, 0, 'abcdefghij')
+    grid.flush()
+    del osd.calls[:]
+    # Two unchanged cells are cheaper to resend than a new command
+    grid.put(1, 0, 'B')
+    grid.put(4, 0, 'E')
+    # Three aren't
+    grid.put(8, 0, 'I')
+    assert grid.flush() == 2
+    assert osd.calls == [('str', 1, 0, b'BcdE', 0), ('chr', 8, 0, ord('I'), 0)]
+
+def test_runs_split_on_opts_and_wide_chars():
+    grid, osd = _grid()
+    grid.write(0, 2, 'ab')
+    grid.write(2, 2, 'cd', 1)
+    grid.put(4, 2, 300, 1)
+    grid.flush()
+    assert osd.calls == [
+        ('str', 0, 2, b'ab', 0),
+        ('str', 2, 2, b'cd', 1),
+        ('chr', 4, 2, 300, 1),
+    ]
+
+def test_flush_sends_only_changes():
+    grid, osd = _grid()
+    grid.write(0, 0, 'hello')
+    grid.flush()
+    assert grid.flush() == 0
+    grid.write(0, 0, 'hello')
+    assert grid.flush() == 0
+    grid.clear(0)
+    grid.flush()
+    assert osd.calls[-1] == ('str', 0, 0, b'     ', 0)
+
+def test_invalidate_resends_everything():
+    grid, osd = _grid()
+    grid.invalidate()
+    assert grid.flush() == grid.rows
+    assert osd.calls[0] == ('str', 0, 0, b' ' * grid.columns, 0)
@@ -0,0 +1,120 @@
+import io
+
+import pytest
+
+from frskyosd import CHAR_HEIGHT, CHAR_WIDTH, CMD, COLOR, OSD, OUTLINE, MockConn
+
+raster = pytest.importorskip('frskyosd.raster')
+numpy = pytest.importorskip('numpy')
+
+def _font():
+    # Character 'A' has its first row white and the rest transparent,
+    # every other character is solid black
+    lines = [b'MAX7456']
+    for ch in range(256):
+        for row in range(64):
+            if ch == ord('A'):
+                lines.append(b'10101010' if row < 3 else b'01010101')
+            else:
+                lines.append(b'00000000')
+    return io.BytesIO(b'\r\n'.join(lines) + b'\r\n')
+
+@pytest.fixture
+def canvas():
+    osd = OSD('mock')
+    osd.conn = MockConn()
+    return raster.Canvas(osd.get_info(), font=_font())
+
+@pytest.fixture
+def osd(canvas):
+    return canvas.attach(OSD(None))
+
+def _box(canvas, color):
+    # (x0, y0, x1, y1) of the pixels with color, inclusive
+    ys, xs = numpy.nonzero(canvas.pixels == color)
+    return (xs.min(), ys.min(), xs.max(), ys.max())
+
+def test_starts_transparent(canvas):
+    assert canvas.pixels.shape == (288, 360)
+    assert (canvas.pixels == COLOR.TRANSPARENT).all()
+
+def test_rects(canvas, osd):
+    osd.set_fill_color(COLOR.GRAY)
+    osd.fill_rect((10, 20, 30, 5))
+    osd.set_stroke_color(COLOR.WHITE)
+    osd.stroke_rect((100, 100, 5, 4))
+    osd.flush()
+    assert _box(canvas, COLOR.GRAY) == (10, 20, 39, 24)
+    assert (canvas.pixels == COLOR.GRAY).sum() == 30 * 5
+    assert _box(canvas, COLOR.WHITE) == (100, 100, 104, 103)
+    assert (canvas.pixels == COLOR.WHITE).sum() == 2 * 5 + 2 * 2
+    osd.clear_rect((10, 20, 15, 5))
+    osd.flush()
+    assert _box(canvas, COLOR.GRAY) == (25, 20, 39, 24)
+
+def test_lines(canvas, osd):
+    osd.set_stroke_color(COLOR.WHITE)
+    osd.set_line_outline_type(OUTLINE.TOP | OUTLINE.BOTTOM)
+    osd.set_line_outline_color(COLOR.BLACK)
+    osd.move_to_point(10, 10)
+    osd.stroke_line_to_point(20, 10)
+    osd.flush()
+    assert _box(canvas, COLOR.WHITE) == (10, 10, 20, 10)
+    assert _box(canvas, COLOR.BLACK) == (10, 9, 20, 11)
+    assert (canvas.pixels == COLOR.BLACK).sum() == 2 * 11
+
+def test_ctm_and_context(canvas, osd):
+    osd.set_stroke_color(COLOR.WHITE)
+    osd.context_push()
+    osd.set_stroke_color(COLOR.BLACK)
+    osd.ctm_translate(100, 50)
+    osd.set_pixel_to_stroke_color(1, 2)
+    osd.context_pop()
+    osd.set_pixel_to_stroke_color(1, 2)
+    osd.flush()
+    assert canvas.pixels[52, 101] == COLOR.BLACK
+    assert canvas.pixels[2, 1] == COLOR.WHITE
+
+def test_clip(canvas, osd):
+    osd.clip_to_rect((5, 5, 10, 10))
+    osd.fill_rect((0, 0, 100, 100))
+    osd.flush()
+    assert _box(canvas, COLOR.WHITE) == (5, 5, 14, 14)
+
+def test_chars(canvas, osd):
+    osd.draw_grid_str(1, 1, 'AB')
+    osd.flush()
+    x, y = canvas.grid_width, canvas.grid_height
+    assert (canvas.pixels[y, x:x + CHAR_WIDTH] == COLOR.WHITE).all()
+    assert (canvas.pixels[y + 1:y + CHAR_HEIGHT, x:x + CHAR_WIDTH] == COLOR.TRANSPARENT).all()
+    assert (canvas.pixels[y:y + CHAR_HEIGHT, x + CHAR_WIDTH:x + 2 * CHAR_WIDTH] == COLOR.BLACK).all()
+    osd.draw_str_mask(0, 100, 'A', COLOR.GRAY)
+    osd.flush()
+    assert (canvas.pixels[100, 0:CHAR_WIDTH] == COLOR.GRAY).all()
+    assert canvas.missing_chars == 0
+
+def test_transactions(canvas, osd):
+    osd.transaction_begin()
+    osd.fill_rect((0, 0, 5, 5))
+    osd.flush_send_buffer()
+    assert (canvas.pixels == COLOR.TRANSPARENT).all()
+    osd.transaction_commit()
+    osd.flush_send_buffer()
+    assert (canvas.pixels == COLOR.WHITE).sum() == 25
+    assert canvas.transactions == 1
+
+def test_ignored_commands(canvas, osd):
+    osd.widget_ahi_draw(0, 0)
+    osd.flush()
+    assert canvas.ignored[CMD.WIDGET_DRAW] == 1
+
+def test_pgm(canvas, osd):
+    osd.fill_rect((0, 0, 1, 1))
+    osd.flush()
+    f = io.BytesIO()
+    canvas.to_pgm(f)
+    data = f.getvalue()
+    header = b'P5\n360 288\n255\n'
+    assert data.startswith(header)
+    assert len(data) == len(header) + 360 * 288
+    assert bytearray(data)[len(header)] == 255
@@ -0,0 +1,103 @@
+import pytest
+
+from frskyosd import COLOR, OSD, OUTLINE, MockConn, Scene
+from frskyosd.scene import Line, Rect, Triangle
+
+raster = pytest.importorskip('frskyosd.raster')
+
+def _canvas_osd():
+    osd = OSD('mock')
+    osd.conn = MockConn()
+    osd.info = osd.get_info()
+    canvas = raster.Canvas(osd.info)
+    canvas.attach(osd)
+    return osd, canvas
+
+def _drawn(canvas):
+    return int((canvas.pixels != COLOR.TRANSPARENT).sum())
+
+def test_line_ignores_inherited_state():
+    osd, canvas = _canvas_osd()
+    osd.set_stroke_width(3)
+    osd.set_line_outline_type(OUTLINE.TOP)
+    scene = Scene(osd)
+    scene.set('line', Line([(10, 10), (100, 10)], COLOR.WHITE))
+    scene.commit()
+    osd.flush()
+    assert _drawn(canvas) == 91
+
+@pytest.mark.parametrize('outline_color', [None, COLOR.BLACK])
+def test_line_outline_erased(outline_color):
+    osd, canvas = _canvas_osd()
+    osd.set_line_outline_color(COLOR.BLACK)
+    scene = Scene(osd)
+    scene.set('line', Line([(10, 10), (100, 10)], COLOR.WHITE, OUTLINE.BOTTOM, outline_color))
+    scene.commit()
+    osd.flush()
+    assert _drawn(canvas) == 2 * 91
+    scene.remove('line')
+    scene.commit()
+    osd.flush()
+    assert _drawn(canvas) == 0
+
+def _render(nodes):
+    # Pixels for the nodes drawn by a single commit
+    osd, canvas = _canvas_osd()
+    scene = Scene(osd)
+    for key, node in nodes:
+        scene.set(key, node)
+    scene.commit()
+    osd.flush()
+    return canvas.pixels
+
+def test_commit_without_changes_sends_nothing():
+    osd, canvas = _canvas_osd()
+    scene = Scene(osd)
+    scene.set('rect', Rect((10, 10, 20, 20), fill=COLOR.WHITE))
+    assert scene.commit() == (0, 1)
+    osd.flush()
+    # An equal node doesn't count as a change
+    scene.set('rect', Rect((10, 10, 20, 20), fill=COLOR.WHITE))
+    assert scene.commit() == (0, 0)
+    assert not osd.send_buffer
+
+def test_commit_redraws_only_affected_nodes():
+    osd, canvas = _canvas_osd()
+    scene = Scene(osd)
+    scene.set('far', Rect((200, 200, 20, 20), stroke=COLOR.WHITE))
+    scene.set('below', Rect((10, 10, 50, 50), fill=COLOR.GRAY))
+    scene.set('above', Triangle((20, 20), (40, 20), (30, 40), fill=COLOR.WHITE))
+    scene.commit()
+    scene.set('below', Rect((10, 10, 50, 50), fill=COLOR.BLACK))
+    # Erases and draws 'below', then redraws 'above' on top of it
+    assert scene.commit() == (1, 2)
+    osd.flush()
+    assert (canvas.pixels == _render([
+        ('far', Rect((200, 200, 20, 20), stroke=COLOR.WHITE)),
+        ('below', Rect((10, 10, 50, 50), fill=COLOR.BLACK)),
+        ('above', Triangle((20, 20), (40, 20), (30, 40), fill=COLOR.WHITE)),
+    ])).all()
+
+def test_commit_restores_erased_area():
+    osd, canvas = _canvas_osd()
+    scene = Scene(osd)
+    scene.set('back', Rect((0, 0, 100, 100), fill=COLOR.GRAY))
+    scene.set('moving', Rect((10, 10, 20, 20), fill=COLOR.WHITE))
+    scene.commit()
+    scene.set('moving', Rect((50, 50, 20, 20), fill=COLOR.WHITE))
+    # 'back' is redrawn where 'moving' was erased
+    assert scene.commit() == (1, 2)
+    osd.flush()
+    assert (canvas.pixels == _render([
+        ('back', Rect((0, 0, 100, 100), fill=COLOR.GRAY)),
+        ('moving', Rect((50, 50, 20, 20), fill=COLOR.WHITE)),
+    ])).all()
+
+def test_commit_after_invalidate_draws_everything():
+    osd, canvas = _canvas_osd()
+    scene = Scene(osd)
+    scene.set('a', Rect((10, 10, 20, 20), fill=COLOR.WHITE))
+    scene.set('b', Rect((100, 10, 20, 20), fill=COLOR.WHITE))
+    scene.commit()
+    scene.invalidate()
+    assert scene.commit() == (0, 2)
@@ -0,0 +1,89 @@
+import io
+import os
+
+import pytest
+
+from frskyosd import FONT_CHAR_SIZE, OSD, MockOSD, MockOSDServer, parse_mcm
+
+# Errors are random but reproducible, these seeds flip bits in both
+# the requests and the responses of every transfer
+SEEDS = [1, 2, 9]
+BIT_ERROR_RATE = 1e-4
+
+class _Link(object):
+    # MockOSDServer flipping bits only while a pipelined transfer is
+    # running, since the single requests around it aren't retried
+
+    def __init__(self, device, seed):
+        self.bit_error_rate = 0
+        self.server = MockOSDServer(device, bit_error_rate=lambda rate: self.bit_error_rate,
+                                    seed=seed, emulate_link=False)
+
+    def __enter__(self):
+        self.server.start()
+        osd = OSD(self.server.address, timeout=0.1)
+        assert osd.connect()
+        send_pipelined = osd._send_pipelined
+
+        def _send_pipelined(*args, **kwargs):
+            self.bit_error_rate = BIT_ERROR_RATE
+            try:
+                return send_pipelined(*args, **kwargs)
+            finally:
+                self.bit_error_rate = 0
+
+        osd._send_pipelined = _send_pipelined
+        self.osd = osd
+        return osd
+
+    def __exit__(self, *args):
+        self.osd.close()
+        self.server.stop()
+
+    @property
+    def errors(self):
+        return self.server.crc_errors + self.osd._decoder.errors
+
+def _font():
+    lines = (b'01010101' if ii % 3 else b'10011010' for ii in range(FONT_CHAR_SIZE * 48))
+    return b'MAX7456\r\n' + b''.join(line + b'\r\n' for line in lines)
+
+@pytest.fixture
+def device():
+    return MockOSD(vm_storage_size=16384)
+
+@pytest.mark.parametrize('window', [1, 4])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_font_transfer_with_bit_errors(device, seed, window):
+    font = _font()
+    data = parse_mcm(io.BytesIO(font))
+    chars = range(len(data) // FONT_CHAR_SIZE)
+    link = _Link(device, seed)
+    with link as osd:
+        osd.upload_font(io.BytesIO(font), window=window)
+        assert b''.join(device.font[c] for c in chars) == bytes(data)
+        assert osd.read_font(chars, window=window) == data
+    assert link.errors > 0
+
+@pytest.mark.parametrize('window', [1, 4])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_flash_with_bit_errors(device, seed, window):
+    firmware = bytes(bytearray(range(256))) * 24
+    device.reboot(True)
+    link = _Link(device, seed)
+    with link as osd:
+        osd.flash_firmware_bl(io.BytesIO(firmware), window=window)
+    assert device.flash == bytearray(firmware)
+    assert link.errors > 0
+
+@pytest.mark.parametrize('window', [1, 8])
+@pytest.mark.parametrize('seed', SEEDS)
+def test_vm_transfer_with_bit_errors(device, seed, window):
+    program = os.urandom(3000)
+    link = _Link(device, seed)
+    with link as osd:
+        osd.upload_program(io.BytesIO(program), window=window)
+        out = io.BytesIO()
+        osd.download_program(out, window=window)
+    assert out.getvalue() == program
+    assert link.errors > 0